@@ -5,6 +5,20 @@ import os
 import os.path
 import argparse
 import logging
+import operator
+import httplib
+import Queue
+import re
+import socket
+import StringIO
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import photometry_store
+import query_cache
+import sky_index
 
 #############
 ### USAGE ###
@@ -29,6 +43,11 @@ import logging
 # Alternatively, if you're running this program from a python interpreter, you can call the function
 # get_candidates(ra, dec, search_radius), which is what the commandline calls anyway.
 #
+# To search many fields at once, put one 'ra dec angle [name]' per line in a file and enter
+# $ python automated_css_search.py --targets targets.txt --output_directory sweep
+# This writes each search's directory into 'sweep', plus sweep/index.html (a line and a link
+# per target) and sweep/all_candidates.csv (every candidate of every target).
+#
 # Be warned that this program is not smart about handling errors from the web servers 
 # (e.g. server timeout; invalid RA/DEC; etc). If you're getting weird parse errors from 
 # this program, go and try plugging in your same search parameters first into the Chandra
@@ -37,18 +56,76 @@ import logging
 #####################################
 
 
-# Makes url GET request from chandra database.
-def load_CSC_SDSS_CSV(ra, dec, search_radius):
+CSC_XMATCH_URL = 'http://cxc.harvard.edu/cgi-gen/cda/CSC-SDSSxmatch.pl'
+
+# Lines of html before and after the table in a CSC response.
+CSC_HEADER_LINES = 9
+CSC_FOOTER_LINES = 5
+
 
-	sUrl = 'http://cxc.harvard.edu/cgi-gen/cda/CSC-SDSSxmatch.pl?where=&ra_cone={}&dec_cone={}&radius_cone={}&order=&format=tab&Query=+++Submit+Query+++'.format(ra, dec, search_radius)
-	request = urllib2.Request(sUrl)
+# Cuts a CSC response down to the rows within radius_arcmin of ra, dec, keeping the html
+# around the table as it is. Returns None if the rows' positions can't be read (then the
+# cone has to be fetched instead).
+def filter_CSC_response(CSC_file_string, ra, dec, radius_arcmin):
+	lines = CSC_file_string.splitlines()
+	lHeader = [sName.strip().lower() for sName in lines[CSC_HEADER_LINES][5:].split('\t')]
+	if not ('ra' in lHeader and 'dec' in lHeader):
+		return None
+	lDataLines = lines[CSC_HEADER_LINES + 2:-CSC_FOOTER_LINES]
+	try:
+		lRows = [sLine.split('\t') for sLine in lDataLines]
+		aRA = np.array([float(lRow[lHeader.index('ra')]) for lRow in lRows])
+		aDEC = np.array([float(lRow[lHeader.index('dec')]) for lRow in lRows])
+	except (ValueError, IndexError):
+		return None
+	aInside = query_cache.get_separation_arcsec(aRA, aDEC, float(ra), float(dec)) <= float(radius_arcmin) * 60.
+	if not aInside.any():
+		raise BaseException('0 results from Chandra within cached cone RA={} DEC={} Rad={}'.format(
+			ra, dec, radius_arcmin))
+	return '\n'.join(lines[:CSC_HEADER_LINES + 2] +
+		[sLine for (sLine, inside) in zip(lDataLines, aInside) if inside] +
+		lines[-CSC_FOOTER_LINES:]) + '\n'
+
+
+# Makes url GET request from chandra database. With cache_directory, the answer comes
+# from a cached search of the same or a bigger cone if there is one (younger than
+# ttl_hours), and otherwise is cached. connection_pool (an http_connection_pool for
+# sURL) lets several searches share, and be limited to, a few connections.
+def load_CSC_SDSS_CSV(ra, dec, search_radius, cache_directory=None,
+		ttl_hours=query_cache.DEFAULT_TTL_HOURS, sURL=CSC_XMATCH_URL, connection_pool=None):
+
+	if cache_directory:
+		cached_entry = query_cache.find_containing_entry(cache_directory, 'CSC', ra, dec,
+			search_radius, ttl_hours=ttl_hours)
+		if cached_entry is not None:
+			cache_key, meta = cached_entry
+			response_string = query_cache.load_cached_response(cache_directory, cache_key)
+			if response_string is not None and (meta['radius_arcmin'] != float(search_radius)
+					or meta['ra'] != float(ra) or meta['dec'] != float(dec)):
+				response_string = filter_CSC_response(response_string, ra, dec, search_radius)
+			if response_string is not None:
+				print 'query cache: CSC cone answered from cached cone RA={} DEC={} Rad={}'.format(
+					meta['ra'], meta['dec'], meta['radius_arcmin'])
+				return response_string
+
+	sQuery = 'where=&ra_cone={}&dec_cone={}&radius_cone={}&order=&format=tab&Query=+++Submit+Query+++'.format(ra, dec, search_radius)
+	sUrl = (connection_pool.sURL if connection_pool else sURL) + '?' + sQuery
 	print "request sent to CSC web server ..."
-	response_string = urllib2.urlopen(request).read()
+	if connection_pool:
+		response_string = connection_pool.get(sQuery)
+	else:
+		connection_pool = http_connection_pool(sURL, max_connections=1)
+		try:
+			response_string = connection_pool.get(sQuery)
+		finally:
+			connection_pool.close()
 	print "data received..."
 	
 	if len(response_string) < 400:
 		raise BaseException('0 results from Chandra with request URL {}'.format(sUrl)) 
 
+	if cache_directory:
+		query_cache.store_response(cache_directory, 'CSC', ra, dec, search_radius, response_string)
 	return response_string
 
 
@@ -64,10 +141,10 @@ def parse_CSC_CSV(CSC_file_string, oFileNames):
 	lines = CSC_file_string.splitlines()
 
 	# remove first 9 lines (html).
-	lines = lines[9:]
+	lines = lines[CSC_HEADER_LINES:]
 
 	# remove the last 5 lines (html).
-	lines = lines[:-5]
+	lines = lines[:-CSC_FOOTER_LINES]
 
 	# remove '<pre>' from the beginning of the (now) first line.
 	lines[0] = lines[0][5:]
@@ -93,30 +170,193 @@ def parse_CSC_CSV(CSC_file_string, oFileNames):
 	return list(data_in_recarray['objid'])
 
 
-# Loads specified objects from SDSS DR7 and returns a single recarray.
-def load_SDSS_data(CSC_objID_list, ra, dec, search_radius, oFileNames):
-
-	def create_SQL_query(CSC_objID_list, ra, dec, search_radius):
-		query_str = 'SELECT objID,ra,dec,u,g,r,i,z,petroRad_r, type FROM PhotoObjAll WHERE objID IN '.format(ra, dec, search_radius)
-		query_str = ' '.join([query_str, str(tuple(CSC_objID_list))])
-		return query_str 
-
-	def makeSDSS_post_request(sSQL_query):
-		sURL = 'http://cas.sdss.org/dr7/en/tools/search/x_sql.asp'
-		# for POST request
-		values = {'cmd': sSQL_query,
-							'format': 'csv'}
-		data = urllib.urlencode(values)
-		request = urllib2.Request(sURL, data)
-		response = urllib2.urlopen(request)
-		return response.read()
-
-	sql_query_string = create_SQL_query(CSC_objID_list, ra, dec, search_radius)
-	logging.debug(sql_query_string)
-	print 'Querying SDSS dr7 for {} objects ...'.format(len(CSC_objID_list))
-	sdss_data_string = makeSDSS_post_request(sql_query_string)
-	logging.debug(sdss_data_string)
-	print 'data received...'
+SDSS_SQL_URL = 'http://cas.sdss.org/dr7/en/tools/search/x_sql.asp'
+
+# objIDs per SDSS query: the server slows down on (or rejects) huge IN (...) lists.
+SDSS_BATCH_SIZE = 500
+
+# SDSS queries in flight at once, which is also how many connections are kept open.
+SDSS_MAX_CONNECTIONS = 4
+
+# Columns fetched from SDSS for each object.
+SDSS_PHOTOMETRY_COLUMNS = ['objID', 'ra', 'dec', 'u', 'g', 'r', 'i', 'z', 'petroRad_r', 'type']
+
+# Seconds to wait on a web server before giving up.
+HTTP_TIMEOUT = 120
+
+
+# A fixed number of keep-alive HTTP connections to one URL, shared between threads. A
+# request borrows a connection and hands it back once the whole response is read, so
+# the next request on it doesn't have to connect again. Connections are opened as
+# they're first needed, and reopened if the server has closed them in the meantime.
+class http_connection_pool(object):
+	def __init__(self, sURL, max_connections=SDSS_MAX_CONNECTIONS, timeout=HTTP_TIMEOUT):
+		oURL = urlparse.urlparse(sURL)
+		self.sURL = sURL
+		self.connection_class = httplib.HTTPSConnection if oURL.scheme == 'https' else httplib.HTTPConnection
+		self.host = oURL.hostname
+		self.port = oURL.port
+		self.path = oURL.path or '/'
+		self.timeout = timeout
+		self.n_connections_opened = 0
+		self.lock = threading.Lock()
+		self.idle_connections = Queue.Queue()
+		for index in range(max_connections):
+			self.idle_connections.put(None)
+
+	def open_connection(self):
+		with self.lock:
+			self.n_connections_opened += 1
+		return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+	# POSTs a dict of form values and returns the body of the response.
+	def post(self, values):
+		return self.request('POST', self.path, urllib.urlencode(values),
+			{'Content-Type': 'application/x-www-form-urlencoded'})
+
+	# GETs the URL with the given (already encoded) query string, and returns the body of
+	# the response.
+	def get(self, sQuery):
+		return self.request('GET', self.path + '?' + sQuery)
+
+	def request(self, sMethod, sPath, sBody=None, headers=None):
+		headers = dict(headers or {}, Connection='keep-alive')
+		connection = self.idle_connections.get()
+		try:
+			for attempt in range(2):
+				if connection is None:
+					connection = self.open_connection()
+				try:
+					connection.request(sMethod, sPath, sBody, headers)
+					response = connection.getresponse()
+					sResponse = response.read()
+					break
+				except (httplib.HTTPException, socket.error):
+					connection.close()
+					connection = None
+					if attempt:
+						raise
+			if response.will_close:
+				connection.close()
+				connection = None
+			if response.status != 200:
+				raise BaseException('HTTP {} from {}:\n{}'.format(response.status, self.sURL,
+					sResponse[:500]))
+			return sResponse
+		finally:
+			self.idle_connections.put(connection)
+
+	def close(self):
+		while not self.idle_connections.empty():
+			connection = self.idle_connections.get()
+			if connection is not None:
+				connection.close()
+
+
+# sWhere, if given, is an extra condition on the objects (see get_SQL_where).
+def create_SQL_query(lObjIDs, sWhere=None):
+	sQuery = 'SELECT {} FROM PhotoObjAll WHERE objID IN ({})'.format(','.join(SDSS_PHOTOMETRY_COLUMNS),
+		','.join([str(objID) for objID in lObjIDs]))
+	if sWhere:
+		sQuery += ' AND ' + sWhere
+	return sQuery
+
+
+# Sends one SQL query to the SDSS x_sql.asp endpoint over a connection from the pool, and
+# returns the CSV it answers with.
+def post_SDSS_query(connection_pool, sSQL_query):
+	logging.debug(sSQL_query)
+	sResponse = connection_pool.post({'cmd': sSQL_query, 'format': 'csv'})
+	logging.debug(sResponse)
+	return sResponse
+
+
+# Joins the CSV responses of several queries into one CSV, checking they all start with
+# the same header line, give or take case and spaces (an SDSS error message won't).
+def merge_CSV_responses(lResponses):
+	sHeader = None
+	lRows = []
+	for sResponse in lResponses:
+		lLines = sResponse.splitlines()
+		if not lLines:
+			continue
+		if sHeader is None:
+			sHeader = lLines[0]
+		if lLines[0].lower().replace(' ', '') != sHeader.lower().replace(' ', ''):
+			raise BaseException('Unexpected response from SDSS:\n{}'.format(sResponse[:500]))
+		lRows.extend([sLine for sLine in lLines[1:] if sLine])
+	if sHeader is None:
+		raise BaseException('Empty response from SDSS.')
+	return '\n'.join([sHeader] + lRows) + '\n'
+
+
+# Writes rows of photometry (see photometry_store) out as an SDSS CSV answer.
+def format_SDSS_CSV(photometry_rows):
+	return '\n'.join([','.join(SDSS_PHOTOMETRY_COLUMNS)] + [','.join([repr(value) if isinstance(value, float)
+		else str(value) for value in row]) for row in photometry_rows.tolist()]) + '\n'
+
+
+# Reads an SDSS CSV answer into a recarray (an empty one if it has no rows).
+def parse_SDSS_CSV(sdss_data_string):
+	if len(sdss_data_string.strip().splitlines()) < 2:
+		return np.rec.fromarrays([np.empty(0, dtype=column_type)
+			for (column_name, column_type) in photometry_store.PHOTOMETRY_DTYPE],
+			dtype=photometry_store.PHOTOMETRY_DTYPE)
+	return np.atleast_1d(np.recfromcsv(StringIO.StringIO(sdss_data_string), delimiter=','))
+
+
+# Cuts an SDSS CSV down to the rows of the given objIDs (objID is the first column).
+def filter_SDSS_response(sdss_data_string, lObjIDs):
+	setObjIDs = set([long(objID) for objID in lObjIDs])
+	lLines = sdss_data_string.splitlines()
+	return '\n'.join(lLines[:1] + [sLine for sLine in lLines[1:]
+		if sLine and long(sLine.split(',', 1)[0]) in setObjIDs]) + '\n'
+
+
+# Loads specified objects from SDSS DR7 and returns a single recarray. The objIDs are
+# split into queries of batch_size, of which n_connections are sent at once over
+# keep-alive connections; the CSV answers are merged (in the order of the objIDs'
+# batches) and saved to oFileNames['SDSS_data']. sURL can point at a stand-in server (see
+# test_automated_CSS_search.start_fake_SDSS_server), or connection_pool can be an
+# http_connection_pool shared with other searches (it then also limits how many queries
+# are in flight). With cache_directory, the answer comes from the cached
+# SDSS answer for a cone (younger than ttl_hours) that contains ra, dec, search_radius
+# and was asked for all of these objIDs, if there is one, and otherwise is cached. With
+# store_directory, objects already in that photometry store aren't fetched again, and
+# the ones that are fetched are added to it. With filter_spec, SDSS only sends the objects
+# that pass it (others may still come from the cache or store; filter_CSS_candidates
+# applies the same spec to them).
+def load_SDSS_data(CSC_objID_list, ra, dec, search_radius, oFileNames, batch_size=SDSS_BATCH_SIZE,
+		n_connections=SDSS_MAX_CONNECTIONS, sURL=SDSS_SQL_URL, cache_directory=None,
+		ttl_hours=query_cache.DEFAULT_TTL_HOURS, store_directory=None, connection_pool=None,
+		filter_spec=None):
+	if len(CSC_objID_list) == 0:
+		raise BaseException('No objIDs to query SDSS for.')
+
+	sWhere = get_SQL_where(filter_spec) if filter_spec else None
+	cached_entry = None
+	if cache_directory:
+		# An unfiltered answer has every object a filtered one would.
+		setObjIDs = set([long(objID) for objID in CSC_objID_list])
+		cached_entry = query_cache.find_containing_entry(cache_directory, 'SDSS', ra, dec,
+			search_radius, ttl_hours=ttl_hours, accept=lambda meta: setObjIDs.issubset(meta['objids'])
+				and meta.get('where') in (None, sWhere))
+	sdss_data_string = None
+	if cached_entry is not None:
+		cache_key, meta = cached_entry
+		sdss_data_string = query_cache.load_cached_response(cache_directory, cache_key)
+	if sdss_data_string is not None:
+		sdss_data_string = filter_SDSS_response(sdss_data_string, CSC_objID_list)
+		print 'query cache: SDSS data for {} objects answered from cached cone RA={} DEC={} Rad={}'.format(
+			len(CSC_objID_list), meta['ra'], meta['dec'], meta['radius_arcmin'])
+	else:
+		sdss_data_string = load_SDSS_photometry(CSC_objID_list, batch_size=batch_size,
+			n_connections=n_connections, sURL=sURL, store_directory=store_directory,
+			connection_pool=connection_pool, sWhere=sWhere)
+		if cache_directory:
+			query_cache.store_response(cache_directory, 'SDSS', ra, dec, search_radius,
+				sdss_data_string, extra_meta={'objids': [long(objID) for objID in CSC_objID_list],
+				'where': sWhere})
 
 	sSDSS_filename = oFileNames['SDSS_data']
 
@@ -124,36 +364,145 @@ def load_SDSS_data(CSC_objID_list, ra, dec, search_radius, oFileNames):
 	with open(sSDSS_filename, 'w') as f:
 		f.write(sdss_data_string)
 
-	# reopen same file to read into recarray.
-	with open(sSDSS_filename, 'r') as f:
-		sdss_rec_array = np.recfromcsv(f, delimiter=',')
-
-	return sdss_rec_array
-
-
+	# parse_SDSS_CSV keeps the column names of an answer with no rows (e.g. when SDSS
+	# applied filter_spec and nothing passed), which np.recfromcsv doesn't.
+	return parse_SDSS_CSV(sdss_data_string)
+
+
+# Returns the SDSS CSV answer for the given objIDs: the rows already in the photometry
+# store in store_directory (if given), followed by the rest, fetched from SDSS (only
+# those meeting sWhere, if given). Objects the store knows fail sWhere are left out.
+def load_SDSS_photometry(CSC_objID_list, batch_size=SDSS_BATCH_SIZE, n_connections=SDSS_MAX_CONNECTIONS,
+		sURL=SDSS_SQL_URL, store_directory=None, connection_pool=None, sWhere=None):
+	if not store_directory:
+		return fetch_SDSS_data(CSC_objID_list, batch_size=batch_size, n_connections=n_connections,
+			sURL=sURL, connection_pool=connection_pool, sWhere=sWhere)
+
+	store = photometry_store.get_photometry_store(store_directory)
+	stored_rows, aObjIDsToFetch = store.lookup(CSC_objID_list, sCondition=sWhere)
+	print 'photometry store: {} of {} objects already stored, {} to fetch.'.format(len(stored_rows),
+		len(CSC_objID_list), len(aObjIDsToFetch))
+	lResponses = [format_SDSS_CSV(stored_rows)]
+	if len(aObjIDsToFetch):
+		sFetched = fetch_SDSS_data(list(aObjIDsToFetch), batch_size=batch_size,
+			n_connections=n_connections, sURL=sURL, connection_pool=connection_pool, sWhere=sWhere)
+		store.add(parse_SDSS_CSV(sFetched), aObjIDsToFetch, sCondition=sWhere)
+		lResponses.append(sFetched)
+	return merge_CSV_responses(lResponses)
+
+
+# Queries SDSS for the given objIDs, batch_size at a time with n_connections queries in
+# flight (over connection_pool's connections, if given), and returns the merged CSV. With
+# sWhere, only the objects that meet that condition are returned.
+def fetch_SDSS_data(CSC_objID_list, batch_size=SDSS_BATCH_SIZE, n_connections=SDSS_MAX_CONNECTIONS,
+		sURL=SDSS_SQL_URL, connection_pool=None, sWhere=None):
+	lBatches = [CSC_objID_list[start:start + batch_size]
+		for start in range(0, len(CSC_objID_list), batch_size)]
+	print 'Querying SDSS dr7 for {} objects in {} batch(es) ...'.format(len(CSC_objID_list),
+		len(lBatches))
+	bOwnConnections = connection_pool is None
+	if bOwnConnections:
+		connection_pool = http_connection_pool(sURL, max_connections=n_connections)
+	thread_pool = ThreadPool(processes=min(n_connections, len(lBatches)))
+	try:
+		lResponses = thread_pool.map(lambda lObjIDs: post_SDSS_query(connection_pool,
+			create_SQL_query(lObjIDs, sWhere)), lBatches)
+		thread_pool.close()
+	finally:
+		thread_pool.terminate()
+		thread_pool.join()
+		if bOwnConnections:
+			connection_pool.close()
+	sdss_data_string = merge_CSV_responses(lResponses)
+	print 'data received...'
+	return sdss_data_string
+
+
+# Candidate cuts are written as a filter spec: a list of (expression, operator, value)
+# cuts that an object has to pass all of. An expression is a column of the SDSS data
+# ('i') or the difference of two ('g-i'); operators are those of FILTER_OPERATORS. A
+# spec is evaluated on a recarray as NumPy masks (evaluate_filter_spec), and can also be
+# sent to SDSS as the WHERE clause of the query (get_SQL_where), so that objects it
+# rejects are never downloaded. (SDSS compares its own float32 values, so an object right
+# on a cut's edge may be turned away by SDSS but kept locally; nothing extra gets through,
+# since the spec is still applied to what comes back.)
+FILTER_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+	'==': operator.eq, '!=': operator.ne}
+
+# The operators in SDSS SQL.
+SQL_OPERATORS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=', '==': '=', '!=': '<>'}
+
+
+# The spec of filter_CSS_candidates' cuts (all ranges exclusive).
+def make_CSS_filter_spec(petroRadRange=(0.,6.), i_mag_range=(15.,19.4), color_range=(0.7, 1.3)):
+	return [('i', '>', i_mag_range[0]), ('i', '<', i_mag_range[1]),
+		('g-i', '>', color_range[0]), ('g-i', '<', color_range[1]),
+		('type', '==', 3),
+		('petroRad_r', '>', petroRadRange[0]), ('petroRad_r', '<', petroRadRange[1])]
+
+
+# Splits an expression into its column names: 'g-i' -> ['g', 'i'], 'i' -> ['i'].
+def get_expression_columns(sExpression):
+	lColumns = [sColumn.strip() for sColumn in sExpression.split('-')]
+	if not 1 <= len(lColumns) <= 2 or not all([re.match(r'^[A-Za-z_]\w*$', sColumn) for sColumn in lColumns]):
+		raise BaseException("Filter expression '{}' is not a column or the difference of two.".format(
+			sExpression))
+	return lColumns
+
+
+def check_filter_cut(tCut):
+	sExpression, sOperator, value = tCut
+	if not sOperator in FILTER_OPERATORS:
+		raise BaseException("Filter operator '{}' not found in list:\n{}".format(sOperator,
+			sorted(FILTER_OPERATORS)))
+	if not isinstance(value, (int, long, float)):
+		raise BaseException("Filter value {!r} of '{}' is not a number.".format(value, sExpression))
+	return get_expression_columns(sExpression)
+
+
+# Returns a boolean mask of the rows of recarray that pass every cut of filter_spec.
+# Column names are matched without regard to case (np.recfromcsv lowercases them).
+def evaluate_filter_spec(recarray, filter_spec):
+	recarray = np.atleast_1d(recarray)
+	for tCut in filter_spec:
+		check_filter_cut(tCut)
+	if len(recarray) == 0:
+		return np.zeros(0, dtype=bool)
+	column_names = dict((column_name.lower(), column_name) for column_name in recarray.dtype.names)
+	aPass = np.ones(len(recarray), dtype=bool)
+	for tCut in filter_spec:
+		lColumns = check_filter_cut(tCut)
+		for sColumn in lColumns:
+			if not sColumn.lower() in column_names:
+				raise BaseException("Column '{}' not found in SDSS data from list:\n{}".format(sColumn,
+					sorted(recarray.dtype.names)))
+		aValues = recarray[column_names[lColumns[0].lower()]]
+		if len(lColumns) == 2:
+			aValues = aValues - recarray[column_names[lColumns[1].lower()]]
+		aPass &= FILTER_OPERATORS[tCut[1]](aValues, tCut[2])
+	return aPass
+
+
+# Translates filter_spec into an SDSS SQL condition, e.g. "i > 15.0 AND (g - i) < 1.3".
+def get_SQL_where(filter_spec):
+	lTerms = []
+	for tCut in filter_spec:
+		lColumns = check_filter_cut(tCut)
+		sExpression = lColumns[0] if len(lColumns) == 1 else '({} - {})'.format(*lColumns)
+		lTerms.append('{} {} {!r}'.format(sExpression, SQL_OPERATORS[tCut[1]], tCut[2]))
+	return ' AND '.join(lTerms)
+
+
+# Keeps the rows of SDSS_data_recarray that pass filter_spec (by default, the cuts of
+# make_CSS_filter_spec with the given ranges).
 def filter_CSS_candidates(SDSS_data_recarray, oFileNames, petroRadRange=(0.,6.), 
-		i_mag_range=(15.,19.4), color_range=(0.7, 1.3)):
-
-	def IsObjectInCSSRegime(SDSS_object_line, petroRadRange=petroRadRange,
-		i_mag_range=i_mag_range, color_range=color_range):
-		g_mag = SDSS_object_line['g']
-		i_mag = SDSS_object_line['i']
-		g_i = g_mag - i_mag
-		petroRad_r = SDSS_object_line['petrorad_r']
-		object_type = SDSS_object_line['type']
-		return ((i_mag > i_mag_range[0]) & (i_mag < i_mag_range[1])
-			& (g_i > color_range[0]) & (g_i < color_range[1])
-			& (object_type == 3) 
-			& (petroRadRange[0] < petroRad_r) & (petroRad_r < petroRadRange[1]))
-
-	# similar functionality to numpy.where(), but I find this more readable.
-	CSS_candidate_indices = []
-	for index, line_content in enumerate(SDSS_data_recarray):
-		if IsObjectInCSSRegime(line_content):
-			CSS_candidate_indices.append(index)
-
-	print "After filtering, {} CSS candidate(s) remain.".format(len(CSS_candidate_indices))
-	return SDSS_data_recarray[CSS_candidate_indices]
+		i_mag_range=(15.,19.4), color_range=(0.7, 1.3), filter_spec=None):
+	if filter_spec is None:
+		filter_spec = make_CSS_filter_spec(petroRadRange, i_mag_range, color_range)
+	SDSS_data_recarray = np.atleast_1d(SDSS_data_recarray)
+	candidates = SDSS_data_recarray[evaluate_filter_spec(SDSS_data_recarray, filter_spec)]
+	print "After filtering, {} CSS candidate(s) remain.".format(len(candidates))
+	return candidates
 
 # generate a local webpage for allowing visual inspection of thumbnails.
 def generate_webpage_of_results(candidates_recarray, oFileNames):
@@ -191,13 +540,24 @@ def generate_webpage_of_results(candidates_recarray, oFileNames):
 # For CSC objects, pulls data from SDSS database; parses.
 # Filters objects for color/magnitude, radius, etc.
 # Finally, creates a little, local webpage for manual inspection
-# of thumbnails.
-def get_candidates(ra, dec, search_radius):
+# of thumbnails. Server responses are cached in cache_directory (None: not cached) for
+# ttl_hours, and SDSS photometry is kept in the store in store_directory (None: no store).
+# The results go in a directory in output_directory (default: the current directory).
+# CSC_pool and SDSS_pool are http_connection_pools shared with other searches (see
+# run_batch). filter_spec replaces the default cuts (see make_CSS_filter_spec); with
+# push_down_filter, SDSS applies them too, and doesn't send the objects they reject.
+# Returns the recarray of candidates, or (candidates, oFileNames) with return_file_names.
+def get_candidates(ra, dec, search_radius, cache_directory=None,
+		ttl_hours=query_cache.DEFAULT_TTL_HOURS, store_directory=None, output_directory=None,
+		CSC_pool=None, SDSS_pool=None, filter_spec=None, push_down_filter=False,
+		return_file_names=False):
+	filter_spec = filter_spec or make_CSS_filter_spec()
+
 
 	# define names of files.
 	sSearchID = 'RA{}_DEC{}_Rad{}'.format(ra, dec, search_radius)
 	subdirectory_name = 'results_for_{}'.format(sSearchID)
-	subdirectory_path = os.path.join(os.getcwd(), subdirectory_name)
+	subdirectory_path = os.path.join(output_directory or os.getcwd(), subdirectory_name)
 	oFileNames = {
 		'CSC_data': os.path.join(subdirectory_path, 'CSC_data_{}.csv'.format(sSearchID)),
 		'SDSS_data': os.path.join(subdirectory_path, 'SDSS_data_{}.csv'.format(sSearchID)),
@@ -212,25 +572,248 @@ def get_candidates(ra, dec, search_radius):
 		level=logging.DEBUG, filemode='w')
 
 	# Load data and parse, saving along intermediate points.
-	CSC_file_string = load_CSC_SDSS_CSV(ra, dec, search_radius)
+	CSC_file_string = load_CSC_SDSS_CSV(ra, dec, search_radius, cache_directory=cache_directory,
+		ttl_hours=ttl_hours, connection_pool=CSC_pool)
 	CSC_objID_list = parse_CSC_CSV(CSC_file_string, oFileNames)
-	SDSS_data_recarray = load_SDSS_data(CSC_objID_list, ra, dec, search_radius, oFileNames)
-	filtered_candidates_recarray = filter_CSS_candidates(SDSS_data_recarray, oFileNames)
+	SDSS_data_recarray = load_SDSS_data(CSC_objID_list, ra, dec, search_radius, oFileNames,
+		cache_directory=cache_directory, ttl_hours=ttl_hours, store_directory=store_directory,
+		connection_pool=SDSS_pool, filter_spec=filter_spec if push_down_filter else None)
+	filtered_candidates_recarray = filter_CSS_candidates(SDSS_data_recarray, oFileNames,
+		filter_spec=filter_spec)
 	generate_webpage_of_results(filtered_candidates_recarray, oFileNames)
+	if return_file_names:
+		return filtered_candidates_recarray, oFileNames
+	return filtered_candidates_recarray
+
+
+# Targets searched at once in batch mode.
+BATCH_WORKERS = 8
+
+# Requests in flight at once to each server in batch mode.
+BATCH_MAX_REQUESTS_IN_FLIGHT = 4
+
+
+# Reads a list of targets: one 'ra dec angle' (degrees, degrees, arcmin) per line,
+# separated by spaces or commas, optionally followed by a name. Blank lines and lines
+# starting with '#' are skipped. Returns a list of (name, ra, dec, angle).
+def read_targets(sTargetsFilename):
+	lTargets = []
+	with open(sTargetsFilename, 'r') as f:
+		for iLine, sLine in enumerate(f):
+			if not sLine.strip() or sLine.lstrip().startswith('#'):
+				continue
+			aTokens = sLine.replace(',', ' ').split()
+			try:
+				ra, dec, angle = [float(sToken) for sToken in aTokens[:3]]
+			except ValueError:
+				raise BaseException("Line {} of '{}' is not 'ra dec angle [name]':\n{}".format(iLine + 1,
+					sTargetsFilename, sLine))
+			sName = ' '.join(aTokens[3:]) or 'RA{}_DEC{}_Rad{}'.format(ra, dec, angle)
+			lTargets.append((sName, ra, dec, angle))
+	return lTargets
+
+
+# Returns the centre (ra, dec) and radius (arcmin) of a cone that contains all the given
+# cones: centred on their mean direction, just wide enough to reach around each.
+def get_enclosing_cone(lCones):
+	aRA, aDEC, aRadius = [np.array(tValues, dtype=np.float64) for tValues in zip(*lCones)]
+	xyz = sky_index.radec_to_unit_vectors(aRA, aDEC).mean(axis=0)
+	xyz /= np.sqrt((xyz ** 2).sum())
+	ra = np.degrees(np.arctan2(xyz[1], xyz[0])) % 360.
+	dec = np.degrees(np.arcsin(np.clip(xyz[2], -1., 1.)))
+	radius = (query_cache.get_separation_arcsec(aRA, aDEC, ra, dec) / 60. + aRadius).max()
+	return ra, dec, radius
+
+
+# Groups targets whose cones overlap so much that one cone around them all is no bigger
+# (in area) than their cones put together: each group is then searched once, and its
+# targets are answered from that search through the query cache. Returns a list of
+# (ra, dec, radius, [indices into lTargets]); radius is that of the group's only target
+# if it has just one.
+def merge_target_cones(lTargets):
+	lGroups = []
+	for index in sorted(range(len(lTargets)), key=lambda index: -lTargets[index][3]):
+		sName, ra, dec, angle = lTargets[index]
+		for tGroup in lGroups:
+			lCones = [lTargets[member][1:] for member in tGroup[3]] + [(ra, dec, angle)]
+			merged_ra, merged_dec, merged_radius = get_enclosing_cone(lCones)
+			if merged_radius ** 2 <= sum([cone[2] ** 2 for cone in lCones]):
+				tGroup[:] = [merged_ra, merged_dec, merged_radius, tGroup[3] + [index]]
+				break
+		else:
+			lGroups.append([ra, dec, angle, [index]])
+	return [tuple(tGroup) for tGroup in lGroups]
+
+
+# Searches one group of targets (see merge_target_cones): a merged cone is fetched first,
+# into the query cache, and then each target is searched. Returns a list of (index,
+# candidates recarray or None, oFileNames or None, error message or None).
+def search_target_group(tGroup, lTargets, oOptions):
+	group_ra, group_dec, group_radius, lMembers = tGroup
+	if len(lMembers) > 1:
+		try:
+			sMergedDirectory = os.path.join(oOptions['output_directory'], 'merged_cones')
+			sSearchID = 'RA{}_DEC{}_Rad{}'.format(group_ra, group_dec, group_radius)
+			oFileNames = {'CSC_data': os.path.join(sMergedDirectory, 'CSC_data_{}.csv'.format(sSearchID)),
+				'SDSS_data': os.path.join(sMergedDirectory, 'SDSS_data_{}.csv'.format(sSearchID))}
+			if not os.path.exists(sMergedDirectory):
+				os.makedirs(sMergedDirectory)
+			CSC_objID_list = parse_CSC_CSV(load_CSC_SDSS_CSV(group_ra, group_dec, group_radius,
+				cache_directory=oOptions['cache_directory'], ttl_hours=oOptions['ttl_hours'],
+				connection_pool=oOptions['CSC_pool']), oFileNames)
+			load_SDSS_data(CSC_objID_list, group_ra, group_dec, group_radius, oFileNames,
+				cache_directory=oOptions['cache_directory'], ttl_hours=oOptions['ttl_hours'],
+				store_directory=oOptions['store_directory'], connection_pool=oOptions['SDSS_pool'],
+				filter_spec=oOptions['filter_spec'] if oOptions['push_down_filter'] else None)
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except BaseException as e:
+			# The targets are searched one by one instead.
+			logging.warning('merged cone {} failed: {}'.format(sSearchID, e))
+
+	lResults = []
+	for index in lMembers:
+		sName, ra, dec, angle = lTargets[index]
+		try:
+			candidates_recarray, oFileNames = get_candidates(ra, dec, angle, return_file_names=True,
+				cache_directory=oOptions['cache_directory'], ttl_hours=oOptions['ttl_hours'],
+				store_directory=oOptions['store_directory'], output_directory=oOptions['output_directory'],
+				CSC_pool=oOptions['CSC_pool'], SDSS_pool=oOptions['SDSS_pool'],
+				filter_spec=oOptions['filter_spec'], push_down_filter=oOptions['push_down_filter'])
+			lResults.append((index, candidates_recarray, oFileNames, None))
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except BaseException as e:
+			lResults.append((index, None, None, str(e)))
+	return lResults
+
+
+# Writes the summary of a batch into output_directory: index.html, with a line (and a
+# link to the thumbnail page) per target, and all_candidates.csv, with every candidate
+# of every target. Returns the name of index.html.
+def write_batch_summary(lTargets, lResults, output_directory):
+	sIndexFilename = os.path.join(output_directory, 'index.html')
+	with open(sIndexFilename, 'w') as f:
+		f.write("<html><head></head><body>\n")
+		f.write("{} target(s), {} CSS candidate(s).<br>\n".format(len(lTargets),
+			sum([len(candidates) for (index, candidates, oFileNames, sError) in lResults if sError is None])))
+		f.write("<table border=1 cellspacing=2 cellpadding=2>\n")
+		f.write("<tr><th>target</th><th>ra</th><th>dec</th><th>angle</th><th>candidates</th></tr>\n")
+		for index, candidates, oFileNames, sError in lResults:
+			sName, ra, dec, angle = lTargets[index]
+			if sError is None:
+				sCandidates = "<a href='{}'>{}</a>".format(os.path.relpath(oFileNames['webpage'],
+					output_directory), len(candidates))
+			else:
+				sCandidates = 'failed: {}'.format(sError)
+			f.write("<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n".format(sName, ra,
+				dec, angle, sCandidates))
+		f.write("</table></body></html>")
+
+	with open(os.path.join(output_directory, 'all_candidates.csv'), 'w') as f:
+		f.write('target,' + ','.join(SDSS_PHOTOMETRY_COLUMNS) + '\n')
+		for index, candidates, oFileNames, sError in lResults:
+			if sError is None and len(candidates):
+				for sLine in format_SDSS_CSV(photometry_store.to_photometry_rows(candidates)).splitlines()[1:]:
+					f.write('{},{}\n'.format(lTargets[index][0], sLine))
+
+	print "Summary of {} target(s) created: {}".format(len(lTargets), sIndexFilename)
+	return sIndexFilename
+
+
+# Searches many targets (a list of (name, ra, dec, angle), see read_targets). Targets
+# whose cones overlap heavily are merged (see merge_target_cones); n_workers groups are
+# searched at once, with at most max_in_flight requests in flight to each server,
+# sharing keep-alive connections. A target that fails doesn't stop the others. Writes
+# a summary into output_directory (see write_batch_summary) and returns a list of
+# (index, candidates, oFileNames, error) per target. Merging needs the query cache;
+# without a cache_directory, each target is searched on its own. cache_directory,
+# store_directory, filter_spec and push_down_filter are as for get_candidates.
+def run_batch(lTargets, output_directory, n_workers=BATCH_WORKERS,
+		max_in_flight=BATCH_MAX_REQUESTS_IN_FLIGHT, cache_directory=None,
+		ttl_hours=query_cache.DEFAULT_TTL_HOURS, store_directory=None,
+		sCSC_URL=CSC_XMATCH_URL, sSDSS_URL=SDSS_SQL_URL, filter_spec=None, push_down_filter=False):
+	if not os.path.exists(output_directory):
+		os.makedirs(output_directory)
+	# One log for the whole batch (get_candidates' own logging.basicConfig is then ignored).
+	logging.basicConfig(filename=os.path.join(output_directory, 'log.txt'), level=logging.DEBUG,
+		filemode='w')
+
+	if cache_directory:
+		lGroups = merge_target_cones(lTargets)
+	else:
+		lGroups = [(ra, dec, angle, [index]) for (index, (sName, ra, dec, angle)) in enumerate(lTargets)]
+	print '{} target(s) in {} cone(s); searching {} at a time ...'.format(len(lTargets), len(lGroups),
+		n_workers)
+
+	oOptions = {'output_directory': output_directory, 'cache_directory': cache_directory,
+		'ttl_hours': ttl_hours, 'store_directory': store_directory,
+		'filter_spec': filter_spec or make_CSS_filter_spec(), 'push_down_filter': push_down_filter,
+		'CSC_pool': http_connection_pool(sCSC_URL, max_connections=max_in_flight),
+		'SDSS_pool': http_connection_pool(sSDSS_URL, max_connections=max_in_flight)}
+	start_time = time.time()
+	thread_pool = ThreadPool(processes=max(1, min(n_workers, len(lGroups))))
+	try:
+		lResults = sum(thread_pool.map(lambda tGroup: search_target_group(tGroup, lTargets, oOptions),
+			lGroups), [])
+		thread_pool.close()
+	finally:
+		thread_pool.terminate()
+		thread_pool.join()
+		oOptions['CSC_pool'].close()
+		oOptions['SDSS_pool'].close()
+	lResults.sort(key=lambda tResult: tResult[0])
+
+	write_batch_summary(lTargets, lResults, output_directory)
+	print 'Searched {} target(s) in {:.1f} s; {} failed.'.format(len(lTargets), time.time() - start_time,
+		len([tResult for tResult in lResults if tResult[3] is not None]))
+	return lResults
 	
 
 if __name__ == '__main__':
 
 	# Get commandline arguments.
 	parser = argparse.ArgumentParser(description='Calls both the Chandra and SDSS databases to look for CSS objects.')
-	parser.add_argument('ra', metavar='ra', type=str, 
+	parser.add_argument('ra', metavar='ra', type=str, nargs='?',
                    help='ra, as in "ra and dec"')
-	parser.add_argument('dec', metavar='dec', type=str,
+	parser.add_argument('dec', metavar='dec', type=str, nargs='?',
                    help='dec, as in "ra and dec"')
-	parser.add_argument('angle', metavar='angle', type=str,
+	parser.add_argument('angle', metavar='angle', type=str, nargs='?',
                    help='angle of search region (arcmin)')
+	parser.add_argument('--targets', type=str, default=None,
+                   help='file of targets to search instead, one "ra dec angle [name]" per line')
+	parser.add_argument('--output_directory', type=str, default='.',
+                   help='where to put the results of a --targets search')
+	parser.add_argument('--workers', type=int, default=BATCH_WORKERS,
+                   help='targets searched at once with --targets')
+	parser.add_argument('--max_in_flight', type=int, default=BATCH_MAX_REQUESTS_IN_FLIGHT,
+                   help='requests in flight at once to each server with --targets')
+	parser.add_argument('--cache', action='store_true',
+                   help='cache server responses in {}/ and SDSS photometry in {}/'.format(
+                   query_cache.DEFAULT_QUERY_CACHE_DIRECTORY, photometry_store.DEFAULT_PHOTOMETRY_STORE_DIRECTORY))
+	parser.add_argument('--cache_directory', type=str, default=None,
+                   help='cache server responses in this directory')
+	parser.add_argument('--store_directory', type=str, default=None,
+                   help='keep SDSS photometry of objects already fetched in this directory')
+	parser.add_argument('--ttl_hours', type=float, default=query_cache.DEFAULT_TTL_HOURS,
+                   help='age (hours) after which cached responses are fetched again')
+	parser.add_argument('--push_down_filter', action='store_true',
+                   help='have SDSS apply the candidate cuts, so rejected objects are never downloaded')
 	args = parser.parse_args()
+	if args.targets is None and args.angle is None:
+		parser.error('give either ra, dec and angle, or --targets')
+	if args.cache:
+		args.cache_directory = args.cache_directory or query_cache.DEFAULT_QUERY_CACHE_DIRECTORY
+		args.store_directory = args.store_directory or photometry_store.DEFAULT_PHOTOMETRY_STORE_DIRECTORY
 
 	# Call main function.
-	print "RA = {}, DEC = {}, Search Angle = {} (arcmin).".format(args.ra, args.dec, args.angle)
-	get_candidates(args.ra, args.dec, args.angle)
+	if args.targets is not None:
+		run_batch(read_targets(args.targets), args.output_directory, n_workers=args.workers,
+			max_in_flight=args.max_in_flight,
+			cache_directory=args.cache_directory, ttl_hours=args.ttl_hours,
+			store_directory=args.store_directory, push_down_filter=args.push_down_filter)
+	else:
+		print "RA = {}, DEC = {}, Search Angle = {} (arcmin).".format(args.ra, args.dec, args.angle)
+		get_candidates(args.ra, args.dec, args.angle,
+			cache_directory=args.cache_directory, ttl_hours=args.ttl_hours,
+			store_directory=args.store_directory, push_down_filter=args.push_down_filter)
@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# A local cache of the columns loaded from catalog files (FITS tables, CSVs), so that a
+# file that hasn't changed is parsed once rather than on every run.
+#
+# Each cache entry is the loaded recarray saved as one .npy file, plus a small .json
+# file saying what it was loaded from. Entries are keyed on the source file's path,
+# mtime and size, the list of columns, and any loader options, so editing the source
+# or asking for other columns is a cache miss. A hit is a memory map of the .npy
+# (copy-on-write), not a parse: columns are only read from disk as they're used.
+# When the cache grows past its size limit, the least recently used entries go first.
+
+DEFAULT_CACHE_DIRECTORY = 'column_cache'
+
+# Default size limit of a cache directory.
+DEFAULT_MAX_CACHE_MB = 4096
+
+
+# Returns the key of the entry holding column_names (None: all columns) of
+# source_filename as it is now. loader_options is anything else that changes what the
+# loader returns (e.g. which FITS extension it reads).
+def get_cache_key(source_filename, column_names, loader_options=None):
+	file_stat = os.stat(source_filename)
+	return hashlib.md5(json.dumps([os.path.abspath(source_filename), file_stat.st_mtime,
+		file_stat.st_size, column_names and list(column_names), loader_options])).hexdigest()
+
+
+def get_entry_filenames(cache_directory, cache_key):
+	return (os.path.join(cache_directory, '{}.npy'.format(cache_key)),
+		os.path.join(cache_directory, '{}.json'.format(cache_key)))
+
+
+# Returns [(cache_key, meta dict, time last used)] for every complete entry in the cache
+# directory.
+def list_cache_entries(cache_directory):
+	if not os.path.isdir(cache_directory):
+		return []
+	entries = []
+	for filename in os.listdir(cache_directory):
+		if not filename.endswith('.json'):
+			continue
+		meta_filename = os.path.join(cache_directory, filename)
+		try:
+			last_used = os.path.getmtime(meta_filename)
+			with open(meta_filename, 'r') as f:
+				entries.append((filename[:-len('.json')], json.load(f), last_used))
+		except (IOError, OSError):
+			# Removed since the listing.
+			pass
+	return entries
+
+
+# (Another process may be removing the same entry.)
+def remove_cache_entry(cache_directory, cache_key):
+	for filename in get_entry_filenames(cache_directory, cache_key):
+		try:
+			os.remove(filename)
+		except OSError:
+			pass
+
+
+# Returns the cached recarray of column_names of source_filename, memory-mapped, or None
+# if there is no up-to-date entry for it.
+def load_cached_columns(cache_directory, source_filename, column_names, loader_options=None):
+	array_filename, meta_filename = get_entry_filenames(cache_directory,
+		get_cache_key(source_filename, column_names, loader_options))
+	if not os.path.exists(meta_filename):
+		return None
+	# Mark the entry as recently used.
+	os.utime(meta_filename, None)
+	return np.load(array_filename, mmap_mode='c').view(np.recarray)
+
+
+# Saves a recarray as the entry for column_names of source_filename. Entries of older
+# versions of the same source file are dropped, and the cache is then trimmed to
+# max_cache_mb. Returns the memory-mapped copy (or recarray, if it didn't fit).
+def store_cached_columns(cache_directory, source_filename, column_names, recarray,
+		loader_options=None, max_cache_mb=DEFAULT_MAX_CACHE_MB):
+	if recarray.dtype.hasobject:
+		print 'column cache: not caching {} (it has object columns).'.format(source_filename)
+		return recarray
+	if not os.path.isdir(cache_directory):
+		os.makedirs(cache_directory)
+	invalidate_column_cache(cache_directory, source_filename, keep_current=True)
+
+	cache_key = get_cache_key(source_filename, column_names, loader_options)
+	array_filename, meta_filename = get_entry_filenames(cache_directory, cache_key)
+	# Write to temporary files and rename them into place, so that a half-written entry
+	# is never picked up.
+	file_descriptor, temp_filename = tempfile.mkstemp(dir=cache_directory, suffix='.tmp')
+	with os.fdopen(file_descriptor, 'wb') as f:
+		np.save(f, np.asarray(recarray))
+	os.rename(temp_filename, array_filename)
+	file_descriptor, temp_filename = tempfile.mkstemp(dir=cache_directory, suffix='.tmp')
+	with os.fdopen(file_descriptor, 'w') as f:
+		json.dump({'source_filename': os.path.abspath(source_filename),
+			'column_names': column_names and list(column_names),
+			'loader_options': loader_options, 'n_rows': len(recarray),
+			'n_bytes': os.path.getsize(array_filename)}, f)
+	os.rename(temp_filename, meta_filename)
+
+	evict_column_cache(cache_directory, max_cache_mb=max_cache_mb)
+	cached_recarray = load_cached_columns(cache_directory, source_filename, column_names,
+		loader_options)
+	# (The entry itself is evicted if it's bigger than the whole cache.)
+	return recarray if cached_recarray is None else cached_recarray
+
+
+# Returns column_names of source_filename from the cache if it has them; otherwise calls
+# load_function() (which must return the same recarray), caches the result and returns
+# it. With cache_directory=None, this is just load_function().
+def load_columns_with_cache(cache_directory, source_filename, column_names, load_function,
+		loader_options=None, max_cache_mb=DEFAULT_MAX_CACHE_MB):
+	if not cache_directory:
+		return load_function()
+	recarray = load_cached_columns(cache_directory, source_filename, column_names, loader_options)
+	if recarray is not None:
+		print 'column cache: loaded {} rows of {} from {}.'.format(len(recarray),
+			column_names or 'all columns', source_filename)
+		return recarray
+	return store_cached_columns(cache_directory, source_filename, column_names, load_function(),
+		loader_options=loader_options, max_cache_mb=max_cache_mb)
+
+
+# Drops least recently used entries until the cache is no bigger than max_cache_mb.
+def evict_column_cache(cache_directory, max_cache_mb=DEFAULT_MAX_CACHE_MB):
+	entries = sorted(list_cache_entries(cache_directory), key=lambda entry: entry[2])
+	n_bytes = sum([meta['n_bytes'] for (cache_key, meta, last_used) in entries])
+	for cache_key, meta, last_used in entries:
+		if n_bytes <= max_cache_mb * 1024 * 1024:
+			break
+		remove_cache_entry(cache_directory, cache_key)
+		n_bytes -= meta['n_bytes']
+		print 'column cache: evicted {} ({})'.format(meta['source_filename'], meta['column_names'])
+
+
+# Drops the entries for source_filename, or every entry if it's None. With
+# keep_current=True, only entries made from older versions of the file are dropped.
+def invalidate_column_cache(cache_directory, source_filename=None, keep_current=False):
+	for cache_key, meta, last_used in list_cache_entries(cache_directory):
+		if source_filename and meta['source_filename'] != os.path.abspath(source_filename):
+			continue
+		if keep_current and os.path.exists(meta['source_filename']) and cache_key == get_cache_key(
+				meta['source_filename'], meta['column_names'], meta['loader_options']):
+			continue
+		remove_cache_entry(cache_directory, cache_key)
+
+
+if __name__ == "__main__":
+	# Get commandline arguments.
+	parser = argparse.ArgumentParser(description='Inspects, trims or clears a column cache.')
+	parser.add_argument('--directory', '-d', type=str, default=DEFAULT_CACHE_DIRECTORY,
+                   help='cache directory')
+	parser.add_argument('--invalidate', type=str, nargs='?', const='', default=None,
+                   help='drop the entries of this source file (or, with no file, all entries)')
+	parser.add_argument('--max_mb', type=float, default=None,
+                   help='evict least recently used entries down to this size')
+	args = parser.parse_args()
+
+	if args.invalidate is not None:
+		invalidate_column_cache(args.directory, args.invalidate or None)
+	if args.max_mb is not None:
+		evict_column_cache(args.directory, max_cache_mb=args.max_mb)
+	for cache_key, meta, last_used in list_cache_entries(args.directory):
+		print '{}  {} rows  {:.1f} MB  {} {}'.format(cache_key, meta['n_rows'],
+			meta['n_bytes'] / 1024. / 1024., meta['source_filename'], meta['column_names'] or '')
@@ -0,0 +1,235 @@
+import io
+import json
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+# A compressed, column-oriented file format for catalogs, so that we don't have to
+# re-parse CSVs every time we load one.
+#
+# The file is a zip archive (readable by np.load, like a .npz) holding one .npy member
+# per (row group, column), named 'chunk_00000/RA.npy' etc., plus a 'meta.json' member
+# with the column names and dtypes and, for each row group, its row count and the
+# min/max of every numeric column. Readers use those stats to skip whole row groups
+# that fall outside the requested ranges, and only load the columns they are asked for.
+
+# Number of rows per row group.
+CHUNK_ROWS = 100000
+
+META_MEMBER_NAME = 'meta.json'
+
+
+def get_member_name(chunk_index, column_name):
+	return 'chunk_{:05d}/{}'.format(chunk_index, column_name)
+
+
+# Returns [min, max] of a column for the row-group stats, or None for string columns
+# (and columns that are all NaN).
+def get_column_stats(aColumn):
+	if aColumn.dtype.kind not in 'biuf' or len(aColumn) == 0:
+		return None
+	if aColumn.dtype.kind == 'f':
+		if np.all(np.isnan(aColumn)):
+			return None
+		return [np.nanmin(aColumn).item(), np.nanmax(aColumn).item()]
+	return [aColumn.min().item(), aColumn.max().item()]
+
+
+# Writes a columnar store incrementally: call append() with blocks of rows (a
+# recarray/structured array, or an OrderedDict of equal-length 1D arrays) and close()
+# at the end. Rows are buffered and written out chunk_rows at a time.
+#
+# The first block fixes each column's dtype, and later blocks are cast to it. A later
+# block that doesn't fit (longer strings, floats in an integer column) widens the
+# column's dtype from then on; row groups already written keep the narrower one, and
+# the readers cast them up to the final dtypes, which meta.json gets on close().
+class columnar_store_writer(object):
+	def __init__(self, output_filename, chunk_rows=CHUNK_ROWS):
+		self.output_filename = output_filename
+		self.chunk_rows = chunk_rows
+		self.column_names = None
+		self.column_dtypes = None
+		self.buffered_columns = None
+		self.n_buffered_rows = 0
+		self.chunks = []
+		self.zip_file = zipfile.ZipFile(output_filename, 'w', zipfile.ZIP_DEFLATED,
+			allowZip64=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def append(self, columns):
+		if not isinstance(columns, dict):
+			columns = OrderedDict((name, columns[name]) for name in columns.dtype.names)
+		if self.column_names is None:
+			self.column_names = list(columns.keys())
+			self.column_dtypes = OrderedDict((name, np.asarray(columns[name]).dtype)
+				for name in self.column_names)
+			self.buffered_columns = OrderedDict((name, []) for name in self.column_names)
+		elif list(columns.keys()) != self.column_names:
+			raise BaseException("Columns {} don't match the store's columns {}.".format(
+				list(columns.keys()), self.column_names))
+
+		for column_name in self.column_names:
+			aColumn = np.asarray(columns[column_name])
+			self.column_dtypes[column_name] = np.promote_types(self.column_dtypes[column_name],
+				aColumn.dtype)
+			self.buffered_columns[column_name].append(aColumn.astype(self.column_dtypes[column_name],
+				copy=False))
+		self.n_buffered_rows += len(columns[self.column_names[0]])
+
+		while self.n_buffered_rows >= self.chunk_rows:
+			self.flush(self.chunk_rows)
+
+	# Writes the first n_rows buffered rows as one row group.
+	def flush(self, n_rows):
+		chunk_index = len(self.chunks)
+		chunk_stats = OrderedDict()
+		for column_name in self.column_names:
+			aBuffered = np.concatenate(self.buffered_columns[column_name]).astype(
+				self.column_dtypes[column_name], copy=False)
+			aColumn = aBuffered[:n_rows]
+			self.buffered_columns[column_name] = [aBuffered[n_rows:]]
+
+			f_member = io.BytesIO()
+			np.lib.format.write_array(f_member, np.ascontiguousarray(aColumn))
+			self.zip_file.writestr('{}.npy'.format(get_member_name(chunk_index, column_name)),
+				f_member.getvalue())
+			chunk_stats[column_name] = get_column_stats(aColumn)
+
+		self.chunks.append({'n_rows': n_rows, 'stats': chunk_stats})
+		self.n_buffered_rows -= n_rows
+
+	def close(self):
+		if self.zip_file is None:
+			return
+		if self.n_buffered_rows:
+			self.flush(self.n_buffered_rows)
+		self.zip_file.writestr(META_MEMBER_NAME, json.dumps({
+			'column_names': self.column_names or [],
+			'dtypes': [dtype.str for dtype in (self.column_dtypes or {}).values()],
+			'chunks': self.chunks}))
+		self.zip_file.close()
+		self.zip_file = None
+		print 'columnar store written: {} ({} row groups).'.format(self.output_filename,
+			len(self.chunks))
+
+
+# Writes a whole recarray to a columnar store.
+def write_columnar_store(output_filename, recarray, chunk_rows=CHUNK_ROWS):
+	with columnar_store_writer(output_filename, chunk_rows=chunk_rows) as writer:
+		writer.append(recarray)
+
+
+def is_columnar_store(input_filename):
+	if not zipfile.is_zipfile(input_filename):
+		return False
+	with zipfile.ZipFile(input_filename, 'r') as f:
+		return META_MEMBER_NAME in f.namelist()
+
+
+def read_columnar_store_meta(input_filename):
+	with zipfile.ZipFile(input_filename, 'r') as f:
+		return json.loads(f.read(META_MEMBER_NAME))
+
+
+# Casts a row group's column up to the store's dtype for it. (Stores written before
+# the dtypes were fixed can have row groups wider than meta.json says; those are
+# widened rather than truncated.)
+def cast_to_store_dtype(aColumn, sDtype):
+	return aColumn.astype(np.promote_types(np.dtype(str(sDtype)), aColumn.dtype), copy=False)
+
+
+# Returns True if a row group's stats say it may hold rows inside every range.
+def chunk_may_match(chunk_stats, ranges):
+	for column_name, min_value, max_value in ranges:
+		column_stats = chunk_stats[column_name]
+		if column_stats is None:
+			continue
+		if min_value is not None and column_stats[1] < min_value:
+			return False
+		if max_value is not None and column_stats[0] > max_value:
+			return False
+	return True
+
+
+# Reads a columnar store into a recarray. column_names selects which columns to load
+# (default: all). ranges is a list of (column_name, min, max) tuples, as for the cuts
+# in convert_megacam_to_csv; min or max may be None. Row groups whose stats fall
+# outside any range are never read, and the remaining rows are filtered exactly.
+# With lowercase_names=True, column names are matched case-insensitively and come back
+# lowercased, the way np.recfromcsv names them.
+def read_columnar_store(input_filename, column_names=None, ranges=None, lowercase_names=False):
+	meta = read_columnar_store_meta(input_filename)
+	all_column_names = [str(name) for name in meta['column_names']]
+	if not column_names:
+		column_names = all_column_names
+	ranges = ranges or []
+	if lowercase_names:
+		name_dict = {name.lower(): name for name in all_column_names}
+		column_names = [name_dict.get(name.lower(), name) for name in column_names]
+		ranges = [(name_dict.get(r[0].lower(), r[0]),) + tuple(r[1:]) for r in ranges]
+	for column_name in list(column_names) + [r[0] for r in ranges]:
+		if not column_name in all_column_names:
+			raise BaseException("Column '{}' not found in '{}' from list:\n{}".format(
+				column_name, input_filename, sorted(all_column_names)))
+
+	lColumnsToLoad = list(column_names) + [r[0] for r in ranges if r[0] not in column_names]
+	columns = OrderedDict((column_name, []) for column_name in column_names)
+	n_skipped = 0
+	column_dtypes = dict(zip(all_column_names, meta['dtypes']))
+	npz = np.load(input_filename)
+	try:
+		for chunk_index, chunk in enumerate(meta['chunks']):
+			if not chunk_may_match(chunk['stats'], ranges):
+				n_skipped += 1
+				continue
+			chunk_columns = dict((column_name, cast_to_store_dtype(
+				npz[get_member_name(chunk_index, column_name)], column_dtypes[column_name]))
+				for column_name in lColumnsToLoad)
+			row_mask = np.ones(chunk['n_rows'], dtype=bool)
+			for column_name, min_value, max_value in ranges:
+				if min_value is not None:
+					row_mask &= chunk_columns[column_name] >= min_value
+				if max_value is not None:
+					row_mask &= chunk_columns[column_name] <= max_value
+			for column_name in column_names:
+				columns[column_name].append(chunk_columns[column_name][row_mask])
+	finally:
+		npz.close()
+
+	# If every row group was skipped, still hand back correctly-typed (empty) columns.
+	for column_name in column_names:
+		columns[column_name].append(np.empty(0, dtype=str(column_dtypes[column_name])))
+
+	arrays = [np.concatenate(columns[column_name]) for column_name in column_names]
+	output_names = [name.lower() if lowercase_names else name for name in column_names]
+	output_array = np.rec.fromarrays(arrays,
+		dtype=[(column_name, array.dtype) for (column_name, array) in zip(output_names, arrays)])
+	print 'loaded {} rows of {} from {} ({} of {} row groups skipped).'.format(
+		len(output_array), column_names, input_filename, n_skipped, len(meta['chunks']))
+	return output_array
+
+
+# Reads a columnar store one row group at a time, yielding a recarray of the requested
+# columns for each, so a store bigger than memory can be streamed.
+def iter_columnar_store_chunks(input_filename, column_names=None):
+	meta = read_columnar_store_meta(input_filename)
+	all_column_names = [str(name) for name in meta['column_names']]
+	if not column_names:
+		column_names = all_column_names
+	column_dtypes = dict(zip(all_column_names, meta['dtypes']))
+	npz = np.load(input_filename)
+	try:
+		for chunk_index in range(len(meta['chunks'])):
+			arrays = [cast_to_store_dtype(npz[get_member_name(chunk_index, column_name)],
+				column_dtypes[column_name]) for column_name in column_names]
+			yield np.rec.fromarrays(arrays,
+				dtype=[(name, array.dtype) for (name, array) in zip(column_names, arrays)])
+	finally:
+		npz.close()
@@ -0,0 +1,170 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+# A catalog held in as little memory as it safely can. Loaders hand back whatever types
+# parsing picked (float64 everywhere, strings as wide as the widest value, int64 flags),
+# and the columns are often held more than once along the way. A compact_catalog copies
+# a recarray into a single buffer, one column after another, narrowing each column:
+#
+#	floats:   to float32 if no value changes (e.g. float32 FITS columns that got
+#	          upcast), or if the column is listed in float32_columns (e.g. magnitudes);
+#	integers: to the narrowest integer type that holds every value, except IDs (by
+#	          default, columns whose name ends in 'id'), which stay int64 so they can
+#	          be joined on across catalogs;
+#	strings:  to integer codes into a table of categories if there are few distinct
+#	          values, otherwise to the width of the longest value.
+#
+# Positions (ra/dec) stay float64 unless asked for: float32 is only good to ~0.1 arcsec.
+
+# Column offsets within the buffer are aligned to this many bytes.
+COLUMN_ALIGNMENT = 8
+
+# A string column is stored as categories if at most this fraction of its values differ.
+MAX_CATEGORY_FRACTION = 0.5
+
+
+def is_id_column(column_name):
+	return column_name.lower().endswith('id')
+
+
+# Returns the narrowest integer type that holds every value of an integer column.
+def get_narrow_int_type(aColumn):
+	if len(aColumn) == 0:
+		return aColumn.dtype.newbyteorder('=')
+	lo, hi = aColumn.min(), aColumn.max()
+	int_types = (np.uint8, np.uint16, np.uint32, np.uint64) if aColumn.dtype.kind == 'u' else (
+		np.int8, np.int16, np.int32, np.int64)
+	for int_type in int_types:
+		if np.iinfo(int_type).min <= lo and hi <= np.iinfo(int_type).max:
+			return np.dtype(int_type)
+	return aColumn.dtype.newbyteorder('=')
+
+
+# Works out how a column is stored. Returns (stored dtype, categories or None).
+def plan_column(column_name, aColumn, float32_columns, id_columns):
+	kind = aColumn.dtype.kind
+	if kind == 'O':
+		raise BaseException("Column '{}' holds Python objects, which can't be compacted.".format(
+			column_name))
+	if kind == 'f':
+		if column_name in float32_columns:
+			return np.dtype(np.float32), None
+		if aColumn.dtype.itemsize > 4:
+			with np.errstate(over='ignore'):
+				aNarrow = aColumn.astype(np.float32)
+			if ((aNarrow == aColumn) | np.isnan(aColumn)).all():
+				return np.dtype(np.float32), None
+		return aColumn.dtype.newbyteorder('='), None
+	if kind in 'iu':
+		if column_name in id_columns:
+			return np.dtype(np.uint64 if kind == 'u' else np.int64), None
+		return get_narrow_int_type(aColumn), None
+	if kind in 'SU' and aColumn.ndim == 1:
+		categories = np.unique(aColumn)
+		if len(categories) <= MAX_CATEGORY_FRACTION * len(aColumn):
+			return get_narrow_int_type(np.array([0, len(categories) - 1])), categories
+		n_chars = np.char.str_len(aColumn).max() if len(aColumn) else 1
+		return np.dtype('{}{}'.format(kind, max(n_chars, 1))), None
+	return aColumn.dtype.newbyteorder('='), None
+
+
+class compact_catalog(object):
+	# recarray is any structured array. float32_columns are narrowed to float32 even if
+	# that rounds them; id_columns (default: names ending in 'id') are kept int64. With
+	# memory_budget_mb, raises if the compacted catalog still doesn't fit in it.
+	def __init__(self, recarray, float32_columns=(), id_columns=None, memory_budget_mb=None):
+		self.column_names = list(recarray.dtype.names)
+		self.n_rows = len(recarray)
+		if id_columns is None:
+			id_columns = [name for name in self.column_names if is_id_column(name)]
+
+		# Plan every column, then lay them out one after another in one buffer.
+		self.source_nbytes = OrderedDict()
+		self.categories = {}
+		column_dtypes = OrderedDict()
+		column_offsets = {}
+		n_bytes = 0
+		for column_name in self.column_names:
+			aColumn = recarray[column_name]
+			self.source_nbytes[column_name] = aColumn.nbytes
+			column_dtype, categories = plan_column(column_name, aColumn, float32_columns, id_columns)
+			column_dtypes[column_name] = np.dtype((column_dtype, aColumn.shape[1:]))
+			if categories is not None:
+				self.categories[column_name] = categories
+			column_offsets[column_name] = n_bytes
+			n_bytes += -(-self.n_rows * column_dtypes[column_name].itemsize // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+		self.buffer = np.empty(n_bytes, dtype=np.uint8)
+		self.columns = OrderedDict()
+		for column_name, column_dtype in column_dtypes.items():
+			offset = column_offsets[column_name]
+			aStored = self.buffer[offset:offset + self.n_rows * column_dtype.itemsize].view(
+				column_dtype.base).reshape((self.n_rows,) + column_dtype.shape)
+			if column_name in self.categories:
+				aStored[:] = np.searchsorted(self.categories[column_name], recarray[column_name])
+			else:
+				aStored[:] = recarray[column_name]
+			self.columns[column_name] = aStored
+
+		if memory_budget_mb is not None and self.get_nbytes() > memory_budget_mb * 1024 * 1024:
+			self.print_memory_report()
+			raise BaseException('Catalog needs {:.1f} MB, more than its budget of {} MB.'.format(
+				self.get_nbytes() / 1024. / 1024., memory_budget_mb))
+
+	def __len__(self):
+		return self.n_rows
+
+	# A column name returns that column's values; anything else (a slice, row numbers,
+	# a boolean mask) returns those rows as a recarray, like indexing a recarray would.
+	def __getitem__(self, key):
+		if isinstance(key, basestring):
+			return self.get_column(key)
+		return self.to_recarray(rows=key)
+
+	def get_column(self, column_name):
+		if not column_name in self.columns:
+			raise BaseException("Column '{}' not found in catalog from list:\n{}".format(
+				column_name, sorted(self.column_names)))
+		if column_name in self.categories:
+			return self.categories[column_name][self.columns[column_name]]
+		return self.columns[column_name]
+
+	# Returns the stored integer codes of a categorical column, and its categories.
+	def get_codes(self, column_name):
+		return self.columns[column_name], self.categories[column_name]
+
+	# Copies column_names (default: all) of the given rows (default: all) out into a
+	# recarray, decoding categorical columns.
+	def to_recarray(self, column_names=None, rows=None):
+		column_names = column_names or self.column_names
+		if rows is None:
+			rows = slice(None)
+		arrays = []
+		for column_name in column_names:
+			aStored = self.columns[column_name][rows]
+			if column_name in self.categories:
+				aStored = self.categories[column_name][aStored]
+			arrays.append(aStored)
+		return np.rec.fromarrays(arrays, dtype=[(column_name, array.dtype, array.shape[1:])
+			for (column_name, array) in zip(column_names, arrays)])
+
+	# Returns {column name: bytes it takes up}, counting the categories of categorical
+	# columns.
+	def get_memory_footprint(self):
+		return OrderedDict((column_name, self.columns[column_name].nbytes + (
+			self.categories[column_name].nbytes if column_name in self.categories else 0))
+			for column_name in self.column_names)
+
+	def get_nbytes(self):
+		return self.buffer.nbytes + sum([categories.nbytes for categories in self.categories.values()])
+
+	def print_memory_report(self):
+		print 'catalog of {} rows:'.format(self.n_rows)
+		for column_name, n_bytes in self.get_memory_footprint().items():
+			print '\t{:<30} {:>10} {:>9.2f} MB (was {:.2f} MB)'.format(column_name,
+				'category' if column_name in self.categories else str(self.columns[column_name].dtype),
+				n_bytes / 1024. / 1024., self.source_nbytes[column_name] / 1024. / 1024.)
+		print '\ttotal: {:.2f} MB (was {:.2f} MB)'.format(self.get_nbytes() / 1024. / 1024.,
+			sum(self.source_nbytes.values()) / 1024. / 1024.)
@@ -0,0 +1,34 @@
+import bz2
+import gzip
+import io
+import os
+
+
+# File name endings of the compressed formats open_catalog_file reads.
+COMPRESSION_SUFFIXES = ('.gz', '.bz2')
+
+
+# Opens a catalog file (NGVS .cat, Galaxy Zoo .csv, ...) for reading line by line. If
+# the file is gzip- or bzip2-compressed (judged from its first bytes, not its name) it
+# is decompressed on the fly as it's read, so nothing gets inflated to disk and memory
+# use depends on how much the caller reads at a time, not on the file size.
+def open_catalog_file(filename):
+	with open(filename, 'rb') as f:
+		sMagic = f.read(3)
+	if sMagic[:2] == '\x1f\x8b':
+		# GzipFile's own readline is slow; a BufferedReader on top of it is not.
+		return io.BufferedReader(gzip.open(filename, 'rb'))
+	if sMagic == 'BZh':
+		return bz2.BZ2File(filename, 'r')
+	return open(filename, 'r')
+
+
+# Returns a catalog file's base name without its compression suffix, e.g.
+# 'NGVS-0+0.G.cat' for '/data/NGVS-0+0.G.cat.bz2', so a tile is named the same whether
+# or not it was compressed.
+def get_catalog_name(filename):
+	sName = os.path.basename(filename)
+	for sSuffix in COMPRESSION_SUFFIXES:
+		if sName.endswith(sSuffix):
+			return sName[:-len(sSuffix)]
+	return sName
@@ -1,87 +1,490 @@
 import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import columnar_store
+import deduplicate_tiles
+from compressed_files import get_catalog_name, open_catalog_file
 
 
 # This program takes NGVS .cat files (fixed-width tablular data with a bunch of
 # header lines we don't care about) and turns them into a single comma-delimited
 # CSV file.
 
-# Takes a list of names of NGVS files in CWD and writes content to 1 big csv file.
-def make_csv_file_from_file_list(sOutputFileName, lFileList):
+# Number of data rows the bulk parser reads from a .cat file at a time.
+CHUNK_ROWS = 100000
 
-	# helper function to convert fixed-width line to csv line.
-	def convert_fw_line_to_csv(sLine):
-		spaces_regex = re.compile('[\s]+')
-		# replace each occurrence of a space with a comma.
-		sNewCSVLine = spaces_regex.subn(',', sLine.strip())[0]
-		return sNewCSVLine
+spaces_regex = re.compile('[\s]+')
 
-	# Get the column definitions once, from the first NGVS file.
-	# Each NGVS file has an identical copy of these column defs.
-	with open(lFileList[0]) as f_in:
+# helper function to convert fixed-width line to csv line. The bulk parser below
+# (iter_cat_token_chunks) produces the same output and is what the converter uses.
+def convert_fw_line_to_csv(sLine):
+	# replace each occurrence of a space with a comma.
+	sNewCSVLine = spaces_regex.subn(',', sLine.strip())[0]
+	return sNewCSVLine
 
-		# collect column definitions.
+
+# Reads the '#' header lines of an NGVS .cat file and returns the list of column names.
+def read_cat_column_names(sFile):
+	with open_catalog_file(sFile) as f_in:
 		sCurrentLine = f_in.readline()
 		oColumnNameRegex = re.compile('#[" "]+([^" "]+)[" "]+([^" "]+)[" "]*')
 		lColumnNames = []
 		while sCurrentLine[0] == '#':
 			lColumnNames.append(oColumnNameRegex.search(sCurrentLine).group(2))
 			sCurrentLine = f_in.readline()
+	return lColumnNames
 
-		# add our own, single column.
-		lColumnNames.append('source_file')
 
-		sHeaderCSVline = '{}\n'.format(','.join(lColumnNames))
+# Bulk parser for the data block of an NGVS .cat file. Skips the '#' header lines,
+# then reads iChunkRows rows at a time and splits the whole chunk in one go.
+# Yields 2D arrays of the raw string tokens, shape (rows in chunk, nColumns).
+# gzip/bzip2-compressed files are decompressed as a stream, one chunk at a time.
+def iter_cat_token_chunks(sFile, nColumns, iChunkRows=CHUNK_ROWS):
+	with open_catalog_file(sFile) as f_in:
+		data_lines = itertools.dropwhile(lambda sLine: sLine[0] == '#', f_in)
+		while True:
+			lChunk = list(itertools.islice(data_lines, iChunkRows))
+			if not lChunk:
+				break
+			aTokens = np.array(''.join(lChunk).split())
+			if aTokens.size == 0:
+				continue
+			if aTokens.size % nColumns != 0:
+				raise BaseException("File '{}' has rows that don't have {} columns.".format(
+					sFile, nColumns))
+			yield aTokens.reshape(-1, nColumns)
+
+
+# Turns a 2D token array from iter_cat_token_chunks into typed columns. Each column
+# becomes int64 if all its values parse as integers, else float64, else stays a string.
+# column_dtypes ({column name: dtype}) are the types earlier chunks of the same file
+# got: a column never goes back to a narrower type than those (a float column stays
+# float even if a chunk happens to hold only whole numbers, strings keep their width).
+def convert_tokens_to_columns(aTokens, lColumnNames, column_dtypes=None):
+	columns = OrderedDict()
+	for index, column_name in enumerate(lColumnNames):
+		aColumn = aTokens[:, index]
+		previous_dtype = column_dtypes.get(column_name) if column_dtypes else None
+		for column_type in (np.int64, np.float64):
+			if previous_dtype is not None and np.promote_types(previous_dtype, column_type) != column_type:
+				continue
+			try:
+				columns[column_name] = aColumn.astype(column_type)
+				break
+			except ValueError:
+				pass
+		else:
+			if previous_dtype is not None:
+				aColumn = aColumn.astype(np.promote_types(previous_dtype, aColumn.dtype))
+			columns[column_name] = aColumn
+	return columns
+
+
+# Reads an NGVS .cat file into typed NumPy columns, one OrderedDict per chunk of rows.
+def iter_cat_column_chunks(sFile, lColumnNames, iChunkRows=CHUNK_ROWS):
+	column_dtypes = None
+	for aTokens in iter_cat_token_chunks(sFile, len(lColumnNames), iChunkRows):
+		columns = convert_tokens_to_columns(aTokens, lColumnNames, column_dtypes)
+		column_dtypes = dict((name, aColumn.dtype) for (name, aColumn) in columns.items())
+		yield columns
+
+
+# Turns the column list and cuts asked for by the user into positions within the .cat
+# columns. cuts is a list of (column_name, min, max) tuples; min or max may be None for
+# an open-ended range. Returns (column indices or None for all columns, cut tuples with
+# the column name replaced by its index).
+def get_selection_indices(lColumnNames, column_names=None, cuts=None):
+	header_dict = {name: index for (index, name) in enumerate(lColumnNames)}
+	for column_name in list(column_names or []) + [cut[0] for cut in cuts or []]:
+		if not column_name in header_dict:
+			raise BaseException("Column '{}' not found in .cat header from list:\n{}".format(
+				column_name, sorted(lColumnNames)))
+
+	lColumnIndices = None
+	if column_names:
+		lColumnIndices = [header_dict[column_name] for column_name in column_names]
+	lCutIndices = [(header_dict[column_name], min_value, max_value)
+		for (column_name, min_value, max_value) in cuts or []]
+	return lColumnIndices, lCutIndices
 
-	# open the single output file (the CSV).
-	with open(sOutputFileName, 'w') as f_out:
-		# write the header line.
-		f_out.write('{}\n'.format(sHeaderCSVline.strip()))
 
+# Drops the rows of a 2D token array that fall outside any of the cuts (inclusive
+# ranges), then keeps only the selected columns.
+def select_rows_and_columns(aTokens, lColumnIndices=None, lCutIndices=None):
+	if lCutIndices:
+		row_mask = np.ones(len(aTokens), dtype=bool)
+		for index, min_value, max_value in lCutIndices:
+			try:
+				aValues = aTokens[:, index].astype(np.float64)
+			except ValueError:
+				raise BaseException("Column {} of the .cat file is cut on but isn't numeric.".format(
+					index + 1))
+			if min_value is not None:
+				row_mask &= aValues >= min_value
+			if max_value is not None:
+				row_mask &= aValues <= max_value
+		aTokens = aTokens[row_mask]
+	if lColumnIndices is not None:
+		aTokens = aTokens[:, lColumnIndices]
+	return aTokens
 
+
+# Copies the data rows of a single NGVS .cat file to the already-open f_out as CSV lines,
+# keeping only the selected columns and the rows that pass the cuts (see
+# get_selection_indices). Returns the number of rows written.
+def write_cat_rows_as_csv(f_out, sFile, nColumns, lColumnIndices=None, lCutIndices=None):
+	print '> Reading from {}'.format(sFile)
+	start_time = time.time()
+
+	# Also, notice here that the final column value is the name of current input
+	# file (without any .gz/.bz2). This matches up with 'source_file' column, added below.
+	sRowEnding = ',{}\n'.format(get_catalog_name(sFile))
+	nRowsRead = 0
+	nRows = 0
+	for aTokens in iter_cat_token_chunks(sFile, nColumns):
+		nRowsRead += len(aTokens)
+		aTokens = select_rows_and_columns(aTokens, lColumnIndices, lCutIndices)
+		if len(aTokens) == 0:
+			continue
+		f_out.write(sRowEnding.join([','.join(lRow) for lRow in aTokens.tolist()]))
+		f_out.write(sRowEnding)
+		nRows += len(aTokens)
+
+	elapsed_time = time.time() - start_time
+	print '\t{} of {} rows kept in {:.2f} s ({:.0f} rows/s).'.format(nRows, nRowsRead,
+		elapsed_time, nRowsRead / max(elapsed_time, 1e-9))
+	return nRows
+
+
+# Worker for the parallel mode: converts one .cat file into its own CSV shard
+# (data rows only, no header line). Takes a single tuple so it can go through Pool.imap.
+def convert_cat_file_to_shard(tShardJob):
+	sFile, sShardFileName, nColumns, lColumnIndices, lCutIndices = tShardJob
+	with open(sShardFileName, 'w') as f_out:
+		write_cat_rows_as_csv(f_out, sFile, nColumns, lColumnIndices, lCutIndices)
+	return sShardFileName
+
+
+# Appends the CSV rows of every file in lFileList to the already-open f_out, in order.
+# With n_workers > 1, each file is parsed by a worker process into its own shard and
+# the shards are stitched into f_out in the original file order.
+def append_cat_files_as_csv(f_out, lFileList, nColumns, lColumnIndices=None, lCutIndices=None,
+		n_workers=1):
+	if n_workers > 1:
+		# Shards go in a scratch directory next to the output, so the stitching
+		# below doesn't cross filesystems.
+		sShardDirectory = tempfile.mkdtemp(prefix='cat_shards_',
+			dir=os.path.dirname(os.path.abspath(f_out.name)))
+		lShardJobs = [(sFile, os.path.join(sShardDirectory, '{}.csv'.format(index)),
+			nColumns, lColumnIndices, lCutIndices) for index, sFile in enumerate(lFileList)]
+		pool = multiprocessing.Pool(processes=n_workers)
+		try:
+			# imap hands back shards in input order, so each one can be appended as
+			# soon as it (and everything before it) is finished.
+			for sShardFileName in pool.imap(convert_cat_file_to_shard, lShardJobs):
+				with open(sShardFileName, 'r') as f_shard:
+					shutil.copyfileobj(f_shard, f_out)
+				os.remove(sShardFileName)
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+			shutil.rmtree(sShardDirectory, ignore_errors=True)
+	else:
 		# read through all .cat files, copying their data.
 		for sFile in lFileList:
-			print '> Reading from {}'.format(sFile)
-
-			short_filename = os.path.basename(sFile)
-			with open(sFile, 'r') as f_in:
-				sCurrentLine = f_in.readline()
-
-				# skip header rows.
-				while sCurrentLine[0] == '#':
-					sCurrentLine = f_in.readline()
-				
-				# run through rest of rows, copy each to output file.
-				while not sCurrentLine == '':
-					# Also, notice here that the final column value is the name of current input
-					# file. This matches up with 'source_file' column, added above.
-					f_out.write('{},{}\n'.format(convert_fw_line_to_csv(sCurrentLine), short_filename))
-					sCurrentLine = f_in.readline()
+			write_cat_rows_as_csv(f_out, sFile, nColumns, lColumnIndices, lCutIndices)
+
+
+# Works out the output CSV header line from the column definitions of an NGVS file
+# (each NGVS file has an identical copy of them), along with the selection indices
+# from get_selection_indices. Returns (header line, nColumns, lColumnIndices, lCutIndices).
+# Cut columns are checked against the file's first data row before anything is parsed:
+# a cut on a column that doesn't hold numbers raises a BaseException naming it.
+def get_csv_header_and_selection(sFile, column_names=None, cuts=None):
+	lColumnNames = read_cat_column_names(sFile)
+	nColumns = len(lColumnNames)
+	lColumnIndices, lCutIndices = get_selection_indices(lColumnNames, column_names, cuts)
+	if lCutIndices:
+		aFirstRow = next(iter_cat_token_chunks(sFile, nColumns, iChunkRows=1), None)
+		if aFirstRow is not None:
+			for index, min_value, max_value in lCutIndices:
+				try:
+					float(aFirstRow[0, index])
+				except ValueError:
+					raise BaseException("Can't cut on column '{}' of '{}': its values aren't numbers "
+						"(e.g. '{}').".format(lColumnNames[index], sFile, aFirstRow[0, index]))
+	if lColumnIndices is not None:
+		lColumnNames = [lColumnNames[index] for index in lColumnIndices]
+
+	# add our own, single column.
+	lColumnNames.append('source_file')
+
+	sHeaderCSVline = '{}\n'.format(','.join(lColumnNames))
+	return sHeaderCSVline, nColumns, lColumnIndices, lCutIndices
+
+
+# Takes a list of names of NGVS files in CWD and writes content to 1 big csv file.
+# column_names limits the output to those .cat columns (plus 'source_file'); cuts is a
+# list of (column_name, min, max) ranges a row must fall within to be written.
+# See append_cat_files_as_csv for n_workers.
+def make_csv_file_from_file_list(sOutputFileName, lFileList, n_workers=1,
+		column_names=None, cuts=None):
+
+	# Get the column definitions once, from the first NGVS file.
+	sHeaderCSVline, nColumns, lColumnIndices, lCutIndices = get_csv_header_and_selection(
+		lFileList[0], column_names, cuts)
+
+	# open the single output file (the CSV).
+	with open(sOutputFileName, 'w') as f_out:
+		# write the header line.
+		f_out.write(sHeaderCSVline)
+		append_cat_files_as_csv(f_out, lFileList, nColumns, lColumnIndices, lCutIndices,
+			n_workers=n_workers)
 
 	print '> Created "{}"'.format(sOutputFileName)	
 
 
+# Reads one .cat file into typed columns, keeping only the selected columns and the rows
+# that pass the cuts, plus the 'source_file' column. Yields one OrderedDict per chunk.
+def iter_selected_cat_column_chunks(sFile, lOutputColumnNames, nColumns, lColumnIndices=None,
+		lCutIndices=None):
+	print '> Reading from {}'.format(sFile)
+	short_filename = get_catalog_name(sFile)
+	column_dtypes = None
+	for aTokens in iter_cat_token_chunks(sFile, nColumns):
+		aTokens = select_rows_and_columns(aTokens, lColumnIndices, lCutIndices)
+		if len(aTokens) == 0:
+			continue
+		columns = convert_tokens_to_columns(aTokens, lOutputColumnNames[:-1], column_dtypes)
+		column_dtypes = dict((name, aColumn.dtype) for (name, aColumn) in columns.items())
+		columns['source_file'] = np.repeat(np.array([short_filename]), len(aTokens))
+		yield columns
+
+
+# Worker for the parallel columnar mode: returns all the selected columns of one .cat
+# file as a single OrderedDict (None if no rows passed the cuts).
+def read_selected_cat_columns(tColumnJob):
+	lChunks = list(iter_selected_cat_column_chunks(*tColumnJob))
+	if not lChunks:
+		return None
+	return OrderedDict((column_name, np.concatenate([chunk[column_name] for chunk in lChunks]))
+		for column_name in lChunks[0])
+
+
+# Same as make_csv_file_from_file_list, but writes a compressed columnar store (see
+# columnar_store.py) with typed columns and per-row-group min/max stats instead of a CSV.
+def make_columnar_store_from_file_list(sOutputFileName, lFileList, n_workers=1,
+		column_names=None, cuts=None):
+
+	sHeaderCSVline, nColumns, lColumnIndices, lCutIndices = get_csv_header_and_selection(
+		lFileList[0], column_names, cuts)
+	lOutputColumnNames = sHeaderCSVline.strip().split(',')
+
+	with columnar_store.columnar_store_writer(sOutputFileName) as writer:
+		if n_workers > 1:
+			lColumnJobs = [(sFile, lOutputColumnNames, nColumns, lColumnIndices, lCutIndices)
+				for sFile in lFileList]
+			pool = multiprocessing.Pool(processes=n_workers)
+			try:
+				# imap hands back each file's columns in input order.
+				for columns in pool.imap(read_selected_cat_columns, lColumnJobs):
+					if columns is not None:
+						writer.append(columns)
+				pool.close()
+			finally:
+				pool.terminate()
+				pool.join()
+		else:
+			for sFile in lFileList:
+				for columns in iter_selected_cat_column_chunks(sFile, lOutputColumnNames, nColumns,
+						lColumnIndices, lCutIndices):
+					writer.append(columns)
+
+	print '> Created "{}"'.format(sOutputFileName)
+
+
+# Returns the md5 hex digest of a file's contents.
+def get_file_hash(sFile, iBlockSize=1 << 20):
+	oHash = hashlib.md5()
+	with open(sFile, 'rb') as f_in:
+		for sBlock in iter(lambda: f_in.read(iBlockSize), ''):
+			oHash.update(sBlock)
+	return oHash.hexdigest()
+
+
+# The manifest of an incrementally-built CSV lives next to it.
+def get_manifest_filename(sOutputFileName):
+	return '{}.manifest.json'.format(sOutputFileName)
+
+
+# Like make_csv_file_from_file_list, but only re-parses the .cat files that are new or
+# changed since the last run. A JSON manifest next to the output records each source
+# file's size, mtime and md5; rows of changed or removed files are spliced out of the
+# existing CSV and the rows of new or changed files are appended to it. A different
+# header, column list or cuts than last time means a full rebuild. Files are keyed by
+# their name without any compression suffix, as in the 'source_file' column.
+def update_csv_file_from_file_list(sOutputFileName, lFileList, n_workers=1,
+		column_names=None, cuts=None):
+
+	sManifestFileName = get_manifest_filename(sOutputFileName)
+	sHeaderCSVline, nColumns, lColumnIndices, lCutIndices = get_csv_header_and_selection(
+		lFileList[0], column_names, cuts)
+	# Round-trip through json so this compares equal to what was loaded from disk.
+	settings = json.loads(json.dumps({'header': sHeaderCSVline,
+		'column_names': column_names, 'cuts': cuts}))
+
+	old_manifest = None
+	if os.path.exists(sOutputFileName) and os.path.exists(sManifestFileName):
+		with open(sManifestFileName, 'r') as f:
+			old_manifest = json.load(f)
+		if old_manifest['settings'] != settings:
+			print '> Header, columns or cuts changed since last run; rebuilding.'
+			old_manifest = None
+	old_files = old_manifest['files'] if old_manifest else {}
+
+	# Compare each file against the manifest. Size and mtime are checked first; the hash
+	# is only computed when those differ, so a run with nothing changed stays cheap.
+	files = {}
+	lFilesToParse = []
+	for sFile in lFileList:
+		short_filename = get_catalog_name(sFile)
+		if short_filename in files:
+			raise BaseException("'{}' is in the file list both compressed and not.".format(
+				short_filename))
+		oStat = os.stat(sFile)
+		file_entry = {'size': oStat.st_size, 'mtime': oStat.st_mtime}
+		old_entry = old_files.get(short_filename)
+		if old_entry and old_entry['size'] == file_entry['size'] and (
+				old_entry['mtime'] == file_entry['mtime']):
+			file_entry['md5'] = old_entry['md5']
+		else:
+			file_entry['md5'] = get_file_hash(sFile)
+			if not old_entry or old_entry['md5'] != file_entry['md5']:
+				lFilesToParse.append(sFile)
+		files[short_filename] = file_entry
+	set_removed_files = set(old_files) - set(files)
+	# Rows of every file about to be parsed are spliced out too, not just those of changed
+	# files: a run interrupted after appending a new file's rows leaves them in the CSV
+	# but not in the manifest, and they'd otherwise be appended a second time.
+	set_stale_files = set_removed_files | set(get_catalog_name(sFile) for sFile in lFilesToParse)
+
+	if old_manifest is None:
+		make_csv_file_from_file_list(sOutputFileName, lFileList, n_workers=n_workers,
+			column_names=column_names, cuts=cuts)
+	elif not lFilesToParse and not set_removed_files:
+		print '> "{}" is up to date.'.format(sOutputFileName)
+	else:
+		print '> {} new or changed, {} removed .cat files.'.format(len(lFilesToParse),
+			len(set_removed_files))
+		if set_stale_files:
+			# Copy the existing output minus the rows of stale files ('source_file' is the
+			# last column), then swap it in. (With only new files this finds nothing to
+			# drop unless a previous run was interrupted.)
+			sTempFileName = '{}.tmp'.format(sOutputFileName)
+			with open(sOutputFileName, 'r') as f_in:
+				with open(sTempFileName, 'w') as f_out:
+					f_out.write(f_in.readline())
+					for sLine in f_in:
+						if not sLine.rstrip('\n').rsplit(',', 1)[-1] in set_stale_files:
+							f_out.write(sLine)
+			os.rename(sTempFileName, sOutputFileName)
+		with open(sOutputFileName, 'a') as f_out:
+			append_cat_files_as_csv(f_out, lFilesToParse, nColumns, lColumnIndices, lCutIndices,
+				n_workers=n_workers)
+		print '> Updated "{}"'.format(sOutputFileName)
+
+	# Write the new manifest via a temp file so an interrupted run can't leave a manifest
+	# that claims rows which were never written.
+	sTempManifestFileName = '{}.tmp'.format(sManifestFileName)
+	with open(sTempManifestFileName, 'w') as f:
+		json.dump({'settings': settings, 'files': files}, f, indent=1, sort_keys=True)
+	os.rename(sTempManifestFileName, sManifestFileName)
+
+
 
 # Within the specified 'source_directory', finds all files with '.cat' in their
-# name and combines their data into one big CSV file.
-def convert_all_cats_in_dir(output_filename, source_directory=None):
+# name and combines their data into one big CSV file. Compressed files such as
+# 'NGVS-1+0.G.cat.gz' or '.cat.bz2' are read directly; with n_workers > 1 several of
+# them are decompressed at once, one per worker.
+# column_names and cuts are passed on to make_csv_file_from_file_list. With
+# incremental=True, only new or changed files are parsed (see update_csv_file_from_file_list).
+# output_format='columnar' writes a columnar store instead of a CSV (not incremental).
+# If dedup_radius_arcsec is given, a copy of the CSV named '<output>_dedup.csv' is also
+# written, without the sources repeated on overlapping tiles (see deduplicate_tiles.py).
+def convert_all_cats_in_dir(output_filename, source_directory=None, n_workers=1,
+		column_names=None, cuts=None, incremental=False, output_format='csv',
+		dedup_radius_arcsec=None, dedup_keep='snr'):
 	if not source_directory:
 		source_directory = os.getcwd()
 	lAllFiles = os.listdir(source_directory)
 	l_cat_files = [os.path.join(source_directory, sFile) for 
 		sFile in lAllFiles if sFile.find('.cat') != -1]
 	print '> found {} .cat files in {} ...'.format(len(l_cat_files), source_directory)
-	make_csv_file_from_file_list(os.path.join(source_directory, output_filename), l_cat_files)
+	if output_format == 'columnar':
+		if incremental or dedup_radius_arcsec:
+			raise BaseException('Incremental conversion and de-duplication only support CSV output.')
+		convert_function = make_columnar_store_from_file_list
+	elif incremental:
+		convert_function = update_csv_file_from_file_list
+	else:
+		convert_function = make_csv_file_from_file_list
+	sOutputFileName = os.path.join(source_directory, output_filename)
+	convert_function(sOutputFileName, l_cat_files,
+		n_workers=n_workers, column_names=column_names, cuts=cuts)
+	if dedup_radius_arcsec:
+		deduplicate_tiles.deduplicate_csv_file(sOutputFileName,
+			'{}_dedup{}'.format(*os.path.splitext(sOutputFileName)),
+			radius_arcsec=dedup_radius_arcsec, keep=dedup_keep)
 		
 
+# Parses a '--cut' commandline value of the form 'COLUMN:MIN:MAX' into a
+# (column_name, min, max) tuple. Either bound may be left empty, e.g. 'MAG_AUTO::24.5'.
+def parse_cut_argument(sCut):
+	lParts = sCut.split(':')
+	if len(lParts) != 3:
+		raise argparse.ArgumentTypeError("cut '{}' is not of the form COLUMN:MIN:MAX".format(sCut))
+	column_name, sMin, sMax = lParts
+	return (column_name, float(sMin) if sMin else None, float(sMax) if sMax else None)
+
+
 if __name__ == "__main__":
 	# Get commandline arguments.
 	parser = argparse.ArgumentParser(description='description')
 	parser.add_argument('--csv_output_filename', '-f', type=str,
-                   help='output CSV filename')
+                   help='output CSV (or columnar store) filename')
 	parser.add_argument('--source_directory', '-d', type=str,
-                   help='directory of NGVS .cat files')
+                   help='directory of NGVS .cat files (may be gzip/bzip2-compressed)')
+	parser.add_argument('--n_workers', '-n', type=int, default=1,
+                   help='number of worker processes parsing .cat files in parallel')
+	parser.add_argument('--columns', '-c', type=str,
+                   help='comma-separated list of .cat columns to keep (default: all)')
+	parser.add_argument('--cut', type=parse_cut_argument, action='append',
+                   help='keep only rows with MIN <= COLUMN <= MAX, given as COLUMN:MIN:MAX '
+                   '(either bound may be empty); may be repeated, e.g. for an RA/DEC box')
+	parser.add_argument('--incremental', '-i', action='store_true',
+                   help='only parse .cat files that are new or changed since the last run')
+	parser.add_argument('--output_format', type=str, choices=['csv', 'columnar'], default='csv',
+                   help='write a CSV, or a compressed columnar store with per-chunk stats')
+	parser.add_argument('--dedup_radius', type=float,
+                   help='also write <output>_dedup.csv, without sources repeated on overlapping '
+                   'tiles within this radius (arcsec)')
+	parser.add_argument('--dedup_keep', type=str, choices=['snr', 'centre'], default='snr',
+                   help='which duplicate to keep: highest S/N, or nearest its tile centre')
 	args = parser.parse_args()
   # Call main function.
-	convert_all_cats_in_dir(source_directory=args.source_directory, output_filename=args.csv_output_filename)
+	convert_all_cats_in_dir(source_directory=args.source_directory, output_filename=args.csv_output_filename,
+		n_workers=args.n_workers, column_names=args.columns.split(',') if args.columns else None,
+		cuts=args.cut, incremental=args.incremental, output_format=args.output_format,
+		dedup_radius_arcsec=args.dedup_radius, dedup_keep=args.dedup_keep)
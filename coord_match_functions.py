@@ -1,65 +1,158 @@
 from astropy.coordinates import SkyCoord
+from astropy.coordinates import match_coordinates_sky
 from astropy import units as u
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import convert_megacam_to_csv
+import sky_index
 import os
 
 
+# Pairwise match of two recarrays. For each row of new_coords, finds the nearest row of
+# old_coords; returns (indices into new_coords, indices into old_coords, separations in
+# arcsec) for the pairs closer than maxdtheta (arcsec).
 def match_pairs_between_two_sets(new_coords, old_coords, RAcolumnname, DECcolumnname, maxdtheta):
 	matchcoord = SkyCoord(ra=new_coords[RAcolumnname]*u.degree,
 		dec=new_coords[DECcolumnname]*u.degree)
-	catalogcoord = SkyCoord(ra=old_coords[RAcolumnname]*u.degree, 
+	catalogcoord = SkyCoord(ra=old_coords[RAcolumnname]*u.degree,
 		dec=old_coords[DECcolumnname]*u.degree)
 
 	# Each of the following 3 vars has length of matchcoord.
-	idx, sep2d, dist3d = astropy.coordinates.match_coordinates_sky(matchcoord, catalogcoord)
+	idx, sep2d, dist3d = match_coordinates_sky(matchcoord, catalogcoord)
 
-	# list for storing the new lines with the union of both sets of input columns.
-	match_lines = []
+	# Keep each closest object of matchcoord if the angular separation is below maxdtheta.
+	sep_arcsec = np.array(sep2d.arcsecond)
+	indices_into_new = np.where(sep_arcsec <= maxdtheta)[0]
+	return indices_into_new, np.array(idx)[indices_into_new], sep_arcsec[indices_into_new]
 
-	# Iterate through each closest object of matchcoord, adding the new matchline if the 
-	# angular separation is below maxdtheta.
-	for i, idx_sep2d in enumerate(zip(idx, sep2d)):
-		if idx_sep2d[1] <= maxdtheta: 
-			new_line = old_coords[idx_sep2d[0]] + new_coords[i]
-	
 
 
-# Takes list of NGVS files and copies each to a CSV format. Returns a list of the 
-# new filenames. 
+# Takes list of NGVS files and copies each to a CSV format. Returns a list of the
+# new filenames.
 def convert_all_NGVS_cat_to_csv(NGVS_list):
 	new_filenames = []
 	for NGVS_file in NGVS_list:
 		new_filename = NGVS_file.replace('.cat', '.csv')
-		convert_megacam_to_csv.make_csv_file_from_file_list([NGVS_file], new_filename)
+		convert_megacam_to_csv.make_csv_file_from_file_list(new_filename, [NGVS_file])
 		new_filenames.append(new_filename)
 
 	return new_filenames
-		
 
 
-# Takes a list of NGVS files, writes each file to an equivalent csv file,
-# then matches the csv files in sequential sets of two, saving an intermediate
-# matched csv file at each step.
-def match_all(NGVS_file_list):
-
-	# Convert all NGVS files in list to CSV files.
-	csv_filenames = convert_all_NGVS_cat_to_csv(NGVS_file_list)
-
-	previous_matched_file = None
-
-	for index, filename in enumerate(csv_filenames):
-		with open(filename, 'w') as input_file:
-			pass
-
-
-
-
-
-	array_of_all_matches = None
-	return array_of_all_matches
+# Reads a whole NGVS .cat file into a recarray of typed columns.
+def read_cat_file_as_recarray(NGVS_file):
+	column_names = convert_megacam_to_csv.read_cat_column_names(NGVS_file)
+	chunks = list(convert_megacam_to_csv.iter_cat_column_chunks(NGVS_file, column_names))
+	if not chunks:
+		raise BaseException("No rows in '{}'.".format(NGVS_file))
+	arrays = [np.concatenate([chunk[name] for chunk in chunks]) for name in column_names]
+	return np.rec.fromarrays(arrays,
+		dtype=[(name, array.dtype) for (name, array) in zip(column_names, arrays)])
+
+
+# 'NGVS-1+0.G.cat' -> 'G'.
+def get_band_name(NGVS_file):
+	name_parts = os.path.basename(NGVS_file).split('.')
+	if 'cat' in name_parts[1:]:
+		return name_parts[name_parts.index('cat', 1) - 1]
+	return name_parts[0]
+
+
+# Returns, for each row, the unit vector pointing at the mean position of its cluster.
+def get_cluster_centres(xyz, cluster, n_clusters):
+	centres = np.zeros((n_clusters, 3))
+	np.add.at(centres, cluster, xyz)
+	centres /= np.linalg.norm(centres, axis=1)[:, np.newaxis]
+	return centres
+
+
+# Fill value for a band's columns on rows where that band has no detection.
+def get_missing_value(dtype):
+	if dtype.kind == 'f':
+		return np.nan
+	if dtype.kind in 'iu':
+		return -1
+	return ''
+
+
+# Takes a list of NGVS files (one per band, e.g. the G and I2 catalogs of a tile) and
+# merges them in one spatial pass: all bands' sources go into a single k-d tree, every
+# cross-band pair closer than max_arcsec_sep links two detections, and each connected
+# group of detections is one physical source. If a group has more than one detection
+# in the same band, the one nearest the group's mean position is used and the others
+# become sources of their own.
+#
+# Returns a recarray with one row per source: its mean 'ra'/'dec', 'n_bands' (how many
+# bands detected it), and every column of every band as '<band>_<column>'. Bands that
+# didn't detect a source hold NaN (floats), -1 (integers) or '' (strings). Also written
+# to output_filename as CSV, if given.
+def match_all(NGVS_file_list, max_arcsec_sep=1.0, band_names=None,
+		ra_column='ALPHA_J2000', dec_column='DELTA_J2000', output_filename=None):
+
+	if not band_names:
+		band_names = [get_band_name(NGVS_file) for NGVS_file in NGVS_file_list]
+	catalogs = [read_cat_file_as_recarray(NGVS_file) for NGVS_file in NGVS_file_list]
+
+	# Stack every detection of every band.
+	band = np.concatenate([np.repeat(index, len(catalog))
+		for index, catalog in enumerate(catalogs)])
+	row_in_band = np.concatenate([np.arange(len(catalog)) for catalog in catalogs])
+	xyz = np.concatenate([sky_index.radec_to_unit_vectors(catalog[ra_column], catalog[dec_column])
+		for catalog in catalogs])
+	n_detections = len(xyz)
+
+	print 'matching {} detections in {} bands ... '.format(n_detections, len(catalogs))
+	pairs = cKDTree(xyz).query_pairs(sky_index.arcsec_to_chord(max_arcsec_sep),
+		output_type='ndarray')
+	pairs = pairs[band[pairs[:, 0]] != band[pairs[:, 1]]]
+	graph = coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+		shape=(n_detections, n_detections))
+	n_clusters, cluster = connected_components(graph, directed=False)
+
+	# Within each (cluster, band), keep the detection nearest the cluster centre and split
+	# the others off into clusters of their own.
+	centres = get_cluster_centres(xyz, cluster, n_clusters)
+	distance = 1. - np.einsum('ij,ij->i', xyz, centres[cluster])
+	order = np.lexsort((distance, band, cluster))
+	is_repeat = np.zeros(n_detections, dtype=bool)
+	is_repeat[order[1:]] = (cluster[order[1:]] == cluster[order[:-1]]) & (
+		band[order[1:]] == band[order[:-1]])
+	cluster[is_repeat] = n_clusters + np.arange(is_repeat.sum())
+	unique_clusters, source = np.unique(cluster, return_inverse=True)
+	n_sources = len(unique_clusters)
+	centres = get_cluster_centres(xyz, source, n_sources)
+
+	# Build the output table.
+	dtype = [('ra', np.float64), ('dec', np.float64), ('n_bands', np.int32)]
+	for band_name, catalog in zip(band_names, catalogs):
+		dtype.extend([('{}_{}'.format(band_name, name), catalog.dtype[name])
+			for name in catalog.dtype.names])
+	output_array = np.recarray(n_sources, dtype=dtype)
+	output_array['ra'] = np.degrees(np.arctan2(centres[:, 1], centres[:, 0])) % 360.
+	output_array['dec'] = np.degrees(np.arcsin(np.clip(centres[:, 2], -1., 1.)))
+	output_array['n_bands'] = np.bincount(source, minlength=n_sources)
+	for band_index, (band_name, catalog) in enumerate(zip(band_names, catalogs)):
+		in_band = band == band_index
+		for name in catalog.dtype.names:
+			column = output_array['{}_{}'.format(band_name, name)]
+			column[:] = get_missing_value(column.dtype)
+			column[source[in_band]] = catalog[name][row_in_band[in_band]]
+	print '\tdone. {} sources, {} of them in all {} bands.'.format(n_sources,
+		(output_array['n_bands'] == len(catalogs)).sum(), len(catalogs))
+
+	if output_filename:
+		with open(output_filename, 'w') as f:
+			f.write('{}\n'.format(','.join(output_array.dtype.names)))
+			for line in output_array.tolist():
+				f.write('{}\n'.format(','.join([str(i) for i in line])))
+		print '{} written.'.format(output_filename)
+
+	return output_array
 
 def test():
-	
+
 	file_list = ['NGVS-1+0.G.cat', 'NGVS-1+0.I2.cat']
 
-	matched_array = match_all(file_list)	
+	matched_array = match_all(file_list)
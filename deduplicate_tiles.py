@@ -0,0 +1,212 @@
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import sky_index
+
+
+# Adjacent MegaCam tiles overlap, so a CSV combined by convert_megacam_to_csv has the
+# same source in it once per tile ('source_file') that it falls on. This drops those
+# duplicates: a row is dropped when a row from a *different* tile lies within the
+# match radius and beats it, either on S/N (keep='snr') or on being nearer to its own
+# tile's centre (keep='centre'); ties go to the earlier row. Rows from the same tile are
+# never merged with each other, since those are separate (deblended) sources.
+#
+# To keep memory bounded for tens of millions of rows, the rows are first spread out
+# into declination-zone files on disk, then each zone (plus the edges of its two
+# neighbours) is searched with a k-d tree on its own. The only thing held in memory
+# for the whole catalog is one keep/drop flag per row.
+
+# Rows read from the CSV at a time.
+CHUNK_ROWS = 100000
+
+# What is kept of each row in the zone files.
+ZONE_RECORD_DTYPE = [('row', np.int64), ('x', np.float64), ('y', np.float64),
+	('z', np.float64), ('dec', np.float64), ('score', np.float64), ('tile', np.int32)]
+
+
+# Reads the data rows of a CSV iChunkRows rows at a time. Yields 2D string token arrays.
+def iter_csv_token_chunks(f_in, nColumns, iChunkRows=CHUNK_ROWS):
+	while True:
+		lChunk = list(itertools.islice(f_in, iChunkRows))
+		if not lChunk:
+			break
+		aTokens = np.array(','.join([sLine.rstrip('\n') for sLine in lChunk]).split(','))
+		if aTokens.size % nColumns != 0:
+			raise BaseException("CSV has rows that don't have {} columns.".format(nColumns))
+		yield aTokens.reshape(-1, nColumns)
+
+
+def get_zone_filename(sZoneDirectory, zone_index):
+	return os.path.join(sZoneDirectory, 'zone_{:05d}.bin'.format(zone_index))
+
+
+def load_zone(sZoneDirectory, zone_index):
+	sZoneFileName = get_zone_filename(sZoneDirectory, zone_index)
+	if not os.path.exists(sZoneFileName):
+		return np.empty(0, dtype=ZONE_RECORD_DTYPE)
+	return np.fromfile(sZoneFileName, dtype=ZONE_RECORD_DTYPE)
+
+
+# First pass: streams the CSV and appends each row's position, score and tile to the
+# file of the declination zone it falls in. Returns (number of rows, number of zones,
+# (n_tiles, 3) array of unit vectors pointing at each tile's centre).
+def partition_csv_into_zones(sInputFileName, sZoneDirectory, zone_height_deg, keep,
+		ra_column, dec_column, snr_columns):
+	n_zones = int(np.ceil(180. / zone_height_deg))
+	with open(sInputFileName, 'r') as f_in:
+		lColumnNames = f_in.readline().strip().split(',')
+		header_dict = {name: index for (index, name) in enumerate(lColumnNames)}
+		lNeededColumns = [ra_column, dec_column, 'source_file']
+		if keep == 'snr':
+			lNeededColumns.extend(snr_columns)
+		for column_name in lNeededColumns:
+			if not column_name in header_dict:
+				raise BaseException("Column '{}' not found in '{}' from list:\n{}".format(
+					column_name, sInputFileName, sorted(lColumnNames)))
+
+		tile_ids = {}
+		tile_xyz_sums = np.zeros((0, 3))
+		n_rows = 0
+		for aTokens in iter_csv_token_chunks(f_in, len(lColumnNames)):
+			dec = aTokens[:, header_dict[dec_column]].astype(np.float64)
+			xyz = sky_index.radec_to_unit_vectors(
+				aTokens[:, header_dict[ra_column]].astype(np.float64), dec)
+
+			# Give each source_file a small integer id.
+			unique_tiles, tile_inverse = np.unique(aTokens[:, header_dict['source_file']],
+				return_inverse=True)
+			tile = np.array([tile_ids.setdefault(s, len(tile_ids)) for s in unique_tiles],
+				dtype=np.int32)[tile_inverse]
+			if len(tile_ids) > len(tile_xyz_sums):
+				tile_xyz_sums = np.vstack([tile_xyz_sums,
+					np.zeros((len(tile_ids) - len(tile_xyz_sums), 3))])
+			np.add.at(tile_xyz_sums, tile, xyz)
+
+			records = np.empty(len(aTokens), dtype=ZONE_RECORD_DTYPE)
+			records['row'] = np.arange(n_rows, n_rows + len(aTokens))
+			records['x'], records['y'], records['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+			records['dec'] = dec
+			records['tile'] = tile
+			if keep == 'snr':
+				with np.errstate(divide='ignore', invalid='ignore'):
+					score = (aTokens[:, header_dict[snr_columns[0]]].astype(np.float64) /
+						aTokens[:, header_dict[snr_columns[1]]].astype(np.float64))
+				records['score'] = np.where(np.isnan(score), -np.inf, score)
+			else:
+				# Filled in per zone, once all the tile centres are known.
+				records['score'] = 0.
+			n_rows += len(aTokens)
+
+			zone = np.clip(np.floor((dec + 90.) / zone_height_deg).astype(int), 0, n_zones - 1)
+			zone_order = np.argsort(zone, kind='mergesort')
+			unique_zones, zone_starts = np.unique(zone[zone_order], return_index=True)
+			for zone_index, lo, hi in zip(unique_zones, zone_starts,
+					list(zone_starts[1:]) + [len(zone)]):
+				with open(get_zone_filename(sZoneDirectory, zone_index), 'ab') as f_zone:
+					records[zone_order[lo:hi]].tofile(f_zone)
+
+	tile_centres = tile_xyz_sums / np.linalg.norm(tile_xyz_sums, axis=1)[:, np.newaxis]
+	return n_rows, n_zones, tile_centres
+
+
+# Second pass: searches each zone for cross-tile pairs closer than the radius and flags
+# the losing row of each pair. Returns a boolean array, True for rows to drop.
+def find_duplicates_in_zones(sZoneDirectory, n_rows, n_zones, zone_height_deg, radius_arcsec,
+		keep, tile_centres):
+	dropped = np.zeros(n_rows, dtype=bool)
+	margin_deg = radius_arcsec / 3600.
+	max_chord = sky_index.arcsec_to_chord(radius_arcsec)
+
+	zone_below = np.empty(0, dtype=ZONE_RECORD_DTYPE)
+	zone_core = load_zone(sZoneDirectory, 0)
+	for zone_index in range(n_zones):
+		zone_above = load_zone(sZoneDirectory, zone_index + 1)
+		if len(zone_core):
+			zone_lo = -90. + zone_index * zone_height_deg
+			zone_hi = zone_lo + zone_height_deg
+			# Core rows come first, so any pair with a core row in it has i < n_core.
+			points = np.concatenate([zone_core,
+				zone_below[zone_below['dec'] >= zone_lo - margin_deg],
+				zone_above[zone_above['dec'] < zone_hi + margin_deg]])
+			xyz = np.column_stack([points['x'], points['y'], points['z']])
+			pairs = cKDTree(xyz).query_pairs(max_chord, output_type='ndarray')
+			pairs = pairs[pairs[:, 0] < len(zone_core)]
+			i, j = pairs[:, 0], pairs[:, 1]
+			cross_tile = points['tile'][i] != points['tile'][j]
+			i, j = i[cross_tile], j[cross_tile]
+
+			if keep == 'snr':
+				score = points['score']
+			else:
+				# Nearer the tile centre means a larger dot product with it.
+				score = np.einsum('ij,ij->i', xyz, tile_centres[points['tile']])
+			i_beats_j = (score[i] > score[j]) | (
+				(score[i] == score[j]) & (points['row'][i] < points['row'][j]))
+			dropped[points['row'][np.where(i_beats_j, j, i)]] = True
+
+		zone_below, zone_core = zone_core, zone_above
+	return dropped
+
+
+# Copies sInputFileName (a CSV from convert_megacam_to_csv) to sOutputFileName without
+# the rows that duplicate a better row from another tile within radius_arcsec. keep is
+# 'snr' (higher snr_columns[0] / snr_columns[1] wins) or 'centre' (nearer the centre of
+# its own tile wins). zone_height_deg sets the declination zone size, and with it the
+# peak memory of the search; it must be at least the radius.
+def deduplicate_csv_file(sInputFileName, sOutputFileName, radius_arcsec=1.0, keep='snr',
+		ra_column='ALPHA_J2000', dec_column='DELTA_J2000',
+		snr_columns=('FLUX_AUTO', 'FLUXERR_AUTO'), zone_height_deg=0.5):
+	if keep not in ('snr', 'centre'):
+		raise BaseException("keep must be 'snr' or 'centre', not '{}'.".format(keep))
+	if radius_arcsec / 3600. > zone_height_deg:
+		raise BaseException('zone_height_deg must be at least the match radius.')
+
+	print '> De-duplicating "{}" within {} arcsec ...'.format(sInputFileName, radius_arcsec)
+	sZoneDirectory = tempfile.mkdtemp(prefix='dedup_zones_',
+		dir=os.path.dirname(os.path.abspath(sOutputFileName)))
+	try:
+		n_rows, n_zones, tile_centres = partition_csv_into_zones(sInputFileName, sZoneDirectory,
+			zone_height_deg, keep, ra_column, dec_column, snr_columns)
+		dropped = find_duplicates_in_zones(sZoneDirectory, n_rows, n_zones, zone_height_deg,
+			radius_arcsec, keep, tile_centres)
+	finally:
+		shutil.rmtree(sZoneDirectory, ignore_errors=True)
+
+	# Last pass: copy over the rows that weren't dropped.
+	with open(sInputFileName, 'r') as f_in:
+		with open(sOutputFileName, 'w') as f_out:
+			f_out.write(f_in.readline())
+			n_rows_read = 0
+			while True:
+				lChunk = list(itertools.islice(f_in, CHUNK_ROWS))
+				if not lChunk:
+					break
+				chunk_dropped = dropped[n_rows_read:n_rows_read + len(lChunk)]
+				f_out.write(''.join([sLine for (sLine, is_dropped) in
+					zip(lChunk, chunk_dropped) if not is_dropped]))
+				n_rows_read += len(lChunk)
+
+	print '> Dropped {} duplicate rows of {}; created "{}"'.format(dropped.sum(), n_rows,
+		sOutputFileName)
+
+
+if __name__ == "__main__":
+	# Get commandline arguments.
+	parser = argparse.ArgumentParser(description='Drops sources duplicated across overlapping NGVS tiles.')
+	parser.add_argument('input_filename', type=str,
+                   help='CSV made by convert_megacam_to_csv.py')
+	parser.add_argument('output_filename', type=str,
+                   help='de-duplicated output CSV')
+	parser.add_argument('--radius', '-r', type=float, default=1.0,
+                   help='match radius (arcsec)')
+	parser.add_argument('--keep', type=str, choices=['snr', 'centre'], default='snr',
+                   help='which duplicate to keep: highest S/N, or nearest its tile centre')
+	args = parser.parse_args()
+	deduplicate_csv_file(args.input_filename, args.output_filename, radius_arcsec=args.radius,
+		keep=args.keep)
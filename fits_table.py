@@ -0,0 +1,97 @@
+import numpy as np
+from astropy.io import fits
+
+
+# Lazy access to a FITS binary table (e.g. the multi-GB NSA catalog). The file is
+# memory-mapped rather than read, and only the requested columns of the requested rows
+# are ever copied out of it, converted from the raw FITS values (big-endian, scaled,
+# 'T'/'F' logicals) the same way astropy converts them.
+#
+#	with fits_table('nsa_v0_1_2.fits') as table:
+#		z = table.read(['Z'])['Z']
+#		nearby = table.read(['NSAID', 'RA', 'DEC'], rows=z < 0.05)
+#		for chunk in table.iter_chunks(['RA', 'DEC'], row_filter=lambda c: c['DEC'] > 0.):
+#			...
+
+# Rows read at a time by fits_table.iter_chunks.
+CHUNK_ROWS = 100000
+
+# The TZERO that marks an integer column as holding unsigned values, and the type it
+# holds, by column format.
+UNSIGNED_ZEROS = {'I': (2**15, np.uint16), 'J': (2**31, np.uint32), 'K': (2**63, np.uint64)}
+
+
+# Turns raw FITS values of a column into the values they stand for.
+def convert_fits_column(column, raw_values):
+	format_code = column.format.format
+	bscale = column.bscale if column.bscale is not None else 1
+	bzero = column.bzero if column.bzero is not None else 0
+	if format_code == 'L':
+		return raw_values == ord('T')
+	if bscale == 1 and format_code in UNSIGNED_ZEROS and bzero == UNSIGNED_ZEROS[format_code][0]:
+		unsigned_type = UNSIGNED_ZEROS[format_code][1]
+		return raw_values.astype(unsigned_type) + unsigned_type(bzero)
+	if bscale != 1 or bzero != 0:
+		return raw_values * np.float64(bscale) + np.float64(bzero)
+	return raw_values.astype(raw_values.dtype.newbyteorder('='))
+
+
+class fits_table(object):
+	def __init__(self, input_filename, hdu_index=1):
+		self.input_filename = input_filename
+		self.hdulist = fits.open(input_filename, memmap=True)
+		hdu = self.hdulist[hdu_index]
+		if not isinstance(hdu, fits.BinTableHDU):
+			raise BaseException("HDU {} of '{}' is not a binary table.".format(hdu_index, input_filename))
+		for column in hdu.columns:
+			if column.format.p_format:
+				raise BaseException("Column '{}' of '{}' has variable-length arrays, which aren't supported.".format(
+					column.name, input_filename))
+		self.columns = hdu.columns
+		self.column_names = list(hdu.columns.names)
+		self.n_rows = hdu.header['NAXIS2']
+		# The raw records, straight from the memory map: nothing is read until a column is.
+		self.raw_records = hdu.data.view(np.ndarray)
+
+	def __len__(self):
+		return self.n_rows
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		self.raw_records = None
+		self.hdulist.close()
+
+	def check_column_names(self, column_names):
+		if not column_names:
+			return self.column_names
+		for column_name in column_names:
+			if not column_name in self.column_names:
+				raise BaseException("Column '{}' not found in file '{}' from list:\n {}".format(
+					column_name, self.input_filename, sorted(self.column_names)))
+		return list(column_names)
+
+	# Returns a recarray of column_names (default: all) for the given rows: a slice, an
+	# array of row numbers, or a boolean mask over the whole table (default: all rows).
+	def read(self, column_names=None, rows=None):
+		column_names = self.check_column_names(column_names)
+		if rows is None:
+			rows = slice(None)
+		arrays = [convert_fits_column(self.columns[column_name], self.raw_records[column_name][rows])
+			for column_name in column_names]
+		return np.rec.fromarrays(arrays, dtype=[(column_name, array.dtype, array.shape[1:])
+			for (column_name, array) in zip(column_names, arrays)])
+
+	# Reads the table chunk_rows rows at a time, yielding a recarray of column_names for
+	# each chunk. row_filter, if given, is called on each chunk and returns a boolean
+	# mask of the rows to keep; the columns it looks at must be among column_names.
+	def iter_chunks(self, column_names=None, chunk_rows=CHUNK_ROWS, row_filter=None):
+		for start in range(0, self.n_rows, chunk_rows):
+			chunk = self.read(column_names, rows=slice(start, start + chunk_rows))
+			if row_filter is not None:
+				chunk = chunk[row_filter(chunk)]
+			yield chunk
@@ -0,0 +1,150 @@
+import argparse
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+# A local store of SDSS photometry, one row per objID, so that objects already fetched
+# for one search are never fetched again for another. DR7 doesn't change, so rows
+# don't expire.
+#
+# The rows are kept sorted on objID (looked up with a binary search) and saved as one
+# .npy file; the objIDs SDSS was asked for but didn't return are kept too, so they're
+# not asked for again either. When SDSS was asked only for objects meeting a condition
+# (a pushed-down filter), the objIDs it didn't return are in SDSS but failed that
+# condition: they're kept in a list of their own for that condition, and are only
+# skipped by lookups made with the same condition. A store is shared by the threads of
+# one process (see get_photometry_store); separate processes writing the same store can
+# lose each other's rows, which then just get fetched again.
+
+DEFAULT_PHOTOMETRY_STORE_DIRECTORY = 'photometry_store'
+
+# Columns of a stored row, as np.recfromcsv names the columns of an SDSS answer.
+PHOTOMETRY_DTYPE = [('objid', np.int64), ('ra', np.float64), ('dec', np.float64),
+	('u', np.float64), ('g', np.float64), ('r', np.float64), ('i', np.float64), ('z', np.float64),
+	('petrorad_r', np.float64), ('type', np.int64)]
+
+# The open stores, by directory.
+open_stores = {}
+open_stores_lock = threading.Lock()
+
+
+# Returns the store in store_directory, opening it the first time it's asked for.
+def get_photometry_store(store_directory=DEFAULT_PHOTOMETRY_STORE_DIRECTORY):
+	with open_stores_lock:
+		store_directory = os.path.abspath(store_directory)
+		if not store_directory in open_stores:
+			open_stores[store_directory] = photometry_store(store_directory)
+		return open_stores[store_directory]
+
+
+# Copies the PHOTOMETRY_DTYPE columns of a recarray into a new array of that dtype.
+def to_photometry_rows(recarray):
+	recarray = np.atleast_1d(recarray)
+	for column_name, column_type in PHOTOMETRY_DTYPE:
+		if not column_name in recarray.dtype.names:
+			raise BaseException("Column '{}' not found in photometry from list:\n{}".format(
+				column_name, sorted(recarray.dtype.names)))
+	return np.rec.fromarrays([recarray[column_name] for (column_name, column_type) in PHOTOMETRY_DTYPE],
+		dtype=PHOTOMETRY_DTYPE)
+
+
+class photometry_store(object):
+	def __init__(self, store_directory=DEFAULT_PHOTOMETRY_STORE_DIRECTORY):
+		self.store_directory = store_directory
+		self.rows_filename = os.path.join(store_directory, 'photometry.npy')
+		self.not_found_filename = os.path.join(store_directory, 'not_found.npy')
+		self.lock = threading.Lock()
+		if os.path.exists(self.rows_filename):
+			self.rows = np.load(self.rows_filename).view(np.recarray)
+		else:
+			self.rows = np.rec.fromarrays([np.empty(0, dtype=column_type)
+				for (column_name, column_type) in PHOTOMETRY_DTYPE], dtype=PHOTOMETRY_DTYPE)
+		if os.path.exists(self.not_found_filename):
+			self.not_found_objids = np.load(self.not_found_filename)
+		else:
+			self.not_found_objids = np.empty(0, dtype=np.int64)
+		# {condition: objIDs that failed it}, loaded as conditions are first used.
+		self.rejected_objids = {}
+
+	def get_rejected_filename(self, sCondition):
+		return os.path.join(self.store_directory, 'rejected_{}.npy'.format(
+			hashlib.md5(sCondition).hexdigest()))
+
+	# Returns the objIDs known to fail sCondition. Call with the lock held.
+	def get_rejected_objids(self, sCondition):
+		if not sCondition in self.rejected_objids:
+			sRejectedFilename = self.get_rejected_filename(sCondition)
+			if os.path.exists(sRejectedFilename):
+				self.rejected_objids[sCondition] = np.load(sRejectedFilename)
+			else:
+				self.rejected_objids[sCondition] = np.empty(0, dtype=np.int64)
+		return self.rejected_objids[sCondition]
+
+	def __len__(self):
+		return len(self.rows)
+
+	# Returns (recarray of the stored rows of lObjIDs, in the order asked for; array of
+	# the objIDs that still have to be fetched). objIDs known not to be in SDSS, or (with
+	# sCondition) known to fail sCondition, are in neither.
+	def lookup(self, lObjIDs, sCondition=None):
+		aObjIDs = np.asarray(lObjIDs, dtype=np.int64)
+		with self.lock:
+			rows = self.rows
+			not_found_objids = self.not_found_objids
+			if sCondition:
+				not_found_objids = np.union1d(not_found_objids, self.get_rejected_objids(sCondition))
+		aPositions = np.clip(np.searchsorted(rows['objid'], aObjIDs), 0, max(len(rows) - 1, 0))
+		aFound = rows['objid'][aPositions] == aObjIDs if len(rows) else np.zeros(len(aObjIDs), dtype=bool)
+		aMissing = ~aFound & ~np.in1d(aObjIDs, not_found_objids)
+		return rows[aPositions[aFound]], aObjIDs[aMissing]
+
+	# Adds freshly fetched rows (any recarray with the PHOTOMETRY_DTYPE columns) and saves
+	# the store. lRequestedObjIDs are the objIDs they were fetched for: the ones that
+	# didn't come back are remembered as not found or, if the fetch asked only for objects
+	# meeting sCondition, as failing sCondition.
+	def add(self, recarray, lRequestedObjIDs=(), sCondition=None):
+		new_rows = to_photometry_rows(recarray) if len(np.atleast_1d(recarray)) else self.rows[:0]
+		aNotReturned = np.setdiff1d(np.asarray(lRequestedObjIDs, dtype=np.int64), new_rows['objid'])
+		with self.lock:
+			# New rows replace stored rows of the same objID.
+			aAll = np.concatenate([new_rows, self.rows[~np.in1d(self.rows['objid'], new_rows['objid'])]])
+			aObjIDs, aFirst = np.unique(aAll['objid'], return_index=True)
+			self.rows = aAll[aFirst].view(np.recarray)
+			if sCondition:
+				self.rejected_objids[sCondition] = np.union1d(self.get_rejected_objids(sCondition),
+					aNotReturned)
+			else:
+				self.not_found_objids = np.setdiff1d(np.union1d(self.not_found_objids, aNotReturned),
+					self.rows['objid'])
+			self.save()
+
+	# Writes the store to temporary files and renames them into place, so that a
+	# half-written store is never loaded.
+	def save(self):
+		if not os.path.isdir(self.store_directory):
+			os.makedirs(self.store_directory)
+		lFiles = [(self.rows_filename, np.asarray(self.rows)),
+			(self.not_found_filename, self.not_found_objids)]
+		for sCondition, rejected_objids in self.rejected_objids.items():
+			lFiles.append((self.get_rejected_filename(sCondition), rejected_objids))
+		for filename, array in lFiles:
+			file_descriptor, temp_filename = tempfile.mkstemp(dir=self.store_directory, suffix='.tmp')
+			with os.fdopen(file_descriptor, 'wb') as f:
+				np.save(f, array)
+			os.rename(temp_filename, filename)
+
+
+if __name__ == "__main__":
+	# Get commandline arguments.
+	parser = argparse.ArgumentParser(description='Inspects an SDSS photometry store.')
+	parser.add_argument('--directory', '-d', type=str, default=DEFAULT_PHOTOMETRY_STORE_DIRECTORY,
+                   help='store directory')
+	args = parser.parse_args()
+
+	store = photometry_store(args.directory)
+	print '{}: {} objects stored, {} known not to be in SDSS.'.format(args.directory, len(store),
+		len(store.not_found_objids))
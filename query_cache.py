@@ -0,0 +1,193 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import sky_index
+
+
+# A local cache of the answers web services (the Chandra CSC-SDSS crossmatch, SDSS) give
+# to cone searches, so that searching a field again doesn't go back to the servers.
+#
+# Each cache entry is the response text as it came from the server, plus a small .json
+# file saying which service and cone (RA, DEC, radius) it answers, and when it was
+# fetched. Entries older than the TTL are never used, and are dropped as they're found.
+# A search whose cone lies entirely inside a cached cone of the same service can be
+# answered from that entry, by the caller filtering its rows down to the smaller cone.
+# When the cache grows past its size limit, the least recently used entries go first.
+
+DEFAULT_QUERY_CACHE_DIRECTORY = 'query_cache'
+
+# Default age after which an entry is stale, in hours.
+DEFAULT_TTL_HOURS = 7 * 24
+
+# Default size limit of a cache directory.
+DEFAULT_MAX_CACHE_MB = 256
+
+
+# Angular separation (arcseconds) between positions ra, dec and one position ra_0, dec_0,
+# all in degrees.
+def get_separation_arcsec(ra, dec, ra_0, dec_0):
+	xyz = sky_index.radec_to_unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+	xyz_0 = sky_index.radec_to_unit_vectors([ra_0], [dec_0])
+	return sky_index.chord_to_arcsec(np.sqrt(((xyz - xyz_0) ** 2).sum(axis=1)))
+
+
+# True if the cone (radius in arcmin) lies entirely inside the cone ra_0, dec_0, radius_0.
+def is_cone_inside(ra, dec, radius_arcmin, ra_0, dec_0, radius_0_arcmin):
+	return get_separation_arcsec(float(ra), float(dec), float(ra_0), float(dec_0))[0] / 60. + \
+		float(radius_arcmin) <= float(radius_0_arcmin)
+
+
+def get_cache_key(service, ra, dec, radius_arcmin):
+	return hashlib.md5(json.dumps([service, float(ra), float(dec), float(radius_arcmin)])).hexdigest()
+
+
+def get_entry_filenames(cache_directory, cache_key):
+	return (os.path.join(cache_directory, '{}.txt'.format(cache_key)),
+		os.path.join(cache_directory, '{}.json'.format(cache_key)))
+
+
+# Returns [(cache_key, meta dict)] for every complete entry in the cache directory.
+def list_cache_entries(cache_directory):
+	if not os.path.isdir(cache_directory):
+		return []
+	entries = []
+	for filename in os.listdir(cache_directory):
+		if not filename.endswith('.json'):
+			continue
+		try:
+			with open(os.path.join(cache_directory, filename), 'r') as f:
+				entries.append((filename[:-len('.json')], json.load(f)))
+		except IOError:
+			# Removed since the listing.
+			pass
+	return entries
+
+
+# (Another thread or process may be removing the same entry.)
+def remove_cache_entry(cache_directory, cache_key):
+	for filename in get_entry_filenames(cache_directory, cache_key):
+		try:
+			os.remove(filename)
+		except OSError:
+			pass
+
+
+def is_entry_expired(meta, ttl_hours=DEFAULT_TTL_HOURS):
+	return time.time() - meta['fetched_time'] > ttl_hours * 3600.
+
+
+# Returns (cache_key, meta) of the smallest fresh entry of service whose cone contains
+# the given cone, or None. accept, if given, is called on each such entry's meta and
+# can turn it down. Expired entries are dropped.
+def find_containing_entry(cache_directory, service, ra, dec, radius_arcmin,
+		ttl_hours=DEFAULT_TTL_HOURS, accept=None):
+	best_entry = None
+	for cache_key, meta in list_cache_entries(cache_directory):
+		if meta['service'] != service:
+			continue
+		if is_entry_expired(meta, ttl_hours):
+			remove_cache_entry(cache_directory, cache_key)
+			continue
+		if not is_cone_inside(ra, dec, radius_arcmin, meta['ra'], meta['dec'], meta['radius_arcmin']):
+			continue
+		if accept is not None and not accept(meta):
+			continue
+		if best_entry is None or meta['radius_arcmin'] < best_entry[1]['radius_arcmin']:
+			best_entry = (cache_key, meta)
+	return best_entry
+
+
+# Returns the response text of an entry, and marks it as recently used. Returns None if
+# the entry has been removed since it was found.
+def load_cached_response(cache_directory, cache_key):
+	response_filename, meta_filename = get_entry_filenames(cache_directory, cache_key)
+	try:
+		os.utime(meta_filename, None)
+		with open(response_filename, 'r') as f:
+			return f.read()
+	except (IOError, OSError):
+		return None
+
+
+# Saves a server's response to a cone search as an entry, then trims the cache to
+# max_cache_mb. extra_meta is saved along with it, for find_containing_entry's accept.
+def store_response(cache_directory, service, ra, dec, radius_arcmin, response_string,
+		extra_meta=None, max_cache_mb=DEFAULT_MAX_CACHE_MB):
+	if not os.path.isdir(cache_directory):
+		os.makedirs(cache_directory)
+	cache_key = get_cache_key(service, ra, dec, radius_arcmin)
+	response_filename, meta_filename = get_entry_filenames(cache_directory, cache_key)
+	meta = dict(extra_meta or {})
+	meta.update({'service': service, 'ra': float(ra), 'dec': float(dec),
+		'radius_arcmin': float(radius_arcmin), 'fetched_time': time.time(),
+		'n_bytes': len(response_string)})
+	# Write to temporary files and rename them into place, so that a half-written entry
+	# is never picked up.
+	file_descriptor, temp_filename = tempfile.mkstemp(dir=cache_directory, suffix='.tmp')
+	with os.fdopen(file_descriptor, 'w') as f:
+		f.write(response_string)
+	os.rename(temp_filename, response_filename)
+	file_descriptor, temp_filename = tempfile.mkstemp(dir=cache_directory, suffix='.tmp')
+	with os.fdopen(file_descriptor, 'w') as f:
+		json.dump(meta, f)
+	os.rename(temp_filename, meta_filename)
+	evict_query_cache(cache_directory, max_cache_mb=max_cache_mb)
+
+
+# Drops expired entries (with ttl_hours), then least recently used entries until the
+# cache is no bigger than max_cache_mb.
+def evict_query_cache(cache_directory, max_cache_mb=DEFAULT_MAX_CACHE_MB, ttl_hours=None):
+	entries = []
+	for cache_key, meta in list_cache_entries(cache_directory):
+		if ttl_hours is not None and is_entry_expired(meta, ttl_hours):
+			remove_cache_entry(cache_directory, cache_key)
+		else:
+			entries.append((cache_key, meta))
+	last_used = {}
+	for cache_key, meta in entries:
+		try:
+			last_used[cache_key] = os.path.getmtime(get_entry_filenames(cache_directory, cache_key)[1])
+		except OSError:
+			last_used[cache_key] = 0.
+	entries.sort(key=lambda entry: last_used[entry[0]])
+	n_bytes = sum([meta['n_bytes'] for (cache_key, meta) in entries])
+	for cache_key, meta in entries:
+		if n_bytes <= max_cache_mb * 1024 * 1024:
+			break
+		remove_cache_entry(cache_directory, cache_key)
+		n_bytes -= meta['n_bytes']
+		print 'query cache: evicted {} cone RA={} DEC={} Rad={}'.format(meta['service'], meta['ra'],
+			meta['dec'], meta['radius_arcmin'])
+
+
+def clear_query_cache(cache_directory):
+	for cache_key, meta in list_cache_entries(cache_directory):
+		remove_cache_entry(cache_directory, cache_key)
+
+
+if __name__ == "__main__":
+	# Get commandline arguments.
+	parser = argparse.ArgumentParser(description='Inspects, trims or clears a query cache.')
+	parser.add_argument('--directory', '-d', type=str, default=DEFAULT_QUERY_CACHE_DIRECTORY,
+                   help='cache directory')
+	parser.add_argument('--clear', action='store_true',
+                   help='drop every entry')
+	parser.add_argument('--ttl_hours', type=float, default=None,
+                   help='drop entries older than this')
+	parser.add_argument('--max_mb', type=float, default=DEFAULT_MAX_CACHE_MB,
+                   help='evict least recently used entries down to this size')
+	args = parser.parse_args()
+
+	if args.clear:
+		clear_query_cache(args.directory)
+	evict_query_cache(args.directory, max_cache_mb=args.max_mb, ttl_hours=args.ttl_hours)
+	for cache_key, meta in list_cache_entries(args.directory):
+		print '{}  {:<5} RA={} DEC={} Rad={}  {:.1f} h old  {:.1f} kB'.format(cache_key, meta['service'],
+			meta['ra'], meta['dec'], meta['radius_arcmin'], (time.time() - meta['fetched_time']) / 3600.,
+			meta['n_bytes'] / 1024.)
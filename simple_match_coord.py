@@ -2,6 +2,8 @@ from astropy.coordinates import match_coordinates_sky
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 import numpy as np
+import columnar_store
+import sky_index
 
 
 
@@ -10,8 +12,12 @@ import numpy as np
 
 
 
-def match_coordinates(match_RA, match_DEC, catalog_RA, catalog_DEC):
-	
+# engine='numpy' matches with sky_index.match_coordinates_sky_numpy instead, which skips
+# building SkyCoords and returns the same idx, sep2d, dist3d.
+def match_coordinates(match_RA, match_DEC, catalog_RA, catalog_DEC, engine='astropy'):
+	if engine == 'numpy':
+		return sky_index.match_coordinates_sky_numpy(match_RA, match_DEC, catalog_RA, catalog_DEC)
+
 	matchcoord = SkyCoord(ra=match_RA * u.degree, dec=match_DEC * u.degree)
 	catalogcoord = SkyCoord(ra=catalog_RA * u.degree, 
 		dec=catalog_DEC * u.degree)
@@ -24,8 +30,13 @@ def match_coordinates(match_RA, match_DEC, catalog_RA, catalog_DEC):
 
 
 
+# Also reads columnar stores (see columnar_store.py), loading only the two columns.
 def get_RA_DEC_from_CSV(csv_filename, RA_column_name, DEC_column_name):
-	recarray = np.recfromcsv(csv_filename)
+	if columnar_store.is_columnar_store(csv_filename):
+		recarray = columnar_store.read_columnar_store(csv_filename,
+			[RA_column_name, DEC_column_name], lowercase_names=True)
+	else:
+		recarray = np.recfromcsv(csv_filename)
 	RA = recarray[RA_column_name]
 	DEC = recarray[DEC_column_name]
 
@@ -0,0 +1,163 @@
+import cPickle as pickle
+import hashlib
+import os
+import time
+
+from astropy.coordinates import Angle, SkyCoord, match_coordinates_sky
+from astropy import units as u
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# Helpers for doing sky matches with a plain k-d tree: RA/DEC are turned into 3D unit
+# vectors, and angular separations into straight-line (chord) distances between them,
+# which is the same ordering the tree's Euclidean distance uses.
+
+# Returns an (N, 3) array of unit vectors for RA/DEC given in degrees.
+def radec_to_unit_vectors(ra, dec, dtype=np.float64):
+	ra_rad = np.radians(np.asarray(ra, dtype=np.float64))
+	dec_rad = np.radians(np.asarray(dec, dtype=np.float64))
+	cos_dec = np.cos(dec_rad)
+	xyz = np.empty((len(ra_rad), 3), dtype=dtype)
+	xyz[:, 0] = cos_dec * np.cos(ra_rad)
+	xyz[:, 1] = cos_dec * np.sin(ra_rad)
+	xyz[:, 2] = np.sin(dec_rad)
+	return xyz
+
+
+# Chord length between two unit vectors separated by the given angle (arcseconds).
+def arcsec_to_chord(arcsec):
+	return 2. * np.sin(np.radians(np.asarray(arcsec, dtype=np.float64) / 3600.) / 2.)
+
+
+# Angle (arcseconds) between two unit vectors separated by the given chord length.
+def chord_to_arcsec(chord):
+	return np.degrees(2. * np.arcsin(np.clip(np.asarray(chord, dtype=np.float64) / 2., 0., 1.))) * 3600.
+
+
+# Returns a checksum of a set of coordinates, used to tell whether a saved tree still
+# belongs to the catalog it's being loaded for.
+def get_coordinate_checksum(ra, dec):
+	oHash = hashlib.md5()
+	for array in (ra, dec):
+		oHash.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+	return oHash.hexdigest()
+
+
+# Saved trees are pickled along with this number; one saved in another format (e.g.
+# before sky_tree had a dtype) is rebuilt instead of loaded. Bump it when sky_tree's
+# attributes change.
+SKY_TREE_FORMAT_VERSION = 2
+
+
+# A k-d tree over the unit vectors of a catalog's RA/DEC, built once and then reused
+# for every lookup. It can be saved to disk (e.g. next to the catalog file) and loaded
+# back instead of being rebuilt; see load_or_build_sky_tree.
+# With dtype=np.float32 the unit vectors are rounded to float32 (good to ~0.02 arcsec)
+# before the tree is built over them.
+class sky_tree(object):
+	def __init__(self, ra, dec, dtype=np.float64):
+		self.n_objects = len(ra)
+		self.dtype = dtype
+		self.checksum = get_coordinate_checksum(ra, dec)
+		self.tree = cKDTree(radec_to_unit_vectors(ra, dec, dtype=dtype))
+
+	# Finds the k nearest catalog objects of each given position. ra/dec may be scalars
+	# or arrays. Returns (indices into the catalog, separations in arcsec), shaped like
+	# cKDTree.query's output. Beyond max_arcsec_sep, indices are n_objects and
+	# separations are inf.
+	def query(self, ra, dec, k=1, max_arcsec_sep=None):
+		xyz = radec_to_unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec), dtype=self.dtype)
+		if max_arcsec_sep is None:
+			chord, indices = self.tree.query(xyz, k=k)
+		else:
+			chord, indices = self.tree.query(xyz, k=k,
+				distance_upper_bound=arcsec_to_chord(max_arcsec_sep))
+		return indices, np.where(np.isinf(chord), np.inf, chord_to_arcsec(np.where(
+			np.isinf(chord), 0., chord)))
+
+	def save(self, filename):
+		with open(filename, 'wb') as f:
+			pickle.dump((SKY_TREE_FORMAT_VERSION, self), f, pickle.HIGHEST_PROTOCOL)
+
+
+# Loads the sky_tree saved in index_filename if it's in the current format and was built
+# from these exact coordinates; otherwise builds a new one (and saves it there, if a
+# filename is given).
+def load_or_build_sky_tree(ra, dec, index_filename=None):
+	if index_filename and os.path.exists(index_filename):
+		with open(index_filename, 'rb') as f:
+			saved = pickle.load(f)
+		if not (isinstance(saved, tuple) and saved[0] == SKY_TREE_FORMAT_VERSION):
+			print 'sky index {} is in an old format; rebuilding.'.format(index_filename)
+		elif saved[1].n_objects == len(ra) and saved[1].checksum == get_coordinate_checksum(ra, dec):
+			return saved[1]
+		else:
+			print 'sky index {} is out of date; rebuilding.'.format(index_filename)
+	tree = sky_tree(ra, dec)
+	if index_filename:
+		tree.save(index_filename)
+	return tree
+
+
+# Same as astropy's match_coordinates_sky for plain ICRS RA/DEC in degrees, without the
+# SkyCoord objects (and their unit and frame handling): for each match position, the
+# nthneighbor-th nearest catalog object. Returns (idx, sep2d, dist3d) like
+# match_coordinates_sky does: indices into the catalog, separations as an Angle, and
+# distances on the unit sphere. A sky_tree already built over the catalog can be passed
+# in as tree, in which case catalog_ra/catalog_dec are not used; otherwise one is built
+# with the given dtype.
+def match_coordinates_sky_numpy(match_ra, match_dec, catalog_ra, catalog_dec, nthneighbor=1,
+		dtype=np.float64, tree=None):
+	if tree is None:
+		if len(catalog_ra) == 0:
+			raise BaseException('The catalog for coordinate matching cannot be empty.')
+		tree = sky_tree(catalog_ra, catalog_dec, dtype=dtype)
+	indices, sep_arcsec = tree.query(match_ra, match_dec, k=nthneighbor)
+	if nthneighbor > 1:
+		indices, sep_arcsec = indices[:, -1], sep_arcsec[:, -1]
+	return (indices, Angle(sep_arcsec / 3600., unit=u.degree),
+		u.Quantity(arcsec_to_chord(sep_arcsec), unit=u.dimensionless_unscaled))
+
+
+# Checks match_coordinates_sky_numpy against astropy's match_coordinates_sky on random
+# positions (poles and the RA wrap included), in float64 and float32, and prints the
+# timings. Indices must agree except where two catalog objects are equally near to
+# within the tolerance; separations must agree to within it (arcsec).
+def test_match_against_astropy(n_catalog=200000, n_match=100000,
+		tolerances={np.float64: 1e-6, np.float32: 0.05}):
+	np.random.seed(0)
+	catalog_ra = np.random.uniform(0., 360., n_catalog)
+	catalog_dec = np.degrees(np.arcsin(np.random.uniform(-1., 1., n_catalog)))
+	match_ra = np.concatenate([np.random.uniform(0., 360., n_match - 4), [0., 359.9999999, 12., 200.]])
+	match_dec = np.concatenate([np.degrees(np.arcsin(np.random.uniform(-1., 1., n_match - 4))),
+		[0., 0., 90., -90.]])
+
+	for nthneighbor in (1, 2):
+		start_time = time.time()
+		astropy_idx, astropy_sep2d, astropy_dist3d = match_coordinates_sky(
+			SkyCoord(ra=match_ra * u.degree, dec=match_dec * u.degree),
+			SkyCoord(ra=catalog_ra * u.degree, dec=catalog_dec * u.degree), nthneighbor=nthneighbor)
+		astropy_time = time.time() - start_time
+		astropy_sep = astropy_sep2d.arcsecond
+
+		for dtype, tolerance in sorted(tolerances.items()):
+			start_time = time.time()
+			idx, sep2d, dist3d = match_coordinates_sky_numpy(match_ra, match_dec, catalog_ra,
+				catalog_dec, nthneighbor=nthneighbor, dtype=dtype)
+			numpy_time = time.time() - start_time
+			sep = sep2d.arcsecond
+
+			assert idx.shape == astropy_idx.shape and sep2d.shape == astropy_sep2d.shape
+			sep_error = np.abs(sep - astropy_sep).max()
+			assert sep_error <= tolerance, sep_error
+			assert np.abs(dist3d.value - astropy_dist3d.value).max() <= arcsec_to_chord(tolerance) * 1.01
+			differ = idx != astropy_idx
+			# Where the picks differ, the two candidates must be equally near.
+			other_sep = np.degrees(2. * np.arcsin(np.linalg.norm(
+				radec_to_unit_vectors(match_ra[differ], match_dec[differ]) -
+				radec_to_unit_vectors(catalog_ra[idx[differ]], catalog_dec[idx[differ]]), axis=1) / 2.)) * 3600.
+			assert np.all(np.abs(other_sep - astropy_sep[differ]) <= tolerance)
+			print 'nthneighbor={} {}: max sep difference {:.2e} arcsec, {} index ties; astropy {:.2f} s, numpy {:.2f} s ({:.1f}x)'.format(
+				nthneighbor, np.dtype(dtype).name, sep_error, differ.sum(), astropy_time, numpy_time,
+				astropy_time / numpy_time)
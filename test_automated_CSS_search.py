@@ -0,0 +1,456 @@
+import BaseHTTPServer
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urlparse
+
+import numpy as np
+
+from automated_CSS_search import (CSC_FOOTER_LINES, CSC_HEADER_LINES, SQL_OPERATORS,
+	evaluate_filter_spec, filter_CSS_candidates, format_SDSS_CSV,
+	get_SQL_where, get_candidates, http_connection_pool, load_CSC_SDSS_CSV, load_SDSS_data,
+	make_CSS_filter_spec, merge_target_cones, parse_CSC_CSV, parse_SDSS_CSV, read_targets,
+	run_batch)
+import photometry_store
+import query_cache
+
+
+# Checks of automated_CSS_search against a local stand-in for the SDSS and CSC servers,
+# so they run without the network:
+# $ python test_automated_CSS_search.py
+
+# A stand-in for the SDSS x_sql.asp endpoint and the CSC crossmatch, for testing without
+# the network. It answers POSTed 'SELECT ... WHERE objID IN (...)' queries with the
+# matching rows of its CSV table (server.sHeader, server.photometry_lines: {objID: CSV
+# line}), and GET cone searches with a CSC-style html table of the objects in the cone,
+# over keep-alive HTTP/1.1. It counts the queries and client connections it sees.
+class fake_SDSS_request_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# Send each answer in one go, rather than headers and body in separate packets.
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		values = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+		photometry = self.server.photometry
+		aInside = query_cache.get_separation_arcsec(photometry['ra'], photometry['dec'],
+			float(values['ra_cone'][0]), float(values['dec_cone'][0])) <= float(values['radius_cone'][0]) * 60.
+		lLines = ['<html>'] + ['<!-- CSC-SDSS crossmatch stand-in -->'] * (CSC_HEADER_LINES - 1) + \
+			['<pre>name\tra\tdec\tobjid', 'char\tdouble\tdouble\tlong'] + \
+			['CXO J{}\t{!r}\t{!r}\t{}'.format(index, row['ra'], row['dec'], row['objID'])
+				for (index, row) in enumerate(photometry[aInside])] + \
+			['</pre>'] + ['<!-- -->'] * (CSC_FOOTER_LINES - 2) + ['</html>']
+		with self.server.lock:
+			self.server.n_CSC_queries += 1
+		self.send_answer('\n'.join(lLines) + '\n', 'text/html')
+
+	def do_POST(self):
+		values = urlparse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+		oMatch = re.search(r'objID IN \(([^)]*)\)(?: AND (.*))?$', values['cmd'][0])
+		lObjIDs = oMatch.group(1).split(',')
+		time.sleep(self.server.delay)
+		lLines = [self.server.photometry_lines[long(objID)] for objID in lObjIDs
+			if long(objID) in self.server.photometry_lines]
+		if oMatch.group(2):
+			# Read the conditions back into a filter spec, and apply it.
+			dOperators = dict((sSQL, sOperator) for (sOperator, sSQL) in SQL_OPERATORS.items())
+			filter_spec = []
+			for sTerm in oMatch.group(2).split(' AND '):
+				sColumn, sOtherColumn, sSQL, sValue = re.match(r'^\(?(\w+)(?: - (\w+)\))? (\S+) (\S+)$',
+					sTerm).groups()
+				filter_spec.append(('-'.join(filter(None, [sColumn, sOtherColumn])), dOperators[sSQL],
+					float(sValue)))
+			rows = parse_SDSS_CSV('\n'.join([self.server.sHeader] + lLines))
+			lLines = [sLine for (sLine, bPass) in zip(lLines, evaluate_filter_spec(rows, filter_spec))
+				if bPass]
+		with self.server.lock:
+			self.server.n_objects_queried += len(lObjIDs)
+			self.server.n_rows_returned += len(lLines)
+		sBody = '\n'.join([self.server.sHeader] + lLines) + '\n'
+		with self.server.lock:
+			self.server.n_queries += 1
+			self.server.client_addresses.add(self.client_address)
+		self.send_answer(sBody, 'text/plain')
+
+	def send_answer(self, sBody, sContentType):
+		self.send_response(200)
+		self.send_header('Content-Type', sContentType)
+		self.send_header('Content-Length', str(len(sBody)))
+		self.end_headers()
+		self.wfile.write(sBody)
+
+	def log_message(self, *args):
+		pass
+
+
+class fake_SDSS_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+# Starts a fake_SDSS_server on a free local port, in a background thread. photometry is a
+# recarray with the columns of create_SQL_query. delay (s) is added to every answer.
+# Returns (server, its x_sql.asp URL); its CSC crossmatch URL is the same (it answers
+# GETs at any path). Call server.shutdown() when done.
+def start_fake_SDSS_server(photometry, delay=0.):
+	server = fake_SDSS_server(('127.0.0.1', 0), fake_SDSS_request_handler)
+	server.photometry = photometry
+	server.n_CSC_queries = 0
+	server.n_objects_queried = 0
+	server.n_rows_returned = 0
+	server.sHeader = ','.join(photometry.dtype.names)
+	server.photometry_lines = dict((long(row[0]), ','.join([str(value) for value in row]))
+		for row in photometry.tolist())
+	server.delay = delay
+	server.n_queries = 0
+	server.client_addresses = set()
+	server.lock = threading.Lock()
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return server, 'http://127.0.0.1:{}/x_sql.asp'.format(server.server_address[1])
+
+
+# Random photometry rows, shaped like the answer to create_SQL_query.
+def make_fake_SDSS_photometry(n_objects, ra=187.70593, dec=12.39112):
+	np.random.seed(0)
+	return np.rec.fromarrays([587722981736000000 + np.arange(n_objects),
+		ra + np.random.uniform(-1., 1., n_objects), dec + np.random.uniform(-1., 1., n_objects)] +
+		[np.round(np.random.uniform(14., 22., n_objects), 5) for band in 'ugriz'] +
+		[np.round(np.random.uniform(0., 10., n_objects), 5), np.random.choice([3, 6], n_objects)],
+		names='objID,ra,dec,u,g,r,i,z,petroRad_r,type')
+
+
+# Checks load_SDSS_data against a stand-in server: the merged recarray must hold exactly
+# the requested objects that exist, batches must reuse the pooled connections, and with
+# a per-query delay (and more batches than connections) the batches must overlap in time.
+def test_load_SDSS_data(n_objects=5000, batch_size=300, n_connections=4, delay=0.2):
+	photometry = make_fake_SDSS_photometry(n_objects)
+	server, sURL = start_fake_SDSS_server(photometry, delay=delay)
+	sDirectory = tempfile.mkdtemp(prefix='sdss_test_')
+	try:
+		# Every other object, plus some that SDSS doesn't have.
+		lObjIDs = list(photometry['objID'][::2]) + [1, 2, 3]
+		start_time = time.time()
+		sdss_rec_array = load_SDSS_data(lObjIDs, 0., 0., 0.,
+			{'SDSS_data': os.path.join(sDirectory, 'SDSS_data.csv')},
+			batch_size=batch_size, n_connections=n_connections, sURL=sURL)
+		elapsed_time = time.time() - start_time
+
+		n_batches = -(-len(lObjIDs) // batch_size)
+		assert np.array_equal(sdss_rec_array['objid'], photometry['objID'][::2])
+		for column_name in ['ra', 'dec', 'i', 'petroRad_r', 'type']:
+			assert np.allclose(sdss_rec_array[column_name.lower()], photometry[column_name][::2])
+		assert server.n_queries == n_batches
+		assert len(server.client_addresses) <= n_connections
+		if delay and n_batches > n_connections:
+			assert elapsed_time < n_batches * delay
+		print '{} batches over {} connection(s) in {:.2f} s ({:.2f} s if sent one by one).'.format(
+			n_batches, len(server.client_addresses), elapsed_time, n_batches * delay)
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks the query cache against a stand-in server: a search is fetched once; searching
+# it again, or a smaller cone inside it, needs no server and gives the same objects as
+# fetching that cone would; once the entries have expired, the servers are asked again.
+def test_query_cache(n_objects=5000, ra=187.70593, dec=12.39112, radius=40., small_radius=15.):
+	photometry = make_fake_SDSS_photometry(n_objects, ra=ra, dec=dec)
+	server, sURL = start_fake_SDSS_server(photometry)
+	sDirectory = tempfile.mkdtemp(prefix='query_cache_test_')
+	sCacheDirectory = os.path.join(sDirectory, 'query_cache')
+	oFileNames = {'CSC_data': os.path.join(sDirectory, 'CSC_data.csv'),
+		'SDSS_data': os.path.join(sDirectory, 'SDSS_data.csv')}
+
+	def search(search_ra, search_dec, search_radius, cache_directory=sCacheDirectory,
+			ttl_hours=query_cache.DEFAULT_TTL_HOURS):
+		CSC_objID_list = parse_CSC_CSV(load_CSC_SDSS_CSV(search_ra, search_dec, search_radius,
+			cache_directory=cache_directory, ttl_hours=ttl_hours, sURL=sURL), oFileNames)
+		return load_SDSS_data(CSC_objID_list, search_ra, search_dec, search_radius, oFileNames,
+			sURL=sURL, cache_directory=cache_directory, ttl_hours=ttl_hours)
+
+	# Whether each server was asked anything since the last call.
+	tLastCounts = [(0, 0)]
+	def were_servers_queried():
+		tCounts = (server.n_CSC_queries, server.n_queries)
+		bQueried = tuple([now > then for (now, then) in zip(tCounts, tLastCounts[0])])
+		tLastCounts[0] = tCounts
+		return bQueried
+
+	try:
+		sdss_rec_array = search(ra, dec, radius)
+		assert were_servers_queried() == (True, True)
+		assert np.array_equal(search(ra, dec, radius), sdss_rec_array)
+		assert were_servers_queried() == (False, False)
+
+		# A smaller cone, off-centre but inside the first.
+		small_ra, small_dec = ra + 0.2 / np.cos(np.radians(dec)), dec - 0.1
+		sdss_small_rec_array = search(small_ra, small_dec, small_radius)
+		assert were_servers_queried() == (False, False)
+		assert 0 < len(sdss_small_rec_array) < len(sdss_rec_array)
+		fetched_rec_array = search(small_ra, small_dec, small_radius, cache_directory=None)
+		assert np.array_equal(np.sort(sdss_small_rec_array['objid']), np.sort(fetched_rec_array['objid']))
+		were_servers_queried()
+
+		# A cone that sticks out of the cached one, and expired entries.
+		search(ra, dec, radius + 1.)
+		assert were_servers_queried() == (True, True)
+		search(ra, dec, radius, ttl_hours=0.)
+		assert were_servers_queried() == (True, True)
+		print 'query cache: OK ({} objects in the big cone, {} in the small one).'.format(
+			len(sdss_rec_array), len(sdss_small_rec_array))
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks the photometry store against a stand-in server: after a sweep of neighbouring
+# fields, a search overlapping them only asks SDSS for objects none of them covered, a
+# search inside them asks for nothing, and the answers match fetching everything.
+def test_photometry_store(n_objects=5000, ra=187.70593, dec=12.39112, radius=20.):
+	photometry = make_fake_SDSS_photometry(n_objects, ra=ra, dec=dec)
+	server, sURL = start_fake_SDSS_server(photometry)
+	sDirectory = tempfile.mkdtemp(prefix='photometry_store_test_')
+	sStoreDirectory = os.path.join(sDirectory, 'photometry_store')
+	oFileNames = {'CSC_data': os.path.join(sDirectory, 'CSC_data.csv'),
+		'SDSS_data': os.path.join(sDirectory, 'SDSS_data.csv')}
+
+	def search(search_ra, search_dec, store_directory=sStoreDirectory, filter_spec=None):
+		CSC_objID_list = parse_CSC_CSV(load_CSC_SDSS_CSV(search_ra, search_dec, radius, sURL=sURL),
+			oFileNames)
+		n_objects_queried = server.n_objects_queried
+		sdss_rec_array = load_SDSS_data(CSC_objID_list, search_ra, search_dec, radius, oFileNames,
+			sURL=sURL, store_directory=store_directory, filter_spec=filter_spec)
+		return np.sort(sdss_rec_array, order='objid'), server.n_objects_queried - n_objects_queried
+
+	try:
+		# A sweep of fields 0.5 deg apart (radius 20 arcmin, so they overlap).
+		lFields = [(ra + dra / np.cos(np.radians(dec)), dec + ddec)
+			for dra in (-0.25, 0.25) for ddec in (-0.25, 0.25)]
+		lQueried = [search(field_ra, field_dec)[1] for (field_ra, field_dec) in lFields]
+		sdss_rec_array, n_queried = search(ra, dec)
+		assert n_queried < min(lQueried)
+		sdss_rec_array, n_queried = search(ra + 0.1, dec + 0.1)
+		assert n_queried == 0
+		fetched_rec_array, n_queried = search(ra + 0.1, dec + 0.1, store_directory=None)
+		for column_name in fetched_rec_array.dtype.names:
+			assert np.array_equal(sdss_rec_array[column_name], fetched_rec_array[column_name])
+
+		# The store persists, and objIDs SDSS doesn't have are remembered.
+		photometry_store.open_stores.clear()
+		store = photometry_store.get_photometry_store(sStoreDirectory)
+		stored_rows, aObjIDsToFetch = store.lookup(list(sdss_rec_array['objid']) + [2])
+		assert len(stored_rows) == len(sdss_rec_array) and list(aObjIDsToFetch) == [2]
+		store.add(parse_SDSS_CSV(format_SDSS_CSV(stored_rows[:0])), [2])
+		assert len(store.lookup([2])[1]) == 0
+
+		# With the cuts pushed down to SDSS, the objects they reject are remembered for those
+		# cuts only: searching a field again with them needs no SDSS request, and they're
+		# not taken to be missing from SDSS.
+		filter_spec = make_CSS_filter_spec()
+		far_ra, far_dec = ra + 1.2 / np.cos(np.radians(dec)), dec
+		filtered_rec_array, n_queried = search(far_ra, far_dec, filter_spec=filter_spec)
+		assert n_queried > len(filtered_rec_array)
+		assert search(far_ra, far_dec, filter_spec=filter_spec)[1] == 0
+		assert search(far_ra + 0.05, far_dec, filter_spec=filter_spec)[1] < n_queried / 4
+		photometry_store.open_stores.clear()
+		unfiltered_rec_array, n_unfiltered_queried = search(far_ra, far_dec)
+		assert n_unfiltered_queried == n_queried - len(filtered_rec_array)
+		assert set(filtered_rec_array['objid']) < set(unfiltered_rec_array['objid'])
+		print 'photometry store: OK (fields needed {} objects each; a field overlapping them {}).'.format(
+			lQueried, search(ra, dec + 0.3)[1])
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks batch mode against a stand-in server that takes delay seconds per request:
+# heavily overlapping targets are merged, every target gets the same candidates as
+# searching it on its own would, and the batch takes about as long as its slowest cone
+# rather than the sum of all of them.
+def test_batch(n_objects=20000, ra=187.70593, dec=12.39112, delay=0.2):
+	photometry = make_fake_SDSS_photometry(n_objects, ra=ra, dec=dec)
+	# Make a good share of the objects pass filter_CSS_candidates.
+	photometry['type'][::2] = 3
+	photometry['i'][::2] = 17.
+	photometry['g'][::2] = 18.
+	photometry['petroRad_r'][::2] = 3.
+	server, sURL = start_fake_SDSS_server(photometry, delay=delay)
+	sDirectory = tempfile.mkdtemp(prefix='batch_test_')
+	try:
+		# Eight separate fields, and two targets that sit inside two of them.
+		lTargets = [('field{}'.format(index), ra + dra / np.cos(np.radians(dec)), dec + ddec, 8.)
+			for (index, (dra, ddec)) in enumerate([(dra, ddec) for dra in (-0.6, -0.2, 0.2, 0.6)
+				for ddec in (-0.3, 0.3)])]
+		lTargets += [('inner0', lTargets[0][1] + 0.02, lTargets[0][2], 4.),
+			('inner5', lTargets[5][1], lTargets[5][2] - 0.02, 5.)]
+		with open(os.path.join(sDirectory, 'targets.txt'), 'w') as f:
+			f.write('# ra dec angle name\n')
+			for sName, target_ra, target_dec, angle in lTargets:
+				f.write('{!r} {!r} {} {}\n'.format(target_ra, target_dec, angle, sName))
+		lTargets = read_targets(os.path.join(sDirectory, 'targets.txt'))
+		assert len(merge_target_cones(lTargets)) == 8
+
+		n_requests = server.n_CSC_queries + server.n_queries
+		start_time = time.time()
+		lResults = run_batch(lTargets, os.path.join(sDirectory, 'batch'),
+			cache_directory=os.path.join(sDirectory, 'query_cache'),
+			store_directory=os.path.join(sDirectory, 'photometry_store'), sCSC_URL=sURL, sSDSS_URL=sURL)
+		elapsed_time = time.time() - start_time
+		n_requests = server.n_CSC_queries + server.n_queries - n_requests
+		assert all([sError is None for (index, candidates, oFileNames, sError) in lResults])
+
+		# Compare with the targets searched one by one, with nothing cached.
+		for index, candidates, oFileNames, sError in lResults:
+			sName, target_ra, target_dec, angle = lTargets[index]
+			single_candidates = get_candidates(target_ra, target_dec, angle,
+				output_directory=os.path.join(sDirectory, 'single'),
+				CSC_pool=http_connection_pool(sURL, 1), SDSS_pool=http_connection_pool(sURL, 1))
+			assert np.array_equal(np.sort(candidates['objid']), np.sort(single_candidates['objid']))
+		with open(os.path.join(sDirectory, 'batch', 'all_candidates.csv'), 'r') as f:
+			assert len(f.readlines()) == 1 + sum([len(tResult[1]) for tResult in lResults])
+		assert os.path.exists(os.path.join(sDirectory, 'batch', 'index.html'))
+		print 'batch: {} targets, {} requests in {:.2f} s ({:.2f} s if sent one by one).'.format(
+			len(lTargets), n_requests, elapsed_time, n_requests * delay)
+		assert elapsed_time < n_requests * delay / 2.
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# The row-by-row version of filter_CSS_candidates, which the vectorized one must match.
+def filter_CSS_candidates_original(SDSS_data_recarray, oFileNames, petroRadRange=(0.,6.), 
+		i_mag_range=(15.,19.4), color_range=(0.7, 1.3)):
+
+	def IsObjectInCSSRegime(SDSS_object_line, petroRadRange=petroRadRange,
+		i_mag_range=i_mag_range, color_range=color_range):
+		g_mag = SDSS_object_line['g']
+		i_mag = SDSS_object_line['i']
+		g_i = g_mag - i_mag
+		petroRad_r = SDSS_object_line['petrorad_r']
+		object_type = SDSS_object_line['type']
+		return ((i_mag > i_mag_range[0]) & (i_mag < i_mag_range[1])
+			& (g_i > color_range[0]) & (g_i < color_range[1])
+			& (object_type == 3) 
+			& (petroRadRange[0] < petroRad_r) & (petroRad_r < petroRadRange[1]))
+
+	# similar functionality to numpy.where(), but I find this more readable.
+	CSS_candidate_indices = []
+	for index, line_content in enumerate(SDSS_data_recarray):
+		if IsObjectInCSSRegime(line_content):
+			CSS_candidate_indices.append(index)
+
+	print "After filtering, {} CSS candidate(s) remain.".format(len(CSS_candidate_indices))
+	return SDSS_data_recarray[CSS_candidate_indices]
+
+
+# Checks the vectorized filter against the row-by-row one on random photometry, and that
+# pushing the filter down to a stand-in SDSS server gives the same candidates while
+# transferring only the objects that pass.
+def test_filter_spec(n_objects=200000, ra=187.70593, dec=12.39112, radius=20.):
+	photometry = make_fake_SDSS_photometry(n_objects, ra=ra, dec=dec)
+	photometry['g'] = photometry['i'] + np.random.uniform(0., 2., n_objects)
+	sdss_rec_array = parse_SDSS_CSV(format_SDSS_CSV(photometry_store.to_photometry_rows(
+		np.rec.fromarrays([photometry[name] for name in photometry.dtype.names],
+		names=[name.lower() for name in photometry.dtype.names]))))
+
+	start_time = time.time()
+	original_candidates = filter_CSS_candidates_original(sdss_rec_array, {})
+	original_time = time.time() - start_time
+	start_time = time.time()
+	candidates = filter_CSS_candidates(sdss_rec_array, {})
+	vectorized_time = time.time() - start_time
+	assert np.array_equal(candidates, original_candidates) and len(candidates)
+	print 'filter: {} rows in {:.3f} s, row by row {:.2f} s ({:.0f}x).'.format(n_objects,
+		vectorized_time, original_time, original_time / max(vectorized_time, 1e-9))
+	print 'SQL: ' + get_SQL_where(make_CSS_filter_spec())
+
+	server, sURL = start_fake_SDSS_server(photometry[:20000])
+	sDirectory = tempfile.mkdtemp(prefix='filter_test_')
+	try:
+		lResults = []
+		for push_down_filter in (False, True):
+			n_rows_returned = server.n_rows_returned
+			candidates = get_candidates(ra, dec, radius,
+				store_directory=os.path.join(sDirectory, 'store_{}'.format(push_down_filter)),
+				output_directory=os.path.join(sDirectory, str(push_down_filter)),
+				CSC_pool=http_connection_pool(sURL, 1), SDSS_pool=http_connection_pool(sURL, 1),
+				push_down_filter=push_down_filter)
+			lResults.append((np.sort(candidates['objid']), server.n_rows_returned - n_rows_returned))
+		assert np.array_equal(lResults[0][0], lResults[1][0])
+		assert lResults[1][1] == len(lResults[1][0]) < lResults[0][1]
+		print 'push-down: {} rows transferred instead of {}, same {} candidates.'.format(lResults[1][1],
+			lResults[0][1], len(lResults[0][0]))
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks that a field where nothing passes the cuts gives no candidates rather than an
+# error, both with the cuts applied by SDSS (which then answers with just a header) and
+# locally, and that batch mode reports such a target as having 0 candidates.
+def test_empty_SDSS_answer(n_objects=2000, ra=187.70593, dec=12.39112, radius=20.):
+	photometry = make_fake_SDSS_photometry(n_objects, ra=ra, dec=dec)
+	photometry['type'] = 6
+	server, sURL = start_fake_SDSS_server(photometry)
+	sDirectory = tempfile.mkdtemp(prefix='empty_answer_test_')
+	try:
+		assert len(evaluate_filter_spec(parse_SDSS_CSV('objID,ra\n'), make_CSS_filter_spec())) == 0
+		for push_down_filter in (True, False):
+			candidates = get_candidates(ra, dec, radius,
+				output_directory=os.path.join(sDirectory, str(push_down_filter)),
+				CSC_pool=http_connection_pool(sURL, 1), SDSS_pool=http_connection_pool(sURL, 1),
+				push_down_filter=push_down_filter)
+			assert len(candidates) == 0 and 'petrorad_r' in candidates.dtype.names
+		lResults = run_batch([('empty', ra, dec, radius)], os.path.join(sDirectory, 'batch'),
+			sCSC_URL=sURL, sSDSS_URL=sURL,
+			push_down_filter=True)
+		assert lResults[0][3] is None and len(lResults[0][1]) == 0
+		print 'empty SDSS answer: OK.'
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks that searching caches nothing unless asked to, and that get_candidates returns
+# just the candidates unless asked for the file names too.
+def test_no_cache_by_default(n_objects=2000, ra=187.70593, dec=12.39112, radius=20.):
+	server, sURL = start_fake_SDSS_server(make_fake_SDSS_photometry(n_objects, ra=ra, dec=dec))
+	sDirectory = tempfile.mkdtemp(prefix='no_cache_test_')
+	sWorkingDirectory = os.getcwd()
+	try:
+		os.chdir(sDirectory)
+		candidates = get_candidates(ra, dec, radius, CSC_pool=http_connection_pool(sURL, 1),
+			SDSS_pool=http_connection_pool(sURL, 1))
+		assert isinstance(candidates, np.ndarray)
+		assert not os.path.exists(query_cache.DEFAULT_QUERY_CACHE_DIRECTORY)
+		assert not os.path.exists(photometry_store.DEFAULT_PHOTOMETRY_STORE_DIRECTORY)
+		candidates, oFileNames = get_candidates(ra, dec, radius, CSC_pool=http_connection_pool(sURL, 1),
+			SDSS_pool=http_connection_pool(sURL, 1), return_file_names=True)
+		assert os.path.exists(oFileNames['webpage'])
+		print 'no cache by default: OK.'
+	finally:
+		os.chdir(sWorkingDirectory)
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	test_load_SDSS_data()
+	test_query_cache()
+	test_photometry_store()
+	test_batch()
+	test_filter_spec()
+	test_empty_SDSS_answer()
+	test_no_cache_by_default()
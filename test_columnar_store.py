@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from columnar_store import (chunk_may_match, columnar_store_writer, iter_columnar_store_chunks,
+	read_columnar_store, read_columnar_store_meta)
+
+
+# Checks of columnar_store on small made-up tables:
+# $ python test_columnar_store.py
+
+# Checks that a store written in blocks whose dtypes widen (longer strings, an int
+# column that gets floats) reads back as the whole table in its final dtypes, with and
+# without ranges, and that ranges skip the row groups their stats rule out.
+def test_round_trip(n_blocks=6, n_block_rows=250, chunk_rows=400):
+	sDirectory = tempfile.mkdtemp(prefix='columnar_store_test_')
+	sFileName = os.path.join(sDirectory, 'table.columnar')
+	try:
+		lBlocks = []
+		for index in range(n_blocks):
+			aRows = np.arange(index * n_block_rows, (index + 1) * n_block_rows)
+			lBlocks.append(OrderedDict([('ID', aRows),
+				('DEC', -30. + aRows * 0.01),
+				# Whole numbers at first, floats from the fourth block on.
+				('MAG', aRows % 7 if index < 3 else 20. + (aRows % 7) / 4.),
+				# Strings that get longer from block to block.
+				('NAME', np.array(['t{}'.format('x' * index) + str(row) for row in aRows]))]))
+		with columnar_store_writer(sFileName, chunk_rows=chunk_rows) as writer:
+			for block in lBlocks:
+				writer.append(block)
+
+		expected = OrderedDict((column_name, np.concatenate([block[column_name]
+			for block in lBlocks])) for column_name in lBlocks[0])
+		meta = read_columnar_store_meta(sFileName)
+		assert len(meta['chunks']) == -(-n_blocks * n_block_rows // chunk_rows)
+		assert [np.dtype(str(sDtype)) for sDtype in meta['dtypes']] == [np.dtype(np.int64),
+			np.dtype(np.float64), np.dtype(np.float64), expected['NAME'].dtype]
+
+		table = read_columnar_store(sFileName)
+		assert len(table) == len(expected['ID'])
+		for column_name in expected:
+			assert table[column_name].dtype == expected[column_name].dtype
+			assert np.array_equal(table[column_name], expected[column_name])
+		chunk_table = np.concatenate(list(iter_columnar_store_chunks(sFileName)))
+		for column_name in expected:
+			assert np.array_equal(chunk_table[column_name], expected[column_name])
+
+		# Column selection, and ranges on one column and on two.
+		table = read_columnar_store(sFileName, column_names=['NAME'])
+		assert table.dtype.names == ('NAME',)
+		for ranges in [[('DEC', -20., -10.)], [('DEC', -20., None), ('MAG', 21., 21.)],
+				[('DEC', 100., None)], [('dec', -30., -29.9)]]:
+			lowercase_names = ranges[0][0].islower()
+			upper_ranges = [(r[0].upper(),) + tuple(r[1:]) for r in ranges]
+			table = read_columnar_store(sFileName, ranges=ranges, lowercase_names=lowercase_names)
+			mask = np.ones(len(expected['ID']), dtype=bool)
+			for column_name, min_value, max_value in upper_ranges:
+				if min_value is not None:
+					mask &= expected[column_name] >= min_value
+				if max_value is not None:
+					mask &= expected[column_name] <= max_value
+			for column_name in expected:
+				output_name = column_name.lower() if lowercase_names else column_name
+				assert np.array_equal(table[output_name], expected[column_name][mask])
+			n_read = sum([chunk_may_match(chunk['stats'], upper_ranges) for chunk in meta['chunks']])
+			assert n_read < len(meta['chunks'])
+			assert mask.sum() <= n_read * chunk_rows
+		print 'columnar store round trip: OK ({} rows in {} row groups).'.format(
+			len(expected['ID']), len(meta['chunks']))
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	test_round_trip()
@@ -0,0 +1,223 @@
+import gzip
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import time
+
+import numpy as np
+
+from compressed_files import get_catalog_name
+from convert_megacam_to_csv import (append_cat_files_as_csv, convert_fw_line_to_csv,
+	get_csv_header_and_selection, get_manifest_filename, make_csv_file_from_file_list,
+	read_cat_column_names, update_csv_file_from_file_list, write_cat_rows_as_csv)
+
+
+# Checks of convert_megacam_to_csv on small made-up NGVS tiles:
+# $ python test_convert_megacam_to_csv.py
+
+# Columns of the made-up .cat files: (name, description, printf format).
+FAKE_CAT_COLUMNS = [('NUMBER', 'Running object number', '{:10d}'),
+	('ALPHA_J2000', 'Right ascension of barycenter (J2000) [deg]', '{:11.7f}'),
+	('DELTA_J2000', 'Declination of barycenter (J2000) [deg]', '{:+11.7f}'),
+	('MAG_AUTO', 'Kron-like elliptical aperture magnitude [mag]', '{:8.4f}'),
+	('FLUX_AUTO', 'Flux within a Kron-like elliptical aperture [count]', '{:12.5e}'),
+	('FLUXERR_AUTO', 'RMS error for AUTO flux [count]', '{:12.5e}'),
+	('FLAGS', 'Extraction flags', '{:3d}')]
+
+
+# Writes a made-up NGVS .cat file of n_rows sources scattered around (ra, dec), with the
+# '#' column header and right-aligned fixed-width columns of an NGVS tile. With
+# compress=True it is gzipped. seed picks the sources.
+def make_fake_cat_file(sFileName, n_rows, ra=187.7, dec=12.4, seed=0, compress=False):
+	np.random.seed(seed)
+	lColumns = [np.arange(1, n_rows + 1), ra + np.random.uniform(-0.5, 0.5, n_rows),
+		dec + np.random.uniform(-0.5, 0.5, n_rows), np.random.uniform(15., 27., n_rows),
+		10. ** np.random.uniform(0., 6., n_rows), 10. ** np.random.uniform(0., 3., n_rows),
+		np.random.randint(0, 20, n_rows)]
+	lLines = ['#{:4d} {:<22} {}\n'.format(index + 1, sName, sDescription)
+		for (index, (sName, sDescription, sFormat)) in enumerate(FAKE_CAT_COLUMNS)]
+	sRowFormat = ' '.join([sFormat for (sName, sDescription, sFormat) in FAKE_CAT_COLUMNS]) + '\n'
+	lLines.extend([sRowFormat.format(*lRow) for lRow in zip(*[aColumn.tolist() for aColumn in lColumns])])
+	f_out = gzip.open(sFileName, 'wb') if compress else open(sFileName, 'w')
+	with f_out:
+		f_out.write(''.join(lLines))
+	return sFileName
+
+
+# Returns the CSV rows the per-line regex converter gives for sFile, as the list of
+# their values (source_file last).
+def get_reference_rows(sFile):
+	lRows = []
+	f_in = gzip.open(sFile, 'rb') if sFile.endswith('.gz') else open(sFile, 'r')
+	with f_in:
+		for sLine in f_in:
+			if sLine[0] != '#':
+				lRows.append(convert_fw_line_to_csv(sLine).split(',') + [get_catalog_name(sFile)])
+	return lRows
+
+
+# Returns (header line, sorted data lines) of a CSV, so outputs whose rows come in a
+# different file order can be compared.
+def read_csv_sorted(sFileName):
+	with open(sFileName, 'r') as f:
+		lLines = f.readlines()
+	return lLines[0], sorted(lLines[1:])
+
+
+# Checks that the bulk parser writes exactly what the per-line regex converter writes
+# for a tile, plain and gzipped (named without the '.gz' in 'source_file'), and prints
+# the throughput (rows/s) of both.
+def test_bulk_parser(n_rows=20000):
+	sDirectory = tempfile.mkdtemp(prefix='bulk_parser_test_')
+	try:
+		for bCompress in (False, True):
+			sFile = make_fake_cat_file(os.path.join(sDirectory, 'NGVS+0+0.G.cat{}'.format(
+				'.gz' if bCompress else '')), n_rows, compress=bCompress)
+			start_time = time.time()
+			sReference = ''.join([','.join(lRow) + '\n' for lRow in get_reference_rows(sFile)])
+			reference_time = time.time() - start_time
+
+			start_time = time.time()
+			f_bulk = StringIO.StringIO()
+			nRows = write_cat_rows_as_csv(f_bulk, sFile, len(read_cat_column_names(sFile)))
+			bulk_time = time.time() - start_time
+
+			assert nRows == n_rows
+			assert f_bulk.getvalue() == sReference
+			assert sReference.endswith(',NGVS+0+0.G.cat\n')
+			print 'per-line regex: {:.0f} rows/s; bulk parser: {:.0f} rows/s.'.format(
+				nRows / max(reference_time, 1e-9), nRows / max(bulk_time, 1e-9))
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks that column_names and cuts keep exactly the columns and rows they should, in
+# one process and in several.
+def test_selection(n_rows=5000):
+	sDirectory = tempfile.mkdtemp(prefix='selection_test_')
+	try:
+		lFiles = [make_fake_cat_file(os.path.join(sDirectory, 'NGVS+{}+0.G.cat'.format(index)),
+			n_rows, ra=187.7 + index, seed=index) for index in range(3)]
+		column_names = ['DELTA_J2000', 'NUMBER', 'MAG_AUTO']
+		cuts = [('MAG_AUTO', 18., 24.5), ('ALPHA_J2000', 188., None)]
+		lColumnNames = read_cat_column_names(lFiles[0])
+		lIndices = [lColumnNames.index(column_name) for column_name in column_names]
+		lExpected = []
+		for sFile in lFiles:
+			for lRow in get_reference_rows(sFile):
+				if 18. <= float(lRow[3]) <= 24.5 and float(lRow[1]) >= 188.:
+					lExpected.append(','.join([lRow[index] for index in lIndices] + [lRow[-1]]) + '\n')
+		assert 0 < len(lExpected) < 3 * n_rows
+
+		for n_workers in (1, 2):
+			sOutputFileName = os.path.join(sDirectory, 'selected_{}.csv'.format(n_workers))
+			make_csv_file_from_file_list(sOutputFileName, lFiles, n_workers=n_workers,
+				column_names=column_names, cuts=cuts)
+			with open(sOutputFileName, 'r') as f:
+				assert f.readline() == 'DELTA_J2000,NUMBER,MAG_AUTO,source_file\n'
+				assert f.readlines() == lExpected
+		print 'selection: OK ({} of {} rows kept).'.format(len(lExpected), 3 * n_rows)
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks that an incrementally-updated CSV always has the same rows as a full rebuild
+# from the same tiles: after adding, changing and removing tiles, after a run that was
+# interrupted between appending a new tile's rows and writing the manifest, and when a
+# tile is swapped for its gzipped copy (which keeps its name in 'source_file' and in
+# the manifest).
+def test_incremental(n_rows=2000):
+	sDirectory = tempfile.mkdtemp(prefix='incremental_test_')
+	sTileDirectory = os.path.join(sDirectory, 'tiles')
+	os.makedirs(sTileDirectory)
+	sOutputFileName = os.path.join(sDirectory, 'incremental.csv')
+	sRebuiltFileName = os.path.join(sDirectory, 'rebuilt.csv')
+	cuts = [('MAG_AUTO', None, 25.)]
+
+	def tile(index):
+		return os.path.join(sTileDirectory, 'NGVS+{}+0.G.cat'.format(index))
+
+	def update_and_compare():
+		lFiles = sorted([os.path.join(sTileDirectory, sFile) for sFile in os.listdir(sTileDirectory)])
+		update_csv_file_from_file_list(sOutputFileName, lFiles, cuts=cuts)
+		make_csv_file_from_file_list(sRebuiltFileName, lFiles, cuts=cuts)
+		assert read_csv_sorted(sOutputFileName) == read_csv_sorted(sRebuiltFileName)
+		with open(get_manifest_filename(sOutputFileName), 'r') as f:
+			assert sorted(json.load(f)['files']) == sorted([get_catalog_name(sFile) for sFile in lFiles])
+		return lFiles
+
+	try:
+		for index in range(3):
+			make_fake_cat_file(tile(index), n_rows, ra=187.7 + index, seed=index)
+		update_and_compare()
+
+		# Added, changed (same size; mtime moved on) and removed tiles.
+		make_fake_cat_file(tile(3), n_rows, ra=190.7, seed=3)
+		update_and_compare()
+		make_fake_cat_file(tile(1), n_rows, ra=188.7, seed=11)
+		os.utime(tile(1), (time.time() + 10., time.time() + 10.))
+		update_and_compare()
+		os.remove(tile(0))
+		update_and_compare()
+
+		# A run that appended a new tile's rows but died before writing the manifest.
+		make_fake_cat_file(tile(4), n_rows, ra=191.7, seed=4)
+		sHeaderCSVline, nColumns, lColumnIndices, lCutIndices = get_csv_header_and_selection(
+			tile(4), cuts=cuts)
+		with open(sOutputFileName, 'a') as f_out:
+			append_cat_files_as_csv(f_out, [tile(4)], nColumns, lColumnIndices, lCutIndices)
+		update_and_compare()
+
+		# A tile swapped for its gzipped copy, and a new gzipped tile.
+		make_fake_cat_file(tile(2) + '.gz', n_rows, ra=189.7, seed=2, compress=True)
+		os.remove(tile(2))
+		make_fake_cat_file(tile(5) + '.gz', n_rows, ra=192.7, seed=5, compress=True)
+		update_and_compare()
+		sHeader, lLines = read_csv_sorted(sOutputFileName)
+		assert set([sLine.rstrip('\n').rsplit(',', 1)[-1] for sLine in lLines]) == set(
+			[os.path.basename(tile(index)) for index in (1, 2, 3, 4, 5)])
+
+		# Nothing changed: the CSV is left alone.
+		mtime = os.stat(sOutputFileName).st_mtime
+		os.utime(sOutputFileName, (mtime - 10., mtime - 10.))
+		update_and_compare()
+		assert abs(os.stat(sOutputFileName).st_mtime - (mtime - 10.)) < 1.
+		print 'incremental: OK ({} rows).'.format(len(lLines))
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks that a cut on a column that doesn't hold numbers is refused with the column's
+# name, before any output is written.
+def test_cut_on_text_column():
+	sDirectory = tempfile.mkdtemp(prefix='text_cut_test_')
+	try:
+		sFile = os.path.join(sDirectory, 'NGVS+0+0.G.cat')
+		with open(sFile, 'w') as f_out:
+			f_out.write('#   1 NUMBER                 Running object number\n'
+				'#   2 FIELD                  Field name\n'
+				'#   3 MAG_AUTO               Kron-like elliptical aperture magnitude [mag]\n'
+				'         1   NGVS+0+0  21.1234\n         2   NGVS+0+0  23.4567\n')
+		sOutputFileName = os.path.join(sDirectory, 'cut.csv')
+		make_csv_file_from_file_list(sOutputFileName, [sFile], cuts=[('MAG_AUTO', None, 22.)])
+		with open(sOutputFileName, 'r') as f:
+			assert f.read() == 'NUMBER,FIELD,MAG_AUTO,source_file\n1,NGVS+0+0,21.1234,NGVS+0+0.G.cat\n'
+		os.remove(sOutputFileName)
+		try:
+			make_csv_file_from_file_list(sOutputFileName, [sFile], cuts=[('FIELD', None, 1.)])
+		except BaseException as oError:
+			assert "'FIELD'" in str(oError)
+		else:
+			raise AssertionError('a cut on a text column was accepted')
+		assert not os.path.exists(sOutputFileName)
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	test_bulk_parser()
+	test_selection()
+	test_incremental()
+	test_cut_on_text_column()
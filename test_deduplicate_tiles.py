@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from deduplicate_tiles import deduplicate_csv_file
+import sky_index
+
+
+# Checks of deduplicate_tiles on made-up overlapping tiles:
+# $ python test_deduplicate_tiles.py
+
+CSV_HEADER = 'ALPHA_J2000,DELTA_J2000,FLUX_AUTO,FLUXERR_AUTO,source_file\n'
+
+
+def write_csv(sFileName, rows):
+	with open(sFileName, 'w') as f:
+		f.write(CSV_HEADER)
+		f.write(''.join(['{!r},{!r},{!r},{!r},{}\n'.format(*row) for row in rows]))
+
+
+# Returns the rows of a de-duplicated CSV as (ra, dec, flux, fluxerr, tile) tuples.
+def read_csv_rows(sFileName):
+	with open(sFileName, 'r') as f:
+		assert f.readline() == CSV_HEADER
+		return [tuple([float(s) for s in sLine.strip().split(',')[:4]] + [sLine.strip().split(',')[4]])
+			for sLine in f]
+
+
+# The rows deduplicate_csv_file should drop, found by comparing every pair of rows.
+def find_duplicates_brute_force(rows, radius_arcsec, keep):
+	ra, dec, flux, fluxerr = [np.array([row[index] for row in rows]) for index in range(4)]
+	tile = np.unique([row[4] for row in rows], return_inverse=True)[1]
+	xyz = sky_index.radec_to_unit_vectors(ra, dec)
+	if keep == 'snr':
+		score = flux / fluxerr
+	else:
+		tile_centres = np.array([xyz[tile == index].sum(axis=0) for index in range(tile.max() + 1)])
+		tile_centres /= np.linalg.norm(tile_centres, axis=1)[:, np.newaxis]
+		score = np.einsum('ij,ij->i', xyz, tile_centres[tile])
+	chord = np.linalg.norm(xyz[:, np.newaxis, :] - xyz[np.newaxis, :, :], axis=2)
+	i, j = np.nonzero(np.triu(chord <= sky_index.arcsec_to_chord(radius_arcsec), 1))
+	cross_tile = tile[i] != tile[j]
+	i, j = i[cross_tile], j[cross_tile]
+	# i < j, so on a tie the earlier row i wins.
+	dropped = np.zeros(len(rows), dtype=bool)
+	dropped[np.where(score[i] >= score[j], j, i)] = True
+	return dropped
+
+
+# Two tiles that overlap in RA, both crossing the dec = 10 zone boundary (for
+# zone_height_deg=0.5). Checks hand-placed cases for both keep rules, then checks random
+# rows against a brute-force search with zones far smaller than the tiles.
+def test_deduplicate(radius_arcsec=1.0):
+	sDirectory = tempfile.mkdtemp(prefix='dedup_test_')
+	sInputFileName = os.path.join(sDirectory, 'combined.csv')
+	sOutputFileName = os.path.join(sDirectory, 'dedup.csv')
+	arcsec = 1. / 3600.
+	try:
+		# Tile A spans RA 9.8-10.25 and tile B RA 10.19-10.6, so A's centre lies west of
+		# B's; the hand-placed sources sit where they overlap, near RA 10.2.
+		rows = [(9.8, 10.0, 1., 1., 'A.cat'), (10.0, 10.0, 1., 1., 'A.cat'),
+			(10.6, 10.0, 1., 1., 'B.cat'), (10.4, 10.0, 1., 1., 'B.cat'),
+			# 4/5: a cross-tile pair across the zone boundary; B has the better S/N, A is
+			# nearer its tile centre (RA 10.19 vs 10.19 + 0.4").
+			(10.19, 10. - 0.2 * arcsec, 100., 10., 'A.cat'), (10.19 + 0.4 * arcsec, 10. + 0.2 * arcsec,
+				300., 10., 'B.cat'),
+			# 6/7: two sources of the same tile, 0.5" apart: separate, never merged.
+			(10.2, 10.1, 100., 10., 'A.cat'), (10.2, 10.1 + 0.5 * arcsec, 50., 10., 'A.cat'),
+			# 8/9: a cross-tile pair 1.5" apart: outside the radius.
+			(10.21, 9.9, 100., 10., 'A.cat'), (10.21, 9.9 + 1.5 * arcsec, 50., 10., 'B.cat'),
+			# 10/11: a cross-tile pair with equal S/N, the earlier row wins; B's is also
+			# nearer its centre.
+			(10.25, 9.8, 100., 10., 'B.cat'), (10.25, 9.8 + 0.3 * arcsec, 100., 10., 'A.cat')]
+		write_csv(sInputFileName, rows)
+		for keep, lDropped in [('snr', [4, 11]), ('centre', [5, 11])]:
+			deduplicate_csv_file(sInputFileName, sOutputFileName, radius_arcsec=radius_arcsec,
+				keep=keep)
+			expected = [row for (index, row) in enumerate(rows) if not index in lDropped]
+			assert read_csv_rows(sOutputFileName) == expected
+			assert find_duplicates_brute_force(rows, radius_arcsec, keep).nonzero()[0].tolist() == lDropped
+
+		# Random sources on both tiles; those in the overlap get a copy on the other tile
+		# a fraction of an arcsec away, and some get a close neighbour on their own tile.
+		np.random.seed(0)
+		n_rows = 1500
+		ra = np.random.uniform(9.8, 10.6, n_rows)
+		dec = np.random.uniform(9.95, 10.05, n_rows)
+		tile = np.where(ra < 10.2, 'A.cat', 'B.cat')
+		overlap = np.abs(ra - 10.2) < 0.05
+		copy_ra = ra[overlap] + np.random.normal(0., 0.4, overlap.sum()) * arcsec
+		copy_dec = dec[overlap] + np.random.normal(0., 0.4, overlap.sum()) * arcsec
+		copy_tile = np.where(tile[overlap] == 'A.cat', 'B.cat', 'A.cat')
+		near_ra = ra[::10] + 0.6 * arcsec
+		rows = zip(np.concatenate([ra, copy_ra, near_ra]).tolist(),
+			np.concatenate([dec, copy_dec, dec[::10]]).tolist(),
+			np.random.uniform(10., 1000., n_rows + overlap.sum() + len(near_ra)).tolist(),
+			np.random.uniform(1., 10., n_rows + overlap.sum() + len(near_ra)).tolist(),
+			np.concatenate([tile, copy_tile, tile[::10]]).tolist())
+		write_csv(sInputFileName, rows)
+		for keep in ['snr', 'centre']:
+			dropped = find_duplicates_brute_force(rows, radius_arcsec, keep)
+			assert dropped.sum() > 0
+			deduplicate_csv_file(sInputFileName, sOutputFileName, radius_arcsec=radius_arcsec,
+				keep=keep, zone_height_deg=0.005)
+			assert read_csv_rows(sOutputFileName) == [row for (row, is_dropped) in zip(rows, dropped)
+				if not is_dropped]
+			print 'de-duplication ({}): OK ({} of {} rows dropped).'.format(keep, dropped.sum(),
+				len(rows))
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	test_deduplicate()
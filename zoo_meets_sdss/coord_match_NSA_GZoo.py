@@ -7,106 +7,98 @@ from astropy import units as u
 import numpy as np
 import quick_plot 
 from collections import OrderedDict
-
-# Takes a list of column names and returns a recarray.
+from scipy.spatial import cKDTree
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import column_cache
+import columnar_store
+import csv_columns
+import fits_table
+import sky_index
+
+# Takes a list of column names and returns a recarray, reading only those columns from
+# the memory-mapped file (see fits_table.py). Optionally also writes it to a
+# csv and/or a columnar store (see columnar_store.py). With a cache_directory, the
+# columns are kept in a column cache (see column_cache.py) and later calls for the
+# same columns of the unchanged file map them from there instead of reading the FITS.
 def get_data_from_fits(column_names=None, input_filename='nsa_matched_catalog.fits',
-		write_to_csv_name=None):
-
-	print 'loading columns {} from {} ...'.format(
-		column_names, input_filename)
-
-	# open and read the fits file.
-	hdulist = fits.open(input_filename)
-	tbdata = hdulist[1].data
-
-	# for printing out column definitions.
-	#	print hdulist[1].columns.info()
-	# print(hdulist[1].header.values())
-	# print(sorted(list(tbdata.dtype.names)))
-
-	# This is an OrderedDict to preserve initial ordering of columns.
-	columns = OrderedDict()
+		write_to_csv_name=None, write_to_columnar_name=None, cache_directory=None):
 
-	# For each column specified, make its dict entry point to its respective
-	# 1D recarray from the fits tbdata object.
-	for column_name in column_names:
-		try:
-			columns[column_name] = tbdata[column_name]
-		except KeyError as e:
-			raise BaseException("Column '{}' not found in file '{}' from list:\n {}".format(
-				column_name, input_filename, sorted(list(tbdata.dtype.names))))
+	def load_columns():
+		print 'loading columns {} from {} ...'.format(
+			column_names, input_filename)
 
-	# transfer dict of columns (1D arrays) to recarray. Note implicit reliance on ordering
-	# of dictionary items.
-	output_array = np.rec.fromarrays(tuple(columns.values()),
-		dtype=[(key, value.dtype) for (key, value) in zip(columns.keys(), columns.values())])
+		# Map the fits file and copy out only the specified columns; the rest of the
+		# table is never read.
+		# (for printing out column definitions: print table.columns.info())
+		with fits_table.fits_table(input_filename) as table:
+			output_array = table.read(column_names)
+		print '\tdone. Loaded {} rows.'.format(len(output_array))
+		return output_array
 
+	output_array = column_cache.load_columns_with_cache(cache_directory, input_filename,
+		column_names, load_columns, loader_options='fits:1')
 
 	# write output_array to csv.
 	if write_to_csv_name:
 		np.savetxt(write_to_csv_name, output_array, delimiter=',',
 			header=','.join(output_array.dtype.names))
+	if write_to_columnar_name:
+		columnar_store.write_columnar_store(write_to_columnar_name, output_array)
 
-	print '\tdone. Loaded {} rows.'.format(len(output_array))
 	return output_array
 
 
 
-# reads csv file and for specified column names, returns a recarray.
-def get_data_from_csv(input_filename=None, column_names=None, write_to_csv_name=None):
+# reads csv file and for specified column names, returns a recarray. Optionally also
+# writes it to a csv and/or a columnar store (see columnar_store.py). The csv may be
+# gzip/bzip2-compressed, in which case it's decompressed as it's read. With n_workers > 1
+# it's parsed in that many processes. With a cache_directory, the columns are cached as
+# in get_data_from_fits.
+def get_data_from_csv(input_filename=None, column_names=None, write_to_csv_name=None,
+		write_to_columnar_name=None, cache_directory=None, n_workers=1):
 
-	# Read only the header, then close the file.
-	with open(input_filename, 'r') as f: 
-		# create a dict where the keys are the column names and the values are the column number.
-		header_dict = {name: index for (index, name) in enumerate(f.next().strip().split(','))}
+	# Load only the specified columns, typed from a sample of rows (see csv_columns.py).
+	def load_columns():
+		return csv_columns.load_csv_columns(input_filename, column_names, n_workers=n_workers)
 
-	# This prints out all the column names.
-	#print sorted([column_name for column_name in header_dict])
-
-	# Check that each specified column name is present in the header.
-	for desired_column in column_names:
-		if not desired_column in header_dict:
-			raise BaseException("Column '{}' not found '{}' from list:\n{}".format(
-				desired_column, input_filename, sorted(header_list)))
-
-	# Open file again and load specified columns into single array.
-	print 'loading columns {} from {} ...'.format(column_names, input_filename)
-	column_indices = [header_dict[column_name] for column_name in column_names]
-	ndarray = np.genfromtxt(input_filename, dtype=None, delimiter=',', usecols=column_indices, skip_header=1)
-	print '\tdone. Loaded {} rows.'.format(len(ndarray))
-
-	# Put each column of ndarray into its own array in the return dict.
-	# OrderedDict preserves the order of the columns.
-	columns = OrderedDict()
-	for new_column_index, column_name in enumerate(column_names):
-		columns[column_name] = ndarray[''.join(['f', str(new_column_index)])]
-
-	# Transfer the dict of columns (1D arrays) into a recarray. Note implicit reliance on ordering
-	# of dictionary items.
-	output_array = np.rec.fromarrays(tuple(columns.values()),
-		dtype=[(key, value.dtype) for (key, value) in zip(columns.keys(), columns.values())])
+	output_array = column_cache.load_columns_with_cache(cache_directory, input_filename,
+		column_names, load_columns, loader_options='csv_columns')
 
 	# Write output_array to csv for debugging purposes.
 	if write_to_csv_name:
 		np.savetxt(write_to_csv_name, output_array, delimiter=',',
 		header=','.join(output_array.dtype.names))
+	if write_to_columnar_name:
+		columnar_store.write_columnar_store(write_to_columnar_name, output_array)
 
 	return output_array 
 	
 
 # For each object in "match" (ra/dec), a corresponding line in the output array should 
 # point to the index of the nearest object in "catalog" (ra/dec).
-def match_coordinates_original(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=10):
+# With n_workers > 1 the sky is split into declination stripes that are matched in
+# parallel (see match_nearest_in_stripes); the results are the same.
+# engine='numpy' matches with sky_index.match_coordinates_sky_numpy instead of building
+# SkyCoords (see match_nearest_sky); separations agree with astropy's to ~1e-9 arcsec.
+def match_coordinates_original(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=10, n_workers=1,
+		engine='astropy'):
  	
 	catalog_ra = ra_1; catalog_dec = dec_1
 	match_ra = ra_2; match_dec = dec_2
 
-	print 'matching coordinates ... '  
-	catalogcoord = SkyCoord(ra=catalog_ra* u.degree, dec=catalog_dec * u.degree)
-	matchcoord = SkyCoord(ra=match_ra * u.degree, 
-    dec=match_dec * u.degree)
+	if n_workers > 1:
+		return match_nearest_in_stripes(catalog_ra, catalog_dec, match_ra, match_dec, n_workers,
+			engine=engine)
 
-	indices_into_catalog, sep2d, dist3d = match_coordinates_sky(matchcoord, catalogcoord)
+	print 'matching coordinates ... '  
+	indices_into_catalog, sep2d, dist3d = match_nearest_sky(match_ra, match_dec, catalog_ra,
+		catalog_dec, engine)
 
 	# 1D array of angular distance of each NSA object to nearest GZoo neighbor (arcseconds).
 	sep2d_array = np.array(sep2d.arcsecond)
@@ -152,8 +144,16 @@ def match_coordinates_1by1(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=10):
 
 # For each object in "match" (ra/dec), a corresponding line in the output array should 
 # point to the index of the nearest object in "catalog" (ra/dec).
-def match_coordinates(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=100):
+# Every pair within max_arcsec_sep is returned at once; for large radii or dense
+# catalogs, see iter_pairs_within/reduce_pairs_within instead.
+# With n_workers > 1 the sky is split into declination stripes that are searched in
+# parallel (see search_around_in_stripes); the pairs are then sorted by index into
+# coordinates 1 (and 2).
+def match_coordinates(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=100, n_workers=1):
  	
+	if n_workers > 1:
+		return search_around_in_stripes(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep, n_workers)
+
 	print 'matching coordinates ... '  
 	coordinates1 = SkyCoord(ra=ra_1 * u.degree, dec=dec_1 * u.degree)
 	coordinates2 = SkyCoord(ra=ra_2 * u.degree, 
@@ -167,54 +167,674 @@ def match_coordinates(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=100):
 	sep2d_array = np.array(sep2d.arcsecond)
 	# 1D array, for each NSA object, index into GZoo of nearest object.
 
-	# Combine these two arrays into a 2D array.
-	nearest_coord1_obj_pointers = np.rec.fromarrays((np.array(indices_into_coord1), np.array(sep2d.arcsecond)), 
-		dtype=[('index_into_catalog', int),('DEICH_match_arcsec', float)])
+	# Combine these arrays into a 2D array.
+	nearest_coord1_obj_pointers = np.rec.fromarrays((np.array(indices_into_coord1), np.array(sep2d.arcsecond),
+		np.array(indices_into_coord2)),
+		dtype=[('index_into_catalog', int),('DEICH_match_arcsec', float),('index_into_coord2', int)])
 	
 	print '\tdone.'
 	return nearest_coord1_obj_pointers
 
 
 
-# Take all specified GZoo columns, NSA columns, and the NSA->GZoo matching pointer array. 
-# Returns a single rec array. In the future, this should be a done by a proper database.
-def produce_combined_table(NSA_recarray, GZoo_recarray, NSA_to_GZoo_match_array, foreign_key,
-	output_filename, additional_columns=['DEICH_match_arcsec']):
-	#output_columns = list(map(lambda s: 'GZoo_' + s, GZoo_recarray.dtype.names)) + list(
-	#	map(lambda s: 'NSA_' + s, NSA_recarray.dtype.names)) 
-
-	def make_csv_string(GZoo_row, NSA_row, match_row, this_is_header_line=False):
-		if this_is_header_line:
-			output_columns = list(GZoo_recarray.dtype.names) + list(NSA_recarray.dtype.names) + additional_columns
-			csv_string =  '{}\n'.format(','.join(output_columns))
-		else:
-			output_list = []
-			output_list.extend([str(i) for i in GZoo_row])
-			output_list.extend([str(i) for i in NSA_row]) 
-			output_list.extend([str(i) for i in [match_row['DEICH_match_arcsec']]])
-			csv_string = '{}\n'.format(','.join(output_list))
-		return csv_string
+# For each object in "match" (ra/dec), the k nearest objects in "catalog" (ra/dec),
+# found in one pass over a k-d tree rather than one match_coordinates_sky call per
+# nthneighbor. Returns (indices into catalog, separations in arcsec), both (N, k) with N
+# the number of match objects, nearest first. With max_arcsec_sep, the search stops at
+# that radius and neighbours beyond it are -1 and inf. A sky_index.sky_tree already
+# built over the catalog can be passed in as tree, to be reused across calls.
+def match_k_nearest(ra_1, dec_1, ra_2, dec_2, k=3, max_arcsec_sep=None, tree=None):
+	catalog_ra = ra_1; catalog_dec = dec_1
+	match_ra = ra_2; match_dec = dec_2
 
-	with open(output_filename, 'w') as f:
-		# write header line.
-		f.write(make_csv_string(GZoo_row=GZoo_recarray[0],
-			NSA_row=NSA_recarray[0],
-			match_row=NSA_to_GZoo_match_array[0], 
-			this_is_header_line=True))
+	print 'finding the {} nearest neighbours of {} objects ... '.format(k, len(match_ra))
+	if tree is None:
+		tree = sky_index.sky_tree(catalog_ra, catalog_dec)
+	indices, sep_arcsec = tree.query(match_ra, match_dec, k=k, max_arcsec_sep=max_arcsec_sep)
+	indices = np.asarray(indices, dtype=int).reshape(len(match_ra), k)
+	sep_arcsec = np.asarray(sep_arcsec).reshape(len(match_ra), k)
+	indices[indices == tree.n_objects] = -1
+	print '\tdone.'
+	return indices, sep_arcsec
+
+
+
+PAIR_DTYPE = [('index_into_coord1', int), ('index_into_coord2', int), ('DEICH_match_arcsec', float)]
+
+
+# Generator version of match_coordinates: yields the pairs closer than max_arcsec_sep
+# as record arrays (PAIR_DTYPE) of at most max_block_pairs rows, so the full pair list
+# never has to be in memory. A k-d tree is built over coordinates 2 once; coordinates 1
+# are then searched in batches, whose size adapts to the pair density seen so far.
+# Within a batch, pairs are sorted by index into coordinates 1, then 2.
+def iter_pairs_within(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=100, max_block_pairs=1000000):
+	xyz_1 = sky_index.radec_to_unit_vectors(ra_1, dec_1)
+	tree_2 = cKDTree(sky_index.radec_to_unit_vectors(ra_2, dec_2))
+	max_chord = sky_index.arcsec_to_chord(max_arcsec_sep)
+
+	batch_start = 0
+	batch_size = min(1024, max_block_pairs)
+	while batch_start < len(xyz_1):
+		batch_end = min(batch_start + batch_size, len(xyz_1))
+		batch_pairs = cKDTree(xyz_1[batch_start:batch_end]).sparse_distance_matrix(tree_2,
+			max_chord, output_type='ndarray')
+		batch_pairs = batch_pairs[np.lexsort((batch_pairs['j'], batch_pairs['i']))]
+
+		pairs = np.empty(len(batch_pairs), dtype=PAIR_DTYPE)
+		pairs['index_into_coord1'] = batch_pairs['i'] + batch_start
+		pairs['index_into_coord2'] = batch_pairs['j']
+		pairs['DEICH_match_arcsec'] = sky_index.chord_to_arcsec(batch_pairs['v'])
+		for block_start in range(0, len(pairs), max_block_pairs):
+			yield pairs[block_start:block_start + max_block_pairs].view(np.recarray)
+
+		# Aim the next batch at about max_block_pairs pairs.
+		pairs_per_object = max(len(pairs), 1) / float(batch_end - batch_start)
+		batch_size = int(min(max(max_block_pairs / pairs_per_object, 1), 4 * batch_size))
+		batch_start = batch_end
+
+
+# Streams the pairs from iter_pairs_within straight into a columnar store (see
+# columnar_store.py) instead of memory. Returns the number of pairs written.
+def write_pairs_within(output_filename, ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=100,
+		max_block_pairs=1000000):
+	n_pairs = 0
+	with columnar_store.columnar_store_writer(output_filename) as writer:
+		for pairs in iter_pairs_within(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep, max_block_pairs):
+			writer.append(pairs)
+			n_pairs += len(pairs)
+	return n_pairs
+
+
+# Per-object reductions of the pairs from iter_pairs_within, computed block by block so
+# the full pair list never exists at once. For each object in coordinates 1:
+#   reduction='nearest': recarray with the index into coordinates 2 of the nearest
+#       object within max_arcsec_sep and its separation (index -1 and inf if none), in
+#       the same 'index_into_catalog'/'DEICH_match_arcsec' fields as the other matchers;
+#   reduction='k_nearest': (N, k) arrays (indices, separations) of the k nearest, nearest
+#       first, padded with -1 and inf;
+#   reduction='count': the number of objects within max_arcsec_sep.
+def reduce_pairs_within(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep=100, reduction='nearest',
+		k=1, max_block_pairs=1000000):
+	if reduction not in ('nearest', 'k_nearest', 'count'):
+		raise BaseException("reduction must be 'nearest', 'k_nearest' or 'count', not '{}'.".format(
+			reduction))
+	n_objects = len(ra_1)
+	if reduction == 'nearest':
+		k = 1
+	counts = np.zeros(n_objects, dtype=int)
+	best_indices = np.full((n_objects, k), -1, dtype=int)
+	best_sep = np.full((n_objects, k), np.inf)
+
+	for pairs in iter_pairs_within(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep, max_block_pairs):
+		if reduction == 'count':
+			counts += np.bincount(pairs['index_into_coord1'], minlength=n_objects)
+			continue
+
+		# Candidates: the block's pairs plus what the touched objects already hold.
+		touched = np.unique(pairs['index_into_coord1'])
+		held = np.isfinite(best_sep[touched])
+		candidate_object = np.concatenate([pairs['index_into_coord1'],
+			np.repeat(touched, k)[held.ravel()]])
+		candidate_index = np.concatenate([pairs['index_into_coord2'], best_indices[touched][held]])
+		candidate_sep = np.concatenate([pairs['DEICH_match_arcsec'], best_sep[touched][held]])
+
+		# Rank the candidates of each object by separation and keep the first k.
+		order = np.lexsort((candidate_index, candidate_sep, candidate_object))
+		candidate_object = candidate_object[order]
+		group_starts = np.searchsorted(candidate_object, candidate_object, side='left')
+		rank = np.arange(len(candidate_object)) - group_starts
+		keep = rank < k
+		best_indices[touched] = -1
+		best_sep[touched] = np.inf
+		best_indices[candidate_object[keep], rank[keep]] = candidate_index[order][keep]
+		best_sep[candidate_object[keep], rank[keep]] = candidate_sep[order][keep]
+
+	if reduction == 'count':
+		return counts
+	if reduction == 'k_nearest':
+		return best_indices, best_sep
+	return np.rec.fromarrays((best_indices[:, 0], best_sep[:, 0]),
+		dtype=[('index_into_catalog', int),('DEICH_match_arcsec', float)])
+
+
+# For a list of pairs, returns the position (within the pair arrays) of the closest pair
+# of each object on one side, or -1 for objects with no pairs. Ties in separation go to
+# the pair that comes first.
+def get_best_pair_positions(index_this_side, sep, n_objects):
+	# Sort on a single integer key (object, then rank of separation); much faster than
+	# np.lexsort on millions of pairs.
+	n_pairs = len(sep)
+	sep_rank = np.empty(n_pairs, dtype=np.int64)
+	sep_rank[np.argsort(sep, kind='mergesort')] = np.arange(n_pairs)
+	order = np.argsort(np.asarray(index_this_side, dtype=np.int64) * n_pairs + sep_rank)
+	sorted_index = index_this_side[order]
+	is_first = np.ones(n_pairs, dtype=bool)
+	is_first[1:] = sorted_index[1:] != sorted_index[:-1]
+	best_positions = np.full(n_objects, -1, dtype=int)
+	best_positions[sorted_index[is_first]] = order[is_first]
+	return best_positions
+
+
+# Returns a boolean mask over the pairs, True where each member of the pair is the
+# other's closest match.
+def get_mutual_best_mask(index_1, index_2, sep):
+	index_1 = np.asarray(index_1); index_2 = np.asarray(index_2); sep = np.asarray(sep)
+	mutual = np.zeros(len(sep), dtype=bool)
+	if len(sep) == 0:
+		return mutual
+	best_for_1 = get_best_pair_positions(index_1, sep, index_1.max() + 1)
+	best_for_2 = get_best_pair_positions(index_2, sep, index_2.max() + 1)
+	positions = np.arange(len(sep))
+	mutual[(best_for_1[index_1] == positions) & (best_for_2[index_2] == positions)] = True
+	return mutual
+
+
+# Returns a boolean mask over the pairs selecting a one-to-one assignment: no object on
+# either side is used twice, and pairs are taken closest first (the same result as a
+# greedy walk through the pairs sorted by separation). Done in rounds: each round
+# accepts every mutual-best pair among the pairs still available, then drops all
+# pairs that touch an accepted object.
+def get_one_to_one_mask(index_1, index_2, sep):
+	index_1 = np.asarray(index_1); index_2 = np.asarray(index_2); sep = np.asarray(sep)
+	accepted = np.zeros(len(sep), dtype=bool)
+	available = np.arange(len(sep))
+	if len(sep) == 0:
+		return accepted
+	used_1 = np.zeros(index_1.max() + 1, dtype=bool)
+	used_2 = np.zeros(index_2.max() + 1, dtype=bool)
+	while len(available):
+		mutual = available[get_mutual_best_mask(index_1[available], index_2[available],
+			sep[available])]
+		accepted[mutual] = True
+		used_1[index_1[mutual]] = True
+		used_2[index_2[mutual]] = True
+		available = available[~used_1[index_1[available]] & ~used_2[index_2[available]]]
+	return accepted
+
+
+# Turns the pairs of match_coordinates/iter_pairs_within (index_1 into coordinates 1,
+# index_2 into coordinates 2, separation in arcsec) into one match per object of
+# coordinates 1, in the 'index_into_catalog'/'DEICH_match_arcsec' form that
+# produce_combined_table takes (index_into_catalog points into coordinates 2; objects
+# without a match get -1 and inf). assignment is one of:
+#   'best': each object's closest pair (an object in coordinates 2 may be claimed twice);
+#   'mutual': only pairs where both members are each other's closest;
+#   'unique': a one-to-one assignment, closest pairs first (see get_one_to_one_mask).
+def assign_matches(index_1, index_2, sep, n_1, assignment='best'):
+	index_1 = np.asarray(index_1); index_2 = np.asarray(index_2); sep = np.asarray(sep)
+	if assignment == 'best':
+		best_positions = get_best_pair_positions(index_1, sep, n_1)
+		selected = best_positions[best_positions >= 0]
+	elif assignment == 'mutual':
+		selected = np.where(get_mutual_best_mask(index_1, index_2, sep))[0]
+	elif assignment == 'unique':
+		selected = np.where(get_one_to_one_mask(index_1, index_2, sep))[0]
+	else:
+		raise BaseException("assignment must be 'best', 'mutual' or 'unique', not '{}'.".format(
+			assignment))
+
+	indices_into_catalog = np.full(n_1, -1, dtype=int)
+	sep2d_array = np.full(n_1, np.inf)
+	indices_into_catalog[index_1[selected]] = index_2[selected]
+	sep2d_array[index_1[selected]] = sep[selected]
+	return np.rec.fromarrays((indices_into_catalog, sep2d_array),
+		dtype=[('index_into_catalog', int),('DEICH_match_arcsec', float)])
 
-		# write each row in CSV format.
-		for index_into_NSA, match_row in enumerate(NSA_to_GZoo_match_array):
-			if match_row['DEICH_match_arcsec'] < 100000.:
-				index_into_GZoo = match_row['index_into_catalog']
-				f.write(make_csv_string(GZoo_recarray[index_into_GZoo], 
-					NSA_recarray[index_into_NSA],
-					match_row=match_row)) 
 
-	return ''
+# Any catalog object with dec outside [catalog_lo, catalog_hi) is at least this far
+# (arcsec) from an object at the given dec. Used to tell whether a nearest neighbour
+# found among the objects inside that range is the true nearest neighbour.
+def get_outside_distance_bound(dec, catalog_lo, catalog_hi):
+	bound_arcsec = np.full(len(dec), np.inf)
+	if catalog_lo > -90.:
+		bound_arcsec = np.minimum(bound_arcsec, (dec - catalog_lo) * 3600.)
+	if catalog_hi < 90.:
+		bound_arcsec = np.minimum(bound_arcsec, (catalog_hi - dec) * 3600.)
+	return bound_arcsec
+
+
+# Splits the sky into n_stripes declination stripes holding about the same number of
+# the given objects. Returns (stripe edges, stripe number of each object). The edges
+# always start at -90 and end at 90, so there is at least one stripe even when all
+# the objects share one declination (or there are none); repeated edges are dropped.
+def get_dec_stripes(dec, n_stripes):
+	inner_edges = []
+	if len(dec):
+		inner_edges = np.percentile(dec, np.linspace(0., 100., n_stripes + 1))[1:-1]
+	inner_edges = np.unique([edge for edge in inner_edges if -90. < edge < 90.])
+	edges = np.concatenate([[-90.], inner_edges, [90.]])
+	return edges, np.searchsorted(edges[1:-1], dec, side='right')
+
+
+# Nearest catalog object of each match object, as astropy's match_coordinates_sky
+# returns it: (indices into catalog, sep2d Angle, dist3d). engine is 'astropy' or
+# 'numpy' (sky_index.match_coordinates_sky_numpy).
+def match_nearest_sky(match_ra, match_dec, catalog_ra, catalog_dec, engine='astropy'):
+	if engine == 'numpy':
+		return sky_index.match_coordinates_sky_numpy(match_ra, match_dec, catalog_ra, catalog_dec)
+	if engine != 'astropy':
+		raise BaseException("Unknown matching engine '{}' (use 'astropy' or 'numpy').".format(engine))
+	return match_coordinates_sky(SkyCoord(ra=match_ra * u.degree, dec=match_dec * u.degree),
+		SkyCoord(ra=catalog_ra * u.degree, dec=catalog_dec * u.degree))
+
+
+# Stripe worker for match_nearest_in_stripes. Matches a stripe's objects against the
+# catalog objects in the stripe plus a margin; returns (global catalog indices,
+# separations in arcsec, mask of matches that are certainly the nearest).
+def match_nearest_stripe(tStripeJob):
+	(match_ra, match_dec, catalog_index, catalog_ra, catalog_dec, catalog_lo, catalog_hi,
+		engine) = tStripeJob
+	if len(catalog_index) == 0 or len(match_ra) == 0:
+		return (np.zeros(len(match_ra), dtype=int), np.zeros(len(match_ra)),
+			np.zeros(len(match_ra), dtype=bool))
+	indices_into_catalog, sep2d, dist3d = match_nearest_sky(match_ra, match_dec, catalog_ra,
+		catalog_dec, engine)
+	sep2d_array = np.array(sep2d.arcsecond)
+	resolved = sep2d_array <= get_outside_distance_bound(match_dec, catalog_lo, catalog_hi)
+	return catalog_index[np.array(indices_into_catalog)], sep2d_array, resolved
+
+
+# Parallel version of match_coordinates_original. The match objects are split into
+# declination stripes (a few per worker, for load balancing), and each stripe is
+# matched in a worker process against the catalog objects within margin_arcsec of it.
+# The few objects whose nearest neighbour might lie beyond the margin are then matched
+# against the whole catalog, so the results are the same as the serial version's.
+# engine is as for match_nearest_sky.
+def match_nearest_in_stripes(catalog_ra, catalog_dec, match_ra, match_dec, n_workers,
+		margin_arcsec=60., engine='astropy'):
+
+	print 'matching coordinates in {} processes ... '.format(n_workers)
+	catalog_ra = np.asarray(catalog_ra, dtype=float); catalog_dec = np.asarray(catalog_dec, dtype=float)
+	match_ra = np.asarray(match_ra, dtype=float); match_dec = np.asarray(match_dec, dtype=float)
+	edges, stripe = get_dec_stripes(match_dec, 4 * n_workers)
+	margin_deg = margin_arcsec / 3600.
+
+	stripe_jobs = []
+	stripe_members = []
+	for stripe_index in range(len(edges) - 1):
+		members = np.where(stripe == stripe_index)[0]
+		catalog_lo, catalog_hi = edges[stripe_index] - margin_deg, edges[stripe_index + 1] + margin_deg
+		catalog_index = np.where((catalog_dec >= catalog_lo) & (catalog_dec < catalog_hi))[0]
+		stripe_members.append(members)
+		stripe_jobs.append((match_ra[members], match_dec[members], catalog_index,
+			catalog_ra[catalog_index], catalog_dec[catalog_index], catalog_lo, catalog_hi, engine))
+
+	indices_into_catalog = np.zeros(len(match_ra), dtype=int)
+	sep2d_array = np.zeros(len(match_ra))
+	unresolved = []
+	pool = multiprocessing.Pool(processes=n_workers)
+	try:
+		for members, (stripe_indices, stripe_sep, resolved) in zip(stripe_members,
+				pool.imap(match_nearest_stripe, stripe_jobs)):
+			indices_into_catalog[members] = stripe_indices
+			sep2d_array[members] = stripe_sep
+			unresolved.append(members[~resolved])
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+	unresolved = np.concatenate(unresolved + [np.zeros(0, dtype=int)])
+	if len(unresolved):
+		indices, sep2d, dist3d = match_nearest_sky(match_ra[unresolved], match_dec[unresolved],
+			catalog_ra, catalog_dec, engine)
+		indices_into_catalog[unresolved] = indices
+		sep2d_array[unresolved] = sep2d.arcsecond
+
+	nearest_catalog_obj_pointers = np.rec.fromarrays((indices_into_catalog, sep2d_array),
+		dtype=[('index_into_catalog', int),('DEICH_match_arcsec', float)])
+	print '\tdone ({} objects needed the whole catalog).'.format(len(unresolved))
+	return nearest_catalog_obj_pointers
 
 
+# Stripe worker for search_around_in_stripes. Returns (global indices into coordinates 1,
+# global indices into coordinates 2, separations in arcsec) of the stripe's pairs.
+def search_around_stripe(tStripeJob):
+	index_1, ra_1, dec_1, index_2, ra_2, dec_2, max_arcsec_sep = tStripeJob
+	if len(index_1) == 0 or len(index_2) == 0:
+		return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+	indices_into_coord1, indices_into_coord2, sep2d, dist3d = search_around_sky(
+		SkyCoord(ra=ra_1 * u.degree, dec=dec_1 * u.degree),
+		SkyCoord(ra=ra_2 * u.degree, dec=dec_2 * u.degree),
+		astropy.units.Quantity(value=max_arcsec_sep, unit=u.arcsecond))
+	return (index_1[np.array(indices_into_coord1, dtype=int)],
+		index_2[np.array(indices_into_coord2, dtype=int)], np.array(sep2d.arcsecond))
+
+
+# Parallel version of match_coordinates. Coordinates 1 are split into declination
+# stripes, each searched in a worker process against the coordinates 2 within
+# max_arcsec_sep of the stripe, so every pair is found exactly once. Pairs come back
+# sorted by index into coordinates 1, then coordinates 2.
+def search_around_in_stripes(ra_1, dec_1, ra_2, dec_2, max_arcsec_sep, n_workers):
+
+	print 'matching coordinates in {} processes ... '.format(n_workers)
+	ra_1 = np.asarray(ra_1, dtype=float); dec_1 = np.asarray(dec_1, dtype=float)
+	ra_2 = np.asarray(ra_2, dtype=float); dec_2 = np.asarray(dec_2, dtype=float)
+	edges, stripe = get_dec_stripes(dec_1, 4 * n_workers)
+	margin_deg = max_arcsec_sep / 3600.
+
+	stripe_jobs = []
+	for stripe_index in range(len(edges) - 1):
+		index_1 = np.where(stripe == stripe_index)[0]
+		index_2 = np.where((dec_2 >= edges[stripe_index] - margin_deg) &
+			(dec_2 <= edges[stripe_index + 1] + margin_deg))[0]
+		stripe_jobs.append((index_1, ra_1[index_1], dec_1[index_1],
+			index_2, ra_2[index_2], dec_2[index_2], max_arcsec_sep))
+
+	pool = multiprocessing.Pool(processes=n_workers)
+	try:
+		stripe_results = pool.map(search_around_stripe, stripe_jobs)
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+	stripe_results.append((np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)))
+	indices_into_coord1 = np.concatenate([result[0] for result in stripe_results])
+	indices_into_coord2 = np.concatenate([result[1] for result in stripe_results])
+	sep2d_array = np.concatenate([result[2] for result in stripe_results])
+	order = np.lexsort((indices_into_coord2, indices_into_coord1))
+
+	nearest_coord1_obj_pointers = np.rec.fromarrays((indices_into_coord1[order], sep2d_array[order],
+		indices_into_coord2[order]),
+		dtype=[('index_into_catalog', int),('DEICH_match_arcsec', float),('index_into_coord2', int)])
+	print '\tdone.'
+	return nearest_coord1_obj_pointers
+
+
+# Times the serial and the parallel matchers on random catalogs the size of the NSA
+# (~145k objects) and Galaxy Zoo (~245k) over the SDSS footprint, for 1 to max_workers
+# processes, checks that they agree and prints the speedups.
+def benchmark_parallel_matching(n_NSA=145155, n_GZoo=245609, max_workers=None):
+	max_workers = max_workers or multiprocessing.cpu_count()
+	np.random.seed(0)
+	NSA_ra = np.random.uniform(110., 260., n_NSA); NSA_dec = np.random.uniform(-5., 65., n_NSA)
+	GZoo_ra = np.random.uniform(110., 260., n_GZoo); GZoo_dec = np.random.uniform(-5., 65., n_GZoo)
+
+	for name, match_function in [('match_coordinates_original', match_coordinates_original),
+			('match_coordinates', match_coordinates)]:
+		serial_time = None
+		for n_workers in range(1, max_workers + 1):
+			start_time = time.time()
+			result = match_function(GZoo_ra, GZoo_dec, NSA_ra, NSA_dec, n_workers=n_workers)
+			elapsed_time = time.time() - start_time
+			if serial_time is None:
+				serial_time, serial_result = elapsed_time, result
+			if name == 'match_coordinates':
+				# The parallel pairs are sorted; compare them as sets of rows.
+				assert np.array_equal(np.sort(result, order=list(result.dtype.names)),
+					np.sort(serial_result, order=list(serial_result.dtype.names)))
+			else:
+				assert np.array_equal(result, serial_result)
+			print '{}: {} process(es): {:.2f} s, speedup {:.2f}x'.format(name, n_workers,
+				elapsed_time, serial_time / elapsed_time)
+
+
+# Times match_k_nearest against one match_coordinates_sky call per nthneighbor on random
+# catalogs the size of NSA and GZoo, and checks they find the same neighbours.
+def benchmark_k_nearest(n_NSA=145155, n_GZoo=245609, k=3):
+	np.random.seed(0)
+	NSA_ra = np.random.uniform(110., 260., n_NSA); NSA_dec = np.random.uniform(-5., 65., n_NSA)
+	GZoo_ra = np.random.uniform(110., 260., n_GZoo); GZoo_dec = np.random.uniform(-5., 65., n_GZoo)
+
+	start_time = time.time()
+	NSA_coord = SkyCoord(ra=NSA_ra * u.degree, dec=NSA_dec * u.degree)
+	GZoo_coord = SkyCoord(ra=GZoo_ra * u.degree, dec=GZoo_dec * u.degree)
+	astropy_results = [match_coordinates_sky(NSA_coord, GZoo_coord, nthneighbor=nthneighbor)
+		for nthneighbor in range(1, k + 1)]
+	astropy_time = time.time() - start_time
+
+	start_time = time.time()
+	indices, sep_arcsec = match_k_nearest(GZoo_ra, GZoo_dec, NSA_ra, NSA_dec, k=k)
+	k_nearest_time = time.time() - start_time
+
+	for nthneighbor, (astropy_indices, sep2d, dist3d) in enumerate(astropy_results):
+		assert np.abs(sep_arcsec[:, nthneighbor] - sep2d.arcsecond).max() < 1e-6
+		# Indices may only differ where two neighbours are equally far.
+		assert (indices[:, nthneighbor] != astropy_indices).sum() <= n_NSA * 1e-4
+	print 'k={}: match_coordinates_sky x {} {:.2f} s, match_k_nearest {:.2f} s, speedup {:.1f}x'.format(
+		k, k, astropy_time, k_nearest_time, astropy_time / k_nearest_time)
+
+
+# Height of the declination zones that match_coordinates_out_of_core spills its inputs
+# into. Zones are then grouped into work units that fit the memory budget.
+FINE_ZONE_HEIGHT_DEG = 0.1
+
+# Rough peak memory per object (catalog or match) while a work unit is being matched:
+# the zone records, the SkyCoord objects and their cartesian copies, and the k-d tree.
+MATCH_BYTES_PER_OBJECT = 400
+
+ZONE_RECORD_DTYPE = [('index', np.int64), ('ra', np.float64), ('dec', np.float64)]
+
+
+# Streams (ra, dec) chunks into one file per FINE_ZONE_HEIGHT_DEG declination zone.
+# Returns (total rows, rows per zone).
+def partition_radec_into_zones(radec_chunks, zone_directory, prefix):
+	n_zones = int(np.ceil(180. / FINE_ZONE_HEIGHT_DEG))
+	zone_counts = np.zeros(n_zones, dtype=np.int64)
+	n_rows = 0
+	for ra, dec in radec_chunks:
+		records = np.empty(len(ra), dtype=ZONE_RECORD_DTYPE)
+		records['index'] = np.arange(n_rows, n_rows + len(ra))
+		records['ra'] = ra
+		records['dec'] = dec
+		n_rows += len(ra)
+
+		zone = np.clip(np.floor((records['dec'] + 90.) / FINE_ZONE_HEIGHT_DEG).astype(int),
+			0, n_zones - 1)
+		zone_order = np.argsort(zone, kind='mergesort')
+		unique_zones, zone_starts = np.unique(zone[zone_order], return_index=True)
+		for zone_index, lo, hi in zip(unique_zones, zone_starts, list(zone_starts[1:]) + [len(zone)]):
+			with open(os.path.join(zone_directory, '{}_{:05d}.bin'.format(prefix, zone_index)), 'ab') as f:
+				records[zone_order[lo:hi]].tofile(f)
+			zone_counts[zone_index] += hi - lo
+	return n_rows, zone_counts
+
+
+# Loads the zone records of the given prefix with dec_lo <= dec < dec_hi.
+def load_zone_records(zone_directory, prefix, dec_lo, dec_hi):
+	n_zones = int(np.ceil(180. / FINE_ZONE_HEIGHT_DEG))
+	first_zone = max(int(np.floor((dec_lo + 90.) / FINE_ZONE_HEIGHT_DEG)), 0)
+	last_zone = min(int(np.floor((dec_hi + 90.) / FINE_ZONE_HEIGHT_DEG)), n_zones - 1)
+	zone_records = [np.empty(0, dtype=ZONE_RECORD_DTYPE)]
+	for zone_index in range(first_zone, last_zone + 1):
+		zone_filename = os.path.join(zone_directory, '{}_{:05d}.bin'.format(prefix, zone_index))
+		if os.path.exists(zone_filename):
+			records = np.fromfile(zone_filename, dtype=ZONE_RECORD_DTYPE)
+			zone_records.append(records[(records['dec'] >= dec_lo) & (records['dec'] < dec_hi)])
+	return np.concatenate(zone_records)
+
+
+# Out-of-core version of match_coordinates_original, for catalogs that don't fit in
+# memory. catalog_chunks and match_chunks are iterables of (ra, dec) array pairs, e.g.
+# [(ra_1, dec_1)] or chunks streamed from a columnar store. Both are spilled into
+# declination-zone files in a scratch directory, then matched a group of zones at a
+# time, the group sized so that it stays within memory_budget_mb. Each group is matched
+# against the catalog objects in its zones plus margin_arcsec either side; any object
+# whose nearest neighbour is further away than the edge of that margin (so a nearer
+# one could lie outside it) is matched again with a wider margin.
+#
+# Since each group goes through match_coordinates_sky itself, the results are the same
+# as match_coordinates_original's. They are written straight to output_filename (a .npy
+# file) and returned as a read-only memory-mapped recarray with the same
+# 'index_into_catalog'/'DEICH_match_arcsec' fields.
+def match_coordinates_out_of_core(catalog_chunks, match_chunks, output_filename,
+		memory_budget_mb=1024, margin_arcsec=60.):
+
+	print 'matching coordinates by declination zone ... '
+	zone_directory = tempfile.mkdtemp(prefix='match_zones_',
+		dir=os.path.dirname(os.path.abspath(output_filename)))
+	try:
+		n_catalog, catalog_zone_counts = partition_radec_into_zones(catalog_chunks,
+			zone_directory, 'catalog')
+		n_match, match_zone_counts = partition_radec_into_zones(match_chunks,
+			zone_directory, 'match')
+		if n_catalog == 0:
+			raise BaseException('The catalog to match against is empty.')
+
+		output_array = np.lib.format.open_memmap(output_filename, mode='w+', shape=(n_match,),
+			dtype=[('index_into_catalog', int), ('DEICH_match_arcsec', float)])
+
+		# Group consecutive zones into work units that fit the memory budget.
+		max_objects = memory_budget_mb * 2**20 / MATCH_BYTES_PER_OBJECT
+		work_units = []
+		first_zone = 0
+		n_objects = 0
+		for zone_index in range(len(match_zone_counts)):
+			zone_objects = match_zone_counts[zone_index] + catalog_zone_counts[zone_index]
+			if n_objects and n_objects + zone_objects > max_objects:
+				work_units.append((first_zone, zone_index))
+				first_zone, n_objects = zone_index, 0
+			n_objects += zone_objects
+		work_units.append((first_zone, len(match_zone_counts)))
+
+		for first_zone, end_zone in work_units:
+			if not match_zone_counts[first_zone:end_zone].sum():
+				continue
+			dec_lo = -90. + first_zone * FINE_ZONE_HEIGHT_DEG
+			dec_hi = -90. + end_zone * FINE_ZONE_HEIGHT_DEG
+			# The last unit also takes objects sitting exactly on dec = +90.
+			match_records = load_zone_records(zone_directory, 'match', dec_lo,
+				dec_hi if end_zone < len(match_zone_counts) else 91.)
+			margin_deg = margin_arcsec / 3600.
+			while len(match_records):
+				catalog_lo, catalog_hi = dec_lo - margin_deg, dec_hi + margin_deg
+				catalog_records = load_zone_records(zone_directory, 'catalog', catalog_lo, catalog_hi)
+				if len(catalog_records) == 0:
+					margin_deg *= 4.
+					continue
+				indices_into_catalog, sep2d, dist3d = match_coordinates_sky(
+					SkyCoord(ra=match_records['ra'] * u.degree, dec=match_records['dec'] * u.degree),
+					SkyCoord(ra=catalog_records['ra'] * u.degree, dec=catalog_records['dec'] * u.degree))
+				sep2d_array = np.array(sep2d.arcsecond)
+
+				resolved = sep2d_array <= get_outside_distance_bound(match_records['dec'],
+					catalog_lo, catalog_hi)
+
+				resolved_rows = match_records['index'][resolved]
+				output_array['index_into_catalog'][resolved_rows] = catalog_records['index'][
+					np.array(indices_into_catalog)[resolved]]
+				output_array['DEICH_match_arcsec'][resolved_rows] = sep2d_array[resolved]
+				match_records = match_records[~resolved]
+				margin_deg *= 4.
+		output_array.flush()
+		del output_array
+	finally:
+		shutil.rmtree(zone_directory, ignore_errors=True)
+
+	print '\tdone. {} objects matched against {}; written to {}.'.format(n_match, n_catalog,
+		output_filename)
+	return np.load(output_filename, mmap_mode='r').view(np.recarray)
+
+
+# NSA objects whose match is at least this far away (arcsec) are left out of the
+# combined table. Unmatched objects have inf.
+COMBINED_TABLE_MAX_ARCSEC = 100000.
+
+# Rows formatted and written at a time by write_table.
+WRITE_CHUNK_ROWS = 100000
+
+
+# Structured arrays can't have two fields with the same name, so repeats get '_1',
+# '_2', ... appended, the way np.recfromcsv names them.
+def get_unique_field_names(names):
+	name_counts = {}
+	unique_names = []
+	for name in names:
+		if name in name_counts:
+			name_counts[name] += 1
+			unique_names.append('{}_{}'.format(name, name_counts[name]))
+		else:
+			name_counts[name] = 0
+			unique_names.append(name)
+	return unique_names
+
+
+# Joins every matched NSA row with its GZoo row, a column at a time with fancy indexing
+# instead of a row at a time. Returns (recarray of GZoo columns + NSA columns +
+# additional_columns of the match array, in NSA order, header names). The header
+# names are the plain column names; the recarray's are made unique.
+def join_matched_rows(NSA_recarray, GZoo_recarray, NSA_to_GZoo_match_array,
+		additional_columns=['DEICH_match_arcsec']):
+	is_matched = NSA_to_GZoo_match_array['DEICH_match_arcsec'] < COMBINED_TABLE_MAX_ARCSEC
+	index_into_NSA = np.nonzero(is_matched)[0]
+	index_into_GZoo = NSA_to_GZoo_match_array['index_into_catalog'][is_matched]
+
+	header_names = list(GZoo_recarray.dtype.names) + list(NSA_recarray.dtype.names) + list(
+		additional_columns)
+	columns = [np.asarray(GZoo_recarray[name])[index_into_GZoo] for name in GZoo_recarray.dtype.names]
+	columns.extend([np.asarray(NSA_recarray[name])[index_into_NSA] for name in NSA_recarray.dtype.names])
+	columns.extend([np.asarray(NSA_to_GZoo_match_array[name])[is_matched] for name in additional_columns])
+	combined_array = np.rec.fromarrays(columns, dtype=[(name, column.dtype, column.shape[1:])
+		for (name, column) in zip(get_unique_field_names(header_names), columns)])
+	return combined_array, header_names
+
+
+# Returns a column's values as the list of strings str() would give for each of them.
+def format_csv_column(column):
+	if column.ndim == 1 and column.dtype.kind in 'biufS':
+		return column.astype(str).tolist()
+	return [str(i) for i in column]
+
+
+# Formats a block of table rows as CSV text. Module-level so it can be mapped over a
+# multiprocessing pool.
+def format_csv_rows(table_chunk):
+	string_columns = [format_csv_column(table_chunk[name]) for name in table_chunk.dtype.names]
+	return '\n'.join(map(','.join, zip(*string_columns))) + '\n'
+
+
+# Writes a table (recarray) to output_filename in bulk, WRITE_CHUNK_ROWS rows at a time.
+# output_format 'csv' writes header_names (default: the table's field names) and then
+# each value as str() would print it; 'columnar' writes a columnar_store file instead.
+# Formatting the numbers is most of the work for a CSV, so with n_workers > 1 the
+# chunks are formatted in that many processes (and still written in order).
+def write_table(output_filename, table, header_names=None, output_format='csv', n_workers=1):
+	if output_format == 'columnar':
+		columnar_store.write_columnar_store(output_filename, table)
+		return
+	if output_format != 'csv':
+		raise BaseException("output_format must be 'csv' or 'columnar', not '{}'.".format(output_format))
+
+	table_chunks = (table[start:start + WRITE_CHUNK_ROWS]
+		for start in range(0, len(table), WRITE_CHUNK_ROWS))
+	with open(output_filename, 'w') as f:
+		f.write('{}\n'.format(','.join(header_names or table.dtype.names)))
+		if n_workers > 1:
+			pool = multiprocessing.Pool(processes=n_workers)
+			try:
+				for csv_text in pool.imap(format_csv_rows, table_chunks):
+					f.write(csv_text)
+				pool.close()
+			finally:
+				pool.terminate()
+				pool.join()
+		else:
+			for table_chunk in table_chunks:
+				f.write(format_csv_rows(table_chunk))
+	print '{} written ({} rows).'.format(output_filename, len(table))
+
+
+# Writes every NSA object with a match, joined to its GZoo row, to output_filename
+# (CSV, or a columnar store with output_format='columnar'). The CSV is the same as the
+# old row-by-row version wrote (see test_coord_match_NSA_GZoo.py). n_workers is passed
+# on to write_table.
+# Returns the joined recarray.
+def produce_combined_table(NSA_recarray, GZoo_recarray, NSA_to_GZoo_match_array, foreign_key,
+	output_filename, additional_columns=['DEICH_match_arcsec'], output_format='csv', n_workers=1):
+	combined_array, header_names = join_matched_rows(NSA_recarray, GZoo_recarray,
+		NSA_to_GZoo_match_array, additional_columns=additional_columns)
+	write_table(output_filename, combined_array, header_names=header_names,
+		output_format=output_format, n_workers=n_workers)
+	return combined_array
+
 
-def highest_level():
+# assignment=None keeps the plain nearest-neighbour match of each NSA object. Otherwise
+# NSA/GZoo pairs within max_arcsec_sep are reduced with assign_matches ('best',
+# 'mutual' or 'unique'). With a cache_directory (e.g.
+# column_cache.DEFAULT_CACHE_DIRECTORY), the loaded NSA and GZoo columns are cached there
+# (see column_cache.py); by default nothing is cached.
+def highest_level(assignment=None, max_arcsec_sep=10, cache_directory=None):
 
 	# define filenames and column names.
 	NSA_defs = {'filename': 'nsa_v0_1_2.fits',
@@ -226,16 +846,25 @@ def highest_level():
 
 	# pull specified columns from NSA into memory.
 	NSA_specified_column_data = get_data_from_fits(input_filename=NSA_defs['filename'],
-		column_names=NSA_defs['column_names'], write_to_csv_name="data_from_fits.csv")
+		column_names=NSA_defs['column_names'], write_to_csv_name="data_from_fits.csv",
+		cache_directory=cache_directory)
 
 	# pull specified columns from Galaxy Zoo into memory.
 	GZoo_specified_column_data = get_data_from_csv(input_filename=GZoo_defs['filename'], 
-		column_names=GZoo_defs['column_names'], write_to_csv_name="data_from_galaxy_zoo.csv")
+		column_names=GZoo_defs['column_names'], write_to_csv_name="data_from_galaxy_zoo.csv",
+		cache_directory=cache_directory)
 
 	# perform coordinate match. Use coordinate match only to assign DR8IDs or 
 	# whatever foreign key to all rows in NSA_defs.
-	nearest_GZoo_obj_pointers = match_coordinates_original(ra_1=GZoo_specified_column_data['ra'], dec_1=GZoo_specified_column_data['dec'],
-		ra_2=NSA_specified_column_data['RA'], dec_2=NSA_specified_column_data['DEC'])
+	if assignment:
+		pairs = match_coordinates(ra_1=NSA_specified_column_data['RA'], dec_1=NSA_specified_column_data['DEC'],
+			ra_2=GZoo_specified_column_data['ra'], dec_2=GZoo_specified_column_data['dec'],
+			max_arcsec_sep=max_arcsec_sep)
+		nearest_GZoo_obj_pointers = assign_matches(pairs['index_into_catalog'], pairs['index_into_coord2'],
+			pairs['DEICH_match_arcsec'], len(NSA_specified_column_data), assignment=assignment)
+	else:
+		nearest_GZoo_obj_pointers = match_coordinates_original(ra_1=GZoo_specified_column_data['ra'], dec_1=GZoo_specified_column_data['dec'],
+			ra_2=NSA_specified_column_data['RA'], dec_2=NSA_specified_column_data['DEC'])
 
 	#print '{} / {} matches have angle less than 1 arcsecond.'.format(len(matches), len(matched_coordinates_dict['sep2d']))
 #	quick_plot.quick_histogram(matched_coordinates_dict['sep2d'], title="angular separation of nearest neighbor",
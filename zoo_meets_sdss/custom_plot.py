@@ -4,6 +4,10 @@ import sys, os
 sys.path.append(os.path.split(os.getcwd())[0])
 import make_thumbnail_webpage
 import coord_match_NSA_GZoo
+import column_cache
+import columnar_store
+import compact_catalog
+import sky_index
 
 
 def write_csv(filename, rec_array):
@@ -109,31 +113,61 @@ def match_coordinates():
 	return nearest_GZoo_obj_pointers 
 
 
+# A catalog recarray (or compact_catalog) plus a spatial index over its ra/dec, built
+# once (or loaded from index_filename, see sky_index.load_or_build_sky_tree) and reused
+# for every lookup.
 class catalog:
-	def __init__(self, catalog_rec, ra_name, dec_name):
+	def __init__(self, catalog_rec, ra_name, dec_name, index_filename=None):
 		self.catalog_rec = catalog_rec
 		self.ra_name = ra_name
 		self.dec_name = dec_name
+		self.index = sky_index.load_or_build_sky_tree(catalog_rec[ra_name], catalog_rec[dec_name],
+			index_filename=index_filename)
+
+	# Returns the nearest catalog object to each of the given positions, and the
+	# separations (arcsec).
+	def match(self, ra_array, dec_array):
+		indices, sep_arcsec = self.index.query(ra_array, dec_array)
+		return self.catalog_rec[indices], sep_arcsec
 
 	def match_single(self, ra, dec):
-		nearest_catalog_obj_pointers = coord_match_NSA_GZoo.match_coordinates(
-			catalog_ra=self.catalog_rec[self.ra_name], catalog_dec=self.catalog_rec[self.dec_name],
-			match_ra = np.array([ra]), match_dec = np.array([dec]))
-		return self.catalog_rec[nearest_catalog_obj_pointers['index_into_catalog']]
+		return self.match(np.array([ra]), np.array([dec]))[0]
+
+
 
+# Reads a table written by coord_match_NSA_GZoo: either a csv or a columnar store.
+# Column names come back lowercased in both cases. With a cache_directory, a csv is
+# parsed once and then loaded from the column cache (see column_cache.py) until it
+# changes.
+def read_table(filename, cache_directory=None):
+	if columnar_store.is_columnar_store(filename):
+		return columnar_store.read_columnar_store(filename, lowercase_names=True)
+	return column_cache.load_columns_with_cache(cache_directory, filename, None,
+		lambda: np.recfromcsv(filename), loader_options='recfromcsv')
 
 
-def make_catalogs():
+# Both catalogs are held as compact_catalogs: narrowed dtypes in one buffer each. The
+# Galaxy Zoo vote fractions are kept as float32. memory_budget_mb, if given, is the
+# most each catalog may take up. cache_directory is passed on to read_table.
+def make_catalogs(NSA_filename='data_from_fits.csv', GZoo_filename='data_from_galaxy_zoo.csv',
+		memory_budget_mb=None, cache_directory=None):
 	print 'reading NSA...'
-	NSA_rec = np.recfromcsv('data_from_fits.csv')
+	NSA_rec = compact_catalog.compact_catalog(read_table(NSA_filename, cache_directory),
+		memory_budget_mb=memory_budget_mb)
+	NSA_rec.print_memory_report()
 	print '\t...done.'
 
 	print 'reading GZoo...'
-	GZoo_rec = np.recfromcsv('data_from_galaxy_zoo.csv')
+	GZoo_table = read_table(GZoo_filename, cache_directory)
+	GZoo_rec = compact_catalog.compact_catalog(GZoo_table, float32_columns=[name for name in
+		GZoo_table.dtype.names if name.endswith('_debiased')], memory_budget_mb=memory_budget_mb)
+	del GZoo_table
+	GZoo_rec.print_memory_report()
 	print '\t...done.'
 
-	GZoo_catalog = catalog(GZoo_rec, 'ra', 'dec')
-	NSA_catalog = catalog(NSA_rec, 'ra', 'dec')
+	# Each catalog's spatial index is saved next to it and reused on later runs.
+	GZoo_catalog = catalog(GZoo_rec, 'ra', 'dec', index_filename='{}.skyindex'.format(GZoo_filename))
+	NSA_catalog = catalog(NSA_rec, 'ra', 'dec', index_filename='{}.skyindex'.format(NSA_filename))
 
 	return GZoo_catalog, NSA_catalog 
 
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from coord_match_NSA_GZoo import (get_dec_stripes, match_coordinates, match_coordinates_original,
+	match_coordinates_out_of_core, produce_combined_table)
+import columnar_store
+
+
+# Checks of coord_match_NSA_GZoo on random catalogs, so they run without the NSA and
+# Galaxy Zoo files:
+# $ python test_coord_match_NSA_GZoo.py
+
+# Take all specified GZoo columns, NSA columns, and the NSA->GZoo matching pointer array. 
+# Returns a single rec array. In the future, this should be a done by a proper database.
+# The row-by-row version of produce_combined_table, which the bulk one must match.
+def produce_combined_table_original(NSA_recarray, GZoo_recarray, NSA_to_GZoo_match_array, foreign_key,
+	output_filename, additional_columns=['DEICH_match_arcsec']):
+	#output_columns = list(map(lambda s: 'GZoo_' + s, GZoo_recarray.dtype.names)) + list(
+	#	map(lambda s: 'NSA_' + s, NSA_recarray.dtype.names)) 
+
+	def make_csv_string(GZoo_row, NSA_row, match_row, this_is_header_line=False):
+		if this_is_header_line:
+			output_columns = list(GZoo_recarray.dtype.names) + list(NSA_recarray.dtype.names) + additional_columns
+			csv_string =  '{}\n'.format(','.join(output_columns))
+		else:
+			output_list = []
+			output_list.extend([str(i) for i in GZoo_row])
+			output_list.extend([str(i) for i in NSA_row]) 
+			output_list.extend([str(i) for i in [match_row['DEICH_match_arcsec']]])
+			csv_string = '{}\n'.format(','.join(output_list))
+		return csv_string
+
+	with open(output_filename, 'w') as f:
+		# write header line.
+		f.write(make_csv_string(GZoo_row=GZoo_recarray[0],
+			NSA_row=NSA_recarray[0],
+			match_row=NSA_to_GZoo_match_array[0], 
+			this_is_header_line=True))
+
+		# write each row in CSV format.
+		for index_into_NSA, match_row in enumerate(NSA_to_GZoo_match_array):
+			if match_row['DEICH_match_arcsec'] < 100000.:
+				index_into_GZoo = match_row['index_into_catalog']
+				f.write(make_csv_string(GZoo_recarray[index_into_GZoo], 
+					NSA_recarray[index_into_NSA],
+					match_row=match_row))
+
+	return ''
+
+
+# Random catalogs shaped like the ones highest_level reads: the NSA columns from FITS
+# (float32 apart from NSAID/RA/DEC), the GZoo ones from a CSV. Some float columns also
+# get negative values, nan/inf and values that print with an exponent.
+def make_fake_combined_catalogs(n_NSA, n_GZoo):
+	np.random.seed(0)
+	NSA_columns = [np.arange(n_NSA), np.random.uniform(110., 260., n_NSA),
+		np.random.uniform(-5., 65., n_NSA)] + [np.random.lognormal(0., 2., n_NSA).astype(np.float32)
+		for name in ['Z', 'ZDIST', 'MASS', 'SERSIC_TH50', 'D4000', 'HAEW']]
+	NSA_recarray = np.rec.fromarrays(NSA_columns,
+		names='NSAID,RA,DEC,Z,ZDIST,MASS,SERSIC_TH50,D4000,HAEW')
+	NSA_recarray['MASS'] = (10. ** np.random.uniform(-30., 30., n_NSA)).astype(np.float32)
+	NSA_recarray['D4000'] *= np.random.choice([-1, 1], n_NSA)
+	NSA_recarray['HAEW'][::7] = np.nan
+	NSA_recarray['HAEW'][3::7] = -np.inf
+	GZoo_recarray = np.rec.fromarrays([np.random.randint(0, 2**62, n_GZoo),
+		np.round(np.random.uniform(110., 260., n_GZoo), 6),
+		np.round(np.random.uniform(-5., 65., n_GZoo), 6),
+		np.round(np.random.uniform(0., 1., n_GZoo), 3),
+		np.random.normal(0., 1., n_GZoo) * 10. ** np.random.uniform(-300., 300., n_GZoo)],
+		names='dr8objid,ra,dec,t01_smooth_or_features_a01_smooth_debiased,t04_spiral_a08_spiral_debiased')
+	GZoo_recarray['t04_spiral_a08_spiral_debiased'][::11] = np.inf
+	GZoo_recarray['t04_spiral_a08_spiral_debiased'][5::11] = np.nan
+	match_array = np.rec.fromarrays([np.random.randint(0, n_GZoo, n_NSA),
+		np.where(np.random.uniform(size=n_NSA) < 0.8, np.random.exponential(2., n_NSA), np.inf)],
+		dtype=[('index_into_catalog', int), ('DEICH_match_arcsec', float)])
+	return NSA_recarray, GZoo_recarray, match_array
+
+
+# Checks that produce_combined_table writes the same CSV as the row-by-row version, in one
+# process and in several, and that the columnar store holds the same rows.
+def test_combined_table(n_NSA=20000, n_GZoo=30000):
+	NSA_recarray, GZoo_recarray, match_array = make_fake_combined_catalogs(n_NSA, n_GZoo)
+	sDirectory = tempfile.mkdtemp(prefix='combined_table_test_')
+	try:
+		original_filename = os.path.join(sDirectory, 'original.csv')
+		start_time = time.time()
+		produce_combined_table_original(NSA_recarray, GZoo_recarray, match_array, 'dr8objid',
+			original_filename)
+		original_time = time.time() - start_time
+		with open(original_filename, 'r') as f:
+			original_csv = f.read()
+
+		for n_workers in [1, 2]:
+			output_filename = os.path.join(sDirectory, 'bulk_{}.csv'.format(n_workers))
+			start_time = time.time()
+			produce_combined_table(NSA_recarray, GZoo_recarray, match_array, 'dr8objid',
+				output_filename, n_workers=n_workers)
+			elapsed_time = time.time() - start_time
+			with open(output_filename, 'r') as f:
+				assert f.read() == original_csv
+			print 'combined table ({} process(es)): {:.2f} s, row by row {:.2f} s ({:.1f}x).'.format(
+				n_workers, elapsed_time, original_time, original_time / elapsed_time)
+
+		output_filename = os.path.join(sDirectory, 'bulk.columnar')
+		combined_array = produce_combined_table(NSA_recarray, GZoo_recarray, match_array,
+			'dr8objid', output_filename, output_format='columnar')
+		assert len(combined_array) == len(original_csv.splitlines()) - 1
+		stored_array = columnar_store.read_columnar_store(output_filename)
+		for column_name in combined_array.dtype.names:
+			assert np.array_equal(stored_array[column_name], combined_array[column_name]) or \
+				np.allclose(stored_array[column_name], combined_array[column_name], equal_nan=True)
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+# Checks that the stripe matchers give the serial matchers' results when every object
+# sits at the same declination (so the stripes collapse into one), for both catalogs
+# there and for the match objects alone.
+def test_stripes_at_one_dec(n_catalog=50, n_match=80, dec=5.):
+	np.random.seed(0)
+	edges, stripe = get_dec_stripes(np.full(n_match, dec), 8)
+	assert edges[0] == -90. and edges[-1] == 90. and len(edges) >= 2
+	assert np.all(stripe < len(edges) - 1)
+	assert list(get_dec_stripes(np.zeros(0), 8)[0]) == [-90., 90.]
+
+	catalog_ra = np.random.uniform(0., 1., n_catalog)
+	match_ra = np.random.uniform(0., 1., n_match)
+	for catalog_dec in [np.full(n_catalog, dec), np.random.uniform(4., 6., n_catalog)]:
+		match_dec = np.full(n_match, dec)
+		serial = match_coordinates_original(catalog_ra, catalog_dec, match_ra, match_dec)
+		parallel = match_coordinates_original(catalog_ra, catalog_dec, match_ra, match_dec,
+			n_workers=2)
+		assert np.array_equal(serial['index_into_catalog'], parallel['index_into_catalog'])
+		assert np.allclose(serial['DEICH_match_arcsec'], parallel['DEICH_match_arcsec'])
+
+		serial = match_coordinates(match_ra, match_dec, catalog_ra, catalog_dec, max_arcsec_sep=600)
+		parallel = match_coordinates(match_ra, match_dec, catalog_ra, catalog_dec, max_arcsec_sep=600,
+			n_workers=2)
+		assert len(parallel) == len(serial) > 0
+		order = np.lexsort((serial['index_into_coord2'], serial['index_into_catalog']))
+		for column_name in ['index_into_catalog', 'index_into_coord2']:
+			assert np.array_equal(serial[column_name][order], parallel[column_name])
+		assert np.allclose(serial['DEICH_match_arcsec'][order], parallel['DEICH_match_arcsec'])
+
+
+# Checks that the out-of-core matcher gives match_coordinates_original's results on an
+# all-sky sample (objects at and around the poles included), with a memory budget so
+# small that the sky is matched a few zones at a time and sparse zones need their
+# margins widened.
+def test_out_of_core(n_catalog=2000, n_match=3000, memory_budget_mb=0.02):
+	np.random.seed(0)
+	catalog_ra = np.random.uniform(0., 360., n_catalog)
+	catalog_dec = np.degrees(np.arcsin(np.random.uniform(-1., 1., n_catalog)))
+	catalog_dec[:4] = [-90., 90., -89.99, 89.95]
+	match_ra = np.random.uniform(0., 360., n_match)
+	match_dec = np.degrees(np.arcsin(np.random.uniform(-1., 1., n_match)))
+	match_dec[:6] = [-90., 90., -89.999, 89.999, -89.9, 0.]
+	sDirectory = tempfile.mkdtemp(prefix='out_of_core_test_')
+	try:
+		expected = match_coordinates_original(catalog_ra, catalog_dec, match_ra, match_dec)
+		# The inputs come in a few chunks each, as from a columnar store.
+		catalog_chunks = [(catalog_ra[start:start + 700], catalog_dec[start:start + 700])
+			for start in range(0, n_catalog, 700)]
+		match_chunks = [(match_ra[start:start + 1000], match_dec[start:start + 1000])
+			for start in range(0, n_match, 1000)]
+		sOutputFileName = os.path.join(sDirectory, 'matches.npy')
+		matches = match_coordinates_out_of_core(catalog_chunks, match_chunks, sOutputFileName,
+			memory_budget_mb=memory_budget_mb, margin_arcsec=60.)
+		assert isinstance(matches.base, np.memmap)
+		assert np.array_equal(matches['index_into_catalog'], expected['index_into_catalog'])
+		assert np.allclose(matches['DEICH_match_arcsec'], expected['DEICH_match_arcsec'])
+		del matches
+	finally:
+		shutil.rmtree(sDirectory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+	test_combined_table()
+	test_stripes_at_one_dec()
+	test_out_of_core()